@@ -1,8 +1,11 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
 import io
+import math
 from typing import List, Optional
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 from fastapi import File, Form, UploadFile
 from PIL import Image
 
@@ -11,6 +14,9 @@ from embeddings.documents import KnowledgeDocument
 from knowledge_manager import KnowledgeManager
 from llms.chats import ChatManager, ChatOptions, StreamingChat
 from llms.model_config import ModelConfig
+from llms.prometheus import CONTENT_TYPE as PROMETHEUS_CONTENT_TYPE
+from llms.rate_limit import RateLimitExceeded
+from llms.session_locks import SessionBusy
 from llms.image_description_service import ImageDescriptionService
 from prompts.prompts import PromptList
 from prompts.inspirations import InspirationsManager
@@ -55,6 +61,177 @@ def streaming_headers(chat_session_key_value=None):
     return headers
 
 
+def chat_events(chat_session, method_name: str, *args, **kwargs):
+    """
+    Iterates the events of a chat session method from the event loop. Chats with an async
+    variant of the method (e.g. run_async for run) stream without holding a worker thread,
+    other chat sessions are iterated in the thread pool like before.
+    """
+    if getattr(type(chat_session), f"{method_name}_async", None) is not None:
+        return getattr(chat_session, f"{method_name}_async")(*args, **kwargs)
+    return _iterate_in_threadpool(getattr(chat_session, method_name)(*args, **kwargs))
+
+
+async def _iterate_in_threadpool(events):
+    try:
+        async for event in iterate_in_threadpool(events):
+            yield event
+    finally:
+        # a stream cancelled before its end leaves the generator open, closing it ends the model
+        # response and runs the cleanup of the chat, like saving what was answered until then
+        if hasattr(events, "close"):
+            await run_in_threadpool(events.close)
+
+
+# Streamed chunks are sent together if they arrive within this window, or until the batch has this many characters
+STREAM_BATCH_WINDOW_SECONDS = 0.02
+STREAM_BATCH_MAX_CHARS = 4096
+
+
+class UnbatchedFrame(str):
+    """
+    A streamed event that batch_events sends as a frame of its own: JSON objects, which have no delimiter
+    the client could split joined frames by, and errors, which the client only detects at the start of a frame.
+    """
+
+
+async def batch_events(
+    events,
+    window_seconds: float = STREAM_BATCH_WINDOW_SECONDS,
+    max_chars: int = STREAM_BATCH_MAX_CHARS,
+):
+    """
+    Joins the formatted events of a stream into larger frames: a frame is sent at the latest
+    window_seconds after its first event, or as soon as it reaches max_chars. Models often stream
+    one token per chunk, so this saves most of the writes per response at a barely noticeable delay.
+    Every event ends on a complete message, so joining them does not change what the client parses.
+    """
+    if window_seconds <= 0:
+        async for event in events:
+            yield event
+        return
+
+    loop = asyncio.get_running_loop()
+    iterator = events.__aiter__()
+    batch: List[str] = []
+    batch_chars = 0
+    flush_at = 0.0
+    next_event = None
+    try:
+        while True:
+            if next_event is None:
+                next_event = asyncio.ensure_future(iterator.__anext__())
+            if batch:
+                done, _ = await asyncio.wait(
+                    {next_event}, timeout=max(0.0, flush_at - loop.time())
+                )
+                if not done:
+                    yield "".join(batch)
+                    batch, batch_chars = [], 0
+                    continue
+            try:
+                event = await next_event
+            except StopAsyncIteration:
+                next_event = None
+                break
+            next_event = None
+
+            if isinstance(event, UnbatchedFrame):
+                if batch:
+                    yield "".join(batch)
+                    batch, batch_chars = [], 0
+                yield event
+                continue
+            if not batch:
+                flush_at = loop.time() + window_seconds
+            batch.append(event)
+            batch_chars += len(event)
+            if batch_chars >= max_chars:
+                yield "".join(batch)
+                batch, batch_chars = [], 0
+
+        if batch:
+            yield "".join(batch)
+    finally:
+        if next_event is not None:
+            next_event.cancel()
+
+
+# how often a streaming response checks whether its client is still connected
+DISCONNECT_POLL_SECONDS = 0.5
+
+
+async def cancel_on_disconnect(
+    events,
+    is_disconnected,
+    poll_seconds: float = DISCONNECT_POLL_SECONDS,
+):
+    """
+    Passes the events of a stream on until the client disconnects, then cancels the event being
+    awaited. The cancellation goes through the chat down to the model response, which is closed
+    instead of being read to its end for nobody.
+    """
+    iterator = events.__aiter__()
+    disconnected = asyncio.ensure_future(
+        _wait_for_disconnect(is_disconnected, poll_seconds)
+    )
+    next_event = None
+    try:
+        while True:
+            next_event = asyncio.ensure_future(iterator.__anext__())
+            await asyncio.wait(
+                {next_event, disconnected}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not next_event.done():
+                HaivenLogger.get().info(
+                    "Client disconnected, cancelling its stream",
+                    extra={"INFO": "StreamClientDisconnected"},
+                )
+                break
+            try:
+                event = next_event.result()
+            except StopAsyncIteration:
+                break
+            next_event = None
+            yield event
+    finally:
+        disconnected.cancel()
+        if next_event is not None and not next_event.done():
+            next_event.cancel()
+            # lets the chat save what was streamed until now before the response ends
+            await asyncio.wait({next_event})
+        await iterator.aclose()
+
+
+async def _wait_for_disconnect(is_disconnected, poll_seconds: float) -> None:
+    while not await is_disconnected():
+        await asyncio.sleep(poll_seconds)
+
+
+def stream_body(events, request: Optional[Request]):
+    """The body of a streaming chat response, cancelled when the client of the request disconnects."""
+    if request is not None:
+        events = cancel_on_disconnect(events, request.is_disconnected)
+    return batch_events(events)
+
+
+class SessionTurnStreamingResponse(StreamingResponse):
+    """
+    Streams the answer of a chat session turn, and gives up the turn once the response is done,
+    also when the client disconnected before its stream started.
+    """
+
+    def __init__(self, session_turn, content, **kwargs):
+        super().__init__(content, **kwargs)
+        self.session_turn = session_turn
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.session_turn.release()
+
+
 class HaivenBaseApi:
     def __init__(
         self,
@@ -91,19 +268,31 @@ class HaivenBaseApi:
         origin_url=None,
         model_config=None,
         userContext=None,
+        state_snapshot=False,
+        request: Request = None,
     ):
         """Stream JSON chat with simplified event handling"""
+        rate_limited_response = self._rate_limited_response(
+            model_config or self.model_config
+        )
+        if rate_limited_response:
+            return rate_limited_response
+
         try:
 
-            def stream_with_events(chat_session, prompt):
+            async def stream_with_events(session_turn, chat_session, prompt):
                 try:
-                    # Pass through the formatted events from the chat session (original behavior)
-                    for event_str in chat_session.run(prompt):
-                        # Ensure we're yielding strings, not dicts
-                        if isinstance(event_str, dict):
-                            yield json.dumps(event_str)
-                        else:
-                            yield str(event_str)
+                    async with session_turn:
+                        # Pass through the formatted events from the chat session (original behavior)
+                        run_kwargs = {"state_snapshot": True} if state_snapshot else {}
+                        async for event_str in chat_events(
+                            chat_session, "run", prompt, **run_kwargs
+                        ):
+                            # Ensure we're yielding strings, not dicts
+                            if isinstance(event_str, dict):
+                                yield UnbatchedFrame(json.dumps(event_str))
+                            else:
+                                yield str(event_str)
 
                 except Exception as error:
                     error_msg = (
@@ -113,7 +302,7 @@ class HaivenBaseApi:
                     print(f"[ERROR]: {error_msg}")
                     # Send error in JSON format for JSON chat
                     error_response = {"data": f"[ERROR]: {error_msg}"}
-                    yield json.dumps(error_response)
+                    yield UnbatchedFrame(json.dumps(error_response))
 
             chat_session_key_value, chat_session = self.chat_manager.json_chat(
                 model_config=model_config or self.model_config,
@@ -122,26 +311,54 @@ class HaivenBaseApi:
                 contexts=contexts or [],
                 user_context=userContext,
             )
-
-            self.log_run(
-                chat_session,
-                origin_url,
-                user_identifier,
-                chat_session_key_value,
-                prompt_id,
-                contexts,
-                userContext,
+            # claimed as the request arrives, so requests arriving before its stream starts see it
+            session_turn = self.chat_manager.session_turn(
+                chat_session_key_value, chat_session
             )
+            try:
+                self.log_run(
+                    chat_session,
+                    origin_url,
+                    user_identifier,
+                    chat_session_key_value,
+                    prompt_id,
+                    contexts,
+                    userContext,
+                )
 
-            return StreamingResponse(
-                stream_with_events(chat_session, prompt),
-                media_type=streaming_media_type(),
-                headers=streaming_headers(chat_session_key_value),
-            )
+                return SessionTurnStreamingResponse(
+                    session_turn,
+                    stream_body(
+                        stream_with_events(session_turn, chat_session, prompt),
+                        request,
+                    ),
+                    media_type=streaming_media_type(),
+                    headers=streaming_headers(chat_session_key_value),
+                )
+            except BaseException:
+                session_turn.release()
+                raise
 
+        except SessionBusy as error:
+            return self._session_busy_response(error)
         except Exception as error:
             raise Exception(error)
 
+    def _session_busy_response(self, error: SessionBusy):
+        return JSONResponse({"detail": str(error)}, status_code=409)
+
+    def _rate_limited_response(self, model_config: ModelConfig):
+        # Reject right away instead of holding the request open until the model's turn comes
+        try:
+            self.chat_manager.check_rate_limit(model_config)
+        except RateLimitExceeded as error:
+            return JSONResponse(
+                {"detail": str(error)},
+                status_code=429,
+                headers={"Retry-After": str(math.ceil(error.retry_after))},
+            )
+        return None
+
     def log_run(
         self,
         chat_session,
@@ -175,31 +392,42 @@ class HaivenBaseApi:
         origin_url=None,
         userContext=None,
         model_config=None,
+        request: Request = None,
     ):
         """Stream text chat with simplified event handling"""
+        rate_limited_response = self._rate_limited_response(
+            model_config or self.model_config
+        )
+        if rate_limited_response:
+            return rate_limited_response
+
         try:
 
-            def stream_with_events(chat_session: StreamingChat, prompt):
+            async def stream_with_events(
+                session_turn, chat_session: StreamingChat, prompt
+            ):
                 try:
-                    if document_keys:
-                        # Handle document-based streaming
-                        for (
-                            event_str,
-                            sources_markdown,
-                        ) in chat_session.run_with_document(document_keys, prompt):
-                            # Ensure we're yielding strings, not dicts
-                            if isinstance(event_str, dict):
-                                yield json.dumps(event_str)
-                            else:
-                                yield str(event_str)
-                    else:
-                        # Handle regular streaming
-                        for event_str in chat_session.run(prompt):
-                            # Ensure we're yielding strings, not dicts
-                            if isinstance(event_str, dict):
-                                yield json.dumps(event_str)
-                            else:
-                                yield str(event_str)
+                    async with session_turn:
+                        if document_keys:
+                            # Handle document-based streaming
+                            async for event_str, sources_markdown in chat_events(
+                                chat_session, "run_with_document", document_keys, prompt
+                            ):
+                                # Ensure we're yielding strings, not dicts
+                                if isinstance(event_str, dict):
+                                    yield UnbatchedFrame(json.dumps(event_str))
+                                else:
+                                    yield str(event_str)
+                        else:
+                            # Handle regular streaming
+                            async for event_str in chat_events(
+                                chat_session, "run", prompt
+                            ):
+                                # Ensure we're yielding strings, not dicts
+                                if isinstance(event_str, dict):
+                                    yield UnbatchedFrame(json.dumps(event_str))
+                                else:
+                                    yield str(event_str)
 
                 except Exception as error:
                     error_msg = (
@@ -207,7 +435,7 @@ class HaivenBaseApi:
                         or "Error while the model was processing the input"
                     )
                     print(f"[ERROR]: {error_msg}")
-                    yield f"[ERROR]: {error_msg}"
+                    yield UnbatchedFrame(f"[ERROR]: {error_msg}")
 
             chat_session_key_value, chat_session = self.chat_manager.streaming_chat(
                 model_config=model_config or self.model_config,
@@ -216,23 +444,36 @@ class HaivenBaseApi:
                 contexts=contexts or [],
                 user_context=userContext,
             )
-
-            self.log_run(
-                chat_session,
-                origin_url,
-                user_identifier,
-                chat_session_key_value,
-                prompt_id,
-                contexts,
-                userContext,
+            # claimed as the request arrives, so requests arriving before its stream starts see it
+            session_turn = self.chat_manager.session_turn(
+                chat_session_key_value, chat_session
             )
+            try:
+                self.log_run(
+                    chat_session,
+                    origin_url,
+                    user_identifier,
+                    chat_session_key_value,
+                    prompt_id,
+                    contexts,
+                    userContext,
+                )
 
-            return StreamingResponse(
-                stream_with_events(chat_session, prompt),
-                media_type=streaming_media_type(),
-                headers=streaming_headers(chat_session_key_value),
-            )
+                return SessionTurnStreamingResponse(
+                    session_turn,
+                    stream_body(
+                        stream_with_events(session_turn, chat_session, prompt),
+                        request,
+                    ),
+                    media_type=streaming_media_type(),
+                    headers=streaming_headers(chat_session_key_value),
+                )
+            except BaseException:
+                session_turn.release()
+                raise
 
+        except SessionBusy as error:
+            return self._session_busy_response(error)
         except Exception as error:
             raise Exception(error)
 
@@ -289,6 +530,57 @@ class ApiBasics(HaivenBaseApi):
                     status_code=500, detail=f"Server error: {str(error)}"
                 )
 
+        @app.get("/api/connection-pools")
+        @logger.catch(reraise=True)
+        def get_connection_pools(request: Request):
+            try:
+                return JSONResponse(self.chat_manager.get_http_pool_stats())
+
+            except Exception as error:
+                HaivenLogger.get().error(str(error))
+                raise HTTPException(
+                    status_code=500, detail=f"Server error: {str(error)}"
+                )
+
+        @app.get("/api/model-latency")
+        @logger.catch(reraise=True)
+        def get_model_latency(request: Request):
+            try:
+                return JSONResponse(self.chat_manager.get_model_latency_stats())
+
+            except Exception as error:
+                HaivenLogger.get().error(str(error))
+                raise HTTPException(
+                    status_code=500, detail=f"Server error: {str(error)}"
+                )
+
+        @app.get("/api/chat-memory")
+        @logger.catch(reraise=True)
+        def get_chat_memory(request: Request):
+            try:
+                return JSONResponse(self.chat_manager.get_memory_report())
+
+            except Exception as error:
+                HaivenLogger.get().error(str(error))
+                raise HTTPException(
+                    status_code=500, detail=f"Server error: {str(error)}"
+                )
+
+        @app.get("/metrics")
+        @logger.catch(reraise=True)
+        def get_metrics(request: Request):
+            try:
+                return PlainTextResponse(
+                    self.chat_manager.get_metrics_text(),
+                    media_type=PROMETHEUS_CONTENT_TYPE,
+                )
+
+            except Exception as error:
+                HaivenLogger.get().error(str(error))
+                raise HTTPException(
+                    status_code=500, detail=f"Server error: {str(error)}"
+                )
+
         @app.get("/api/prompts")
         @logger.catch(reraise=True)
         def get_prompts(request: Request):
@@ -426,6 +718,7 @@ class ApiBasics(HaivenBaseApi):
                     contexts=contexts,
                     userContext=data.userContext,
                     origin_url=origin_url,
+                    request=request,
                 )
 
             except Exception as error:
@@ -435,7 +728,7 @@ class ApiBasics(HaivenBaseApi):
                 )
 
         @app.post("/api/prompt/iterate")
-        def iterate(prompt_data: IterateRequest):
+        def iterate(request: Request, prompt_data: IterateRequest):
             try:
                 if prompt_data.chatSessionId is None or prompt_data.chatSessionId == "":
                     raise HTTPException(
@@ -473,6 +766,9 @@ class ApiBasics(HaivenBaseApi):
                     chat_session_key_value=prompt_data.chatSessionId,
                     contexts=prompt_data.contexts,
                     userContext=prompt_data.user_context,
+                    # every iteration sends the complete current data, so the earlier ones can be dropped
+                    state_snapshot=True,
+                    request=request,
                 )
 
             except Exception as e:
@@ -46,4 +46,5 @@ class ApiCompanyResearch(HaivenBaseApi):
                 user_identifier=self.get_hashed_user_id(request),
                 origin_url=origin_url,
                 model_config=perplexity_model_config,
+                request=request,
             )
@@ -30,4 +30,5 @@ class ApiCreativeMatrix(HaivenBaseApi):
                 "creative-matrix",
                 origin_url=origin_url,
                 prompt_id="creative-matrix",
+                request=request,
             )
@@ -80,6 +80,7 @@ class ApiMultiStep(HaivenBaseApi):
                     origin_url=origin_url,
                     contexts=prompt_data.contexts,
                     userContext=prompt_data.userContext,
+                    request=request,
                 )
 
             except Exception as error:
@@ -146,6 +147,7 @@ I want to focus on this item:
                     origin_url=origin_url,
                     contexts=prompt_data.contexts,
                     userContext=prompt_data.userContext,
+                    request=request,
                 )
 
             except Exception as error:
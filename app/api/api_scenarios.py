@@ -36,4 +36,5 @@ class ApiScenarios(HaivenBaseApi):
                 prompt_id="scenarios",
                 user_identifier=self.get_hashed_user_id(request),
                 origin_url=origin_url,
+                request=request,
             )
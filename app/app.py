@@ -1,7 +1,8 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 from api.boba_api import BobaApi
 from knowledge_manager import KnowledgeManager
-from llms.chats import ChatManager, ServerChatSessionMemory
+from llms.chats import ChatManager
+from llms.chat_session_store import create_chat_session_store
 from llms.image_description_service import ImageDescriptionService
 from llms.clients import ChatClientFactory
 from llms.model_config import ModelConfig
@@ -30,10 +31,18 @@ class App:
 
         prompts_factory = PromptsFactory(knowledge_pack_path)
         disclaimer_and_guidelines = DisclaimerAndGuidelinesService(knowledge_pack_path)
-        chat_session_memory = ServerChatSessionMemory()
+        chat_session_store_config = config_service.load_chat_session_store_config()
+        chat_session_memory = create_chat_session_store(chat_session_store_config)
+        chat_session_memory.start_sweeper(
+            chat_session_store_config.sweep_interval_seconds
+        )
         llm_chat_factory = ChatClientFactory(config_service)
         chat_manager = ChatManager(
-            config_service, chat_session_memory, llm_chat_factory, knowledge_manager
+            config_service,
+            chat_session_memory,
+            llm_chat_factory,
+            knowledge_manager,
+            concurrent_requests=chat_session_store_config.concurrent_requests,
         )
 
         image_service = self.create_image_service(config_service)
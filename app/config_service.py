@@ -6,8 +6,16 @@ from typing import List
 import yaml
 from dotenv import load_dotenv
 from knowledge.pack import KnowledgePackError
+from knowledge.search_config import KnowledgeSearchConfig
 from llms.model_config import ModelConfig
 from llms.default_models import DefaultModels
+from llms.query_rewrite_config import QueryRewriteConfig
+from llms.rate_limit_config import RateLimitConfig
+from llms.http_pool_config import HttpPoolConfig
+from llms.completion_cache_config import CompletionCacheConfig
+from llms.memory_compaction_config import MemoryCompactionConfig
+from llms.model_routing_config import ModelRoutingConfig
+from llms.chat_session_store_config import ChatSessionStoreConfig
 from embeddings.model import EmbeddingModel
 import re
 
@@ -190,6 +198,78 @@ class ConfigService:
 
         return default_models
 
+    def load_knowledge_search_config(self) -> KnowledgeSearchConfig:
+        """
+        Load the knowledge search settings from the config file.
+
+        Returns:
+            KnowledgeSearchConfig: The search settings, with defaults for anything not configured.
+        """
+        return KnowledgeSearchConfig.from_dict(self.data.get("knowledge_search"))
+
+    def load_memory_compaction_config(self) -> MemoryCompactionConfig:
+        """
+        Load how the memory of long chat sessions is kept under the prompt token budget.
+
+        Returns:
+            MemoryCompactionConfig: The memory compaction settings, without a token budget if nothing is configured.
+        """
+        return MemoryCompactionConfig.from_dict(self.data.get("memory_compaction"))
+
+    def load_completion_cache_config(self) -> CompletionCacheConfig:
+        """
+        Load whether and where model responses to identical requests are cached.
+
+        Returns:
+            CompletionCacheConfig: The completion cache settings, disabled if nothing is configured.
+        """
+        return CompletionCacheConfig.from_dict(self.data.get("completion_cache"))
+
+    def load_http_pool_config(self) -> HttpPoolConfig:
+        """
+        Load the limits of the pooled HTTP connections to the model providers.
+
+        Returns:
+            HttpPoolConfig: The connection pool settings, with defaults for anything not configured.
+        """
+        return HttpPoolConfig.from_dict(self.data.get("http_pool"))
+
+    def load_rate_limit_config(self) -> RateLimitConfig:
+        """
+        Load how model calls are throttled and retried when a provider rate limits them.
+
+        Returns:
+            RateLimitConfig: The rate limit settings, with defaults for anything not configured.
+        """
+        return RateLimitConfig.from_dict(self.data.get("rate_limit"))
+
+    def load_model_routing_config(self) -> ModelRoutingConfig:
+        """
+        Load which models answer instead of a chat's own model when it fails or is slow to answer.
+
+        Returns:
+            ModelRoutingConfig: The fallback models and hedging delay per model feature, no fallbacks if nothing is configured.
+        """
+        return ModelRoutingConfig.from_dict(self.data.get("model_routing"))
+
+    def load_chat_session_store_config(self) -> ChatSessionStoreConfig:
+        """
+        Load where chat sessions are kept between the requests of a conversation.
+
+        Returns:
+            ChatSessionStoreConfig: The session store settings, in process memory if nothing is configured.
+        """
+        return ChatSessionStoreConfig.from_dict(self.data.get("chat_sessions"))
+
+    def load_query_rewrite_config(self) -> QueryRewriteConfig:
+        """
+        Load how the search query for knowledge documents is derived from a conversation.
+
+        Returns:
+            QueryRewriteConfig: The query rewrite settings, the full LLM rewrite if nothing is configured.
+        """
+        return QueryRewriteConfig.from_dict(self.data.get("query_rewrite"))
+
     def get_default_chat_model(self) -> str:
         """
         Get the default chat model from the config file.
@@ -350,7 +430,7 @@ def _resolve_config_list_values(config, key, value):
 
 
 def _replace_by_env_var(value):
-    if value is None:
+    if not isinstance(value, str):
         return value
 
     # Use regex to find all ${ENV_VAR} patterns and replace them with their values
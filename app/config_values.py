@@ -0,0 +1,24 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+
+# Config values usually come from env var placeholders in config.yaml,
+# so unset ones arrive as empty strings and set ones as strings.
+
+
+def to_int(value, default: int) -> int:
+    if value is None or value == "":
+        return default
+    return int(value)
+
+
+def to_float(value, default: float) -> float:
+    if value is None or value == "":
+        return default
+    return float(value)
+
+
+def to_bool(value, default: bool) -> bool:
+    if value is None or value == "":
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() == "true"
@@ -0,0 +1,102 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List
+
+from langchain_core.embeddings import Embeddings
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache with an optional time-to-live per entry.
+    Keeps hit and miss counters so callers can report how effective the cache is.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl_seconds: float = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if self._is_expired(stored_at):
+                    del self._entries[key]
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self._clock(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def _is_expired(self, stored_at: float) -> bool:
+        return (
+            self.ttl_seconds is not None
+            and self._clock() - stored_at > self.ttl_seconds
+        )
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Sits in front of an embeddings provider and caches query embeddings by model id and
+    normalized query text, so repeated queries do not pay another round-trip to the provider.
+    Document embeddings are always passed through.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: LRUCache, model_id: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_id = model_id
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = (self.model_id, CachedQueryEmbeddings.normalize_query(text))
+        embedding = self.cache.get(key)
+        if embedding is None:
+            # kept as a tuple and copied on each hit, so callers changing their list do not change the cache
+            embedding = tuple(self.embeddings.embed_query(text))
+            self.cache.put(key, embedding)
+        return list(embedding)
+
+    @staticmethod
+    def normalize_query(text: str) -> str:
+        return re.sub(r"\s+", " ", text or "").strip()
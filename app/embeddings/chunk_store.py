@@ -0,0 +1,145 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import json
+import numbers
+import os
+import pickle
+import sys
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Iterator, List, Union
+
+import pyarrow as pa
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
+
+CHUNKS_FILE_NAME = "chunks.arrow"
+VECTORS_FILE_NAME = "vectors.npy"
+INDEX_FILE_NAME = "index.faiss"
+
+CHUNKS_SCHEMA = pa.schema(
+    [
+        pa.field("id", pa.string()),
+        pa.field("page_content", pa.string()),
+        pa.field("metadata", pa.string()),
+    ]
+)
+
+
+class ChunkStore(Docstore):
+    """
+    Read-only docstore over an uncompressed Arrow IPC file with one row per chunk, in the same
+    order as the vectors in the FAISS index. The file is memory-mapped, so a chunk is only read
+    from disk when it is returned by a search, and worker processes on the same host share the
+    pages through the OS page cache instead of each holding their own copy.
+    """
+
+    def __init__(self, chunks_file_path: Union[str, Path]):
+        self.chunks_file_path = str(chunks_file_path)
+        with pa.memory_map(self.chunks_file_path, "r") as source:
+            # read_all on a memory map is zero-copy, the columns point into the mapped file
+            self._table = pa.ipc.open_file(source).read_all()
+        self._ids = self._table.column("id")
+        self._page_contents = self._table.column("page_content")
+        self._metadata = self._table.column("metadata")
+
+    def __len__(self) -> int:
+        return self._table.num_rows
+
+    def search(self, search: int) -> Union[str, Document]:
+        # FAISS hands over numpy integers from its search results
+        if not isinstance(search, numbers.Integral) or not 0 <= search < len(self):
+            return f"ID {search} not found."
+        search = int(search)
+        return Document(
+            id=self._ids[search].as_py(),
+            page_content=self._page_contents[search].as_py(),
+            metadata=json.loads(self._metadata[search].as_py() or "{}"),
+        )
+
+    def size_bytes(self) -> int:
+        """The size of the ids, texts and metadata of the chunks, as mapped from the file."""
+        return self._table.nbytes
+
+    def row_positions(self) -> "RowPositions":
+        return RowPositions(len(self))
+
+
+class RowPositions(Mapping):
+    """
+    Stands in for FAISS' index_to_docstore_id dictionary when the docstore rows are in index order,
+    so a pack does not need one dictionary entry per chunk.
+    """
+
+    def __init__(self, size: int):
+        self._size = size
+
+    def __getitem__(self, row: int) -> int:
+        if not isinstance(row, numbers.Integral) or not 0 <= row < self._size:
+            raise KeyError(row)
+        return int(row)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(self._size))
+
+    def __len__(self) -> int:
+        return self._size
+
+
+def write_chunk_store(
+    chunks_file_path: Union[str, Path], chunks: List[Document], ids: List[str]
+) -> None:
+    """
+    Writes chunks to an uncompressed Arrow IPC file that ChunkStore can memory-map.
+
+    Parameters:
+        chunks_file_path (str): The file to write.
+        chunks (List[Document]): The chunks, in the order of their vectors in the index.
+        ids (List[str]): The docstore id of each chunk.
+    """
+    table = pa.table(
+        {
+            "id": [str(chunk_id) for chunk_id in ids],
+            "page_content": [chunk.page_content for chunk in chunks],
+            "metadata": [
+                json.dumps(chunk.metadata or {}, default=str) for chunk in chunks
+            ],
+        },
+        schema=CHUNKS_SCHEMA,
+    )
+
+    # write next to the target and rename, so running workers never map a half-written file
+    temporary_path = f"{chunks_file_path}.tmp"
+    with pa.OSFile(temporary_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(temporary_path, chunks_file_path)
+
+
+def convert_docstore(kb_folder_path: Union[str, Path]) -> str:
+    """
+    Writes the chunk store of an existing .kb folder from its pickled docstore (index.pkl),
+    so the folder can be loaded with memory mapping. Only use this on knowledge packs you trust,
+    as reading the pickle can execute code.
+
+    Returns:
+        str: The path of the written chunk store.
+    """
+    kb_folder = Path(kb_folder_path)
+    with open(kb_folder / "index.pkl", "rb") as file:
+        docstore, index_to_docstore_id = pickle.load(file)
+
+    rows = sorted(index_to_docstore_id.keys())
+    if rows != list(range(len(rows))):
+        raise ValueError(
+            f"Cannot convert {kb_folder_path}, its index rows are not numbered consecutively"
+        )
+    ids = [index_to_docstore_id[row] for row in rows]
+    chunks_file_path = kb_folder / CHUNKS_FILE_NAME
+    write_chunk_store(chunks_file_path, [docstore.search(id) for id in ids], ids)
+    return str(chunks_file_path)
+
+
+if __name__ == "__main__":
+    # python -m embeddings.chunk_store <path to .kb folder> [<path to .kb folder> ...]
+    for kb_folder_path in sys.argv[1:]:
+        print("Wrote", convert_docstore(kb_folder_path))
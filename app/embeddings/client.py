@@ -1,18 +1,30 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 import os
+import pickle
+from pathlib import Path
 
+import faiss
+import numpy as np
 from langchain_community.embeddings import BedrockEmbeddings, OllamaEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_openai import AzureOpenAIEmbeddings, OpenAIEmbeddings
+from embeddings.cache import CachedQueryEmbeddings, LRUCache
+from embeddings.chunk_store import (
+    CHUNKS_FILE_NAME,
+    INDEX_FILE_NAME,
+    VECTORS_FILE_NAME,
+    ChunkStore,
+)
 from embeddings.model import EmbeddingModel
 
 
 class EmbeddingsClient:
     CONST_INVALID_CONFIG_ERROR = "Invalid config for the given embedding model"
 
-    def __init__(self, embedding_model: EmbeddingModel):
+    def __init__(self, embedding_model: EmbeddingModel, query_cache: LRUCache = None):
         self.embedding_model: EmbeddingModel = embedding_model
         self.__embeddings_provider = None
+        self.__query_cache = query_cache
 
         if self.embedding_model.provider.lower() == "openai":
             self.__embeddings_provider = self._load_openai_embeddings()
@@ -28,6 +40,13 @@ class EmbeddingsClient:
         else:
             raise ValueError(f"Provider {self.embedding_model.provider} not supported")
 
+        if self.__query_cache is not None:
+            self.__embeddings_provider = CachedQueryEmbeddings(
+                self.__embeddings_provider,
+                self.__query_cache,
+                self.embedding_model.id,
+            )
+
     def _get_embeddings_provider(self):
         return self.__embeddings_provider
 
@@ -81,9 +100,77 @@ class EmbeddingsClient:
         if not self.embedding_model.config.get(key):
             raise ValueError(f"{key} config is not set for the given embedding model")
 
-    def generate_from_filesystem(self, kb_folder_path):
+    def embed_query(self, query: str):
+        return self.__embeddings_provider.embed_query(query)
+
+    def get_query_cache_stats(self) -> dict:
+        if self.__query_cache is None:
+            return {}
+        return self.__query_cache.stats()
+
+    def generate_from_filesystem(self, kb_folder_path, memory_map: bool = False):
+        kb_folder = Path(kb_folder_path)
+        if memory_map and (kb_folder / INDEX_FILE_NAME).exists():
+            return self._load_memory_mapped(kb_folder_path)
+
+        if (kb_folder / VECTORS_FILE_NAME).exists():
+            return self._load_chunk_store_folder(kb_folder_path)
+
+        if memory_map:
+            return self._load_memory_mapped(kb_folder_path)
+
         return FAISS.load_local(
             folder_path=kb_folder_path,
             embeddings=self.__embeddings_provider,
             allow_dangerous_deserialization=True,
         )
+
+    def _load_memory_mapped(self, kb_folder_path) -> FAISS:
+        # The index vectors and the chunk store stay on disk and are paged in on demand,
+        # so several worker processes share one copy in the OS page cache
+        kb_folder = Path(kb_folder_path)
+        index = faiss.read_index(
+            str(kb_folder / INDEX_FILE_NAME),
+            faiss.IO_FLAG_MMAP | faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY,
+        )
+
+        chunks_file_path = kb_folder / CHUNKS_FILE_NAME
+        if chunks_file_path.exists():
+            docstore = ChunkStore(chunks_file_path)
+            if index.ntotal != len(docstore):
+                raise ValueError(
+                    f"{kb_folder_path} holds {index.ntotal} vectors for {len(docstore)} chunks"
+                )
+            index_to_docstore_id = docstore.row_positions()
+        else:
+            # packs that were not converted yet still need their pickled docstore
+            with open(kb_folder / "index.pkl", "rb") as file:
+                docstore, index_to_docstore_id = pickle.load(file)
+
+        return FAISS(
+            embedding_function=self.__embeddings_provider,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+        )
+
+    def _load_chunk_store_folder(self, kb_folder_path) -> FAISS:
+        # Folders without an index.faiss hold a float32 vectors matrix and a chunk store in the same row order.
+        # Only the chunk store stays memory-mapped, the vectors are copied into an index held by this process
+        kb_folder = Path(kb_folder_path)
+        vectors = np.load(kb_folder / VECTORS_FILE_NAME, mmap_mode="r")
+        docstore = ChunkStore(kb_folder / CHUNKS_FILE_NAME)
+        if vectors.ndim != 2 or len(vectors) != len(docstore):
+            raise ValueError(
+                f"{kb_folder_path} holds {len(vectors)} vectors for {len(docstore)} chunks"
+            )
+
+        index = faiss.IndexFlatL2(vectors.shape[1])
+        index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+
+        return FAISS(
+            embedding_function=self.__embeddings_provider,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=docstore.row_positions(),
+        )
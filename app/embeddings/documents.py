@@ -1,6 +1,7 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import threading
 from langchain_community.vectorstores import FAISS
-from typing import List
+from typing import Iterable, List, Tuple
 from langchain_core.documents import Document
 
 
@@ -14,6 +15,7 @@ class KnowledgeDocument:
         sample_question: str,
         description: str,
         provider: str,
+        kb_path: str = None,
     ):
         self.key = key
         self.retriever = retriever
@@ -22,6 +24,7 @@ class KnowledgeDocument:
         self.sample_question = sample_question
         self.description = description
         self.provider = provider
+        self.kb_path = kb_path
 
     def get_source_title_link(self) -> str:
         document_metadata = vars(self)
@@ -34,15 +37,22 @@ class DocumentsUtils:
         documents: List[Document],
     ) -> List[dict[str, str]]:
         unique_sources = []
-        unique_keys = []
+        unique_keys = set()
         for doc in documents:
-            key = f"{doc.metadata.get('source', 'unkown source')}#{doc.metadata.get('page', '')}"
+            key = DocumentsUtils.get_source_key(doc.metadata)
             if key not in unique_keys:
-                unique_keys.append(key)
+                unique_keys.add(key)
                 unique_sources.append(doc)
 
         return unique_sources
 
+    @staticmethod
+    def get_source_key(document_metadata: dict) -> Tuple[str, str]:
+        return (
+            str(document_metadata.get("source", "unkown source")),
+            str(document_metadata.get("page", "")),
+        )
+
     @staticmethod
     def get_source_title_link(document_metadata: dict) -> str:
         page_anchor = (
@@ -120,3 +130,54 @@ class DocumentsUtils:
     @staticmethod
     def get_search_result_item(document_metadata: dict) -> str:
         return f"{DocumentsUtils.get_source_title_link(document_metadata)} {f'({DocumentsUtils.get_extra_metadata(document_metadata).strip()})' if DocumentsUtils.get_extra_metadata(document_metadata) else ''}"
+
+
+class SourceIndex:
+    """
+    The rendered search result item (source link and citation) of each (source, page) in the knowledge pack,
+    so listing the sources of the chunks returned by a search is one lookup per chunk.
+    Items are added when the knowledge pack is loaded, and rendered on first use for chunks that were not added up front.
+    """
+
+    def __init__(self):
+        self._search_result_items: dict[Tuple[str, str], str] = {}
+        self._lock = threading.Lock()
+
+    def add_all(self, documents: Iterable[Document]) -> None:
+        for document in documents:
+            self.get_search_result_item(document.metadata)
+
+    def get_search_result_item(self, document_metadata: dict) -> str:
+        key = DocumentsUtils.get_source_key(document_metadata)
+        search_result_item = self._search_result_items.get(key)
+        if search_result_item is None:
+            search_result_item = DocumentsUtils.get_search_result_item(
+                document_metadata
+            )
+            with self._lock:
+                search_result_item = self._search_result_items.setdefault(
+                    key, search_result_item
+                )
+        return search_result_item
+
+    def get_unique_search_result_items(self, documents: List[Document]) -> List[str]:
+        """
+        The search result items of the distinct sources of the given chunks, in the order of the chunks.
+        """
+        unique_keys = set()
+        search_result_items = []
+        for document in documents:
+            key = DocumentsUtils.get_source_key(document.metadata)
+            if key not in unique_keys:
+                unique_keys.add(key)
+                search_result_items.append(
+                    self.get_search_result_item(document.metadata)
+                )
+        return search_result_items
+
+    def size(self) -> int:
+        return len(self._search_result_items)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._search_result_items.clear()
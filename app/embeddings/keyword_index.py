@@ -0,0 +1,147 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Hashable, Iterable, List, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./:#][a-z0-9]+)*")
+TOKEN_PART_PATTERN = re.compile(r"[a-z0-9]+")
+IDENTIFIER_PATTERN = re.compile(
+    r"^(?:"
+    r"[A-Za-z0-9]*\d[A-Za-z0-9]*"  # contains a digit, e.g. RFC7231 or 1234
+    r"|[A-Za-z0-9]+(?:[-_./:#][A-Za-z0-9]+)+"  # joined parts, e.g. PAY-1234, auth_token, api/v2
+    r"|[a-z]+(?:[A-Z][a-z0-9]*)+"  # camelCase, e.g. getUserById
+    r"|(?:[A-Z][a-z0-9]+){2,}"  # PascalCase, e.g. PaymentGateway
+    r"|[A-Z]{2,}"  # acronyms, e.g. SLA
+    r")$"
+)
+
+
+class KeywordIndex:
+    """
+    In-process BM25 inverted index over the chunks of one knowledge document.
+    Identifiers like ticket ids and API names are kept as whole tokens as well as split into their parts,
+    so exact identifiers rank highest while partial matches are still found.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings: dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._chunk_lengths: np.ndarray = np.empty(0, dtype=np.float32)
+        self._average_chunk_length = 0.0
+
+    def build(self, texts: Iterable[str]) -> None:
+        rows_by_term = defaultdict(list)
+        frequencies_by_term = defaultdict(list)
+        chunk_lengths = []
+
+        for row, text in enumerate(texts):
+            term_frequencies = Counter(KeywordIndex.tokenize(text))
+            chunk_lengths.append(sum(term_frequencies.values()))
+            for term, frequency in term_frequencies.items():
+                rows_by_term[term].append(row)
+                frequencies_by_term[term].append(frequency)
+
+        self._postings = {
+            term: (
+                np.array(rows, dtype=np.int32),
+                np.array(frequencies_by_term[term], dtype=np.float32),
+            )
+            for term, rows in rows_by_term.items()
+        }
+        self._chunk_lengths = np.array(chunk_lengths, dtype=np.float32)
+        self._average_chunk_length = (
+            float(self._chunk_lengths.mean()) if chunk_lengths else 0.0
+        )
+
+    def size(self) -> int:
+        return len(self._chunk_lengths)
+
+    def search(self, query: str, k: int = 5) -> List[Tuple[int, float]]:
+        """
+        Ranks the chunks by their BM25 score for the query.
+
+        Returns:
+            List[Tuple[int, float]]: The rows of the best matching chunks and their scores, highest score first.
+        """
+        chunk_count = self.size()
+        if chunk_count == 0 or k <= 0 or self._average_chunk_length == 0:
+            return []
+
+        scores = np.zeros(chunk_count, dtype=np.float32)
+        length_norms = self.k1 * (
+            1 - self.b + self.b * self._chunk_lengths / self._average_chunk_length
+        )
+        for term in set(KeywordIndex.tokenize(query)):
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            rows, frequencies = posting
+            idf = math.log(1 + (chunk_count - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += (
+                idf * frequencies * (self.k1 + 1) / (frequencies + length_norms[rows])
+            )
+
+        matching_rows = np.flatnonzero(scores)
+        if len(matching_rows) > k:
+            matching_rows = matching_rows[
+                np.argpartition(-scores[matching_rows], k - 1)[:k]
+            ]
+        ranked_rows = matching_rows[np.argsort(-scores[matching_rows], kind="stable")]
+        return [(int(row), float(scores[row])) for row in ranked_rows]
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        tokens = []
+        for token in TOKEN_PATTERN.findall((text or "").lower()):
+            tokens.append(token)
+            parts = TOKEN_PART_PATTERN.findall(token)
+            if len(parts) > 1:
+                tokens.extend(parts)
+        return tokens
+
+    @staticmethod
+    def is_keyword_query(query: str, max_terms: int = 4) -> bool:
+        """
+        Whether the query only consists of a few identifiers, like "PAY-1234" or "getUserById",
+        that a keyword search answers better than a semantic one.
+        """
+        terms = [term.strip("\"'`?!,;()[]{}") for term in (query or "").split()]
+        terms = [term for term in terms if term]
+        return 0 < len(terms) <= max_terms and all(
+            IDENTIFIER_PATTERN.match(term) for term in terms
+        )
+
+
+def reciprocal_rank_fusion(
+    ranked_lists: List[List[Document]], k: int = 5, rank_constant: int = 60
+) -> List[Tuple[Document, float]]:
+    """
+    Merges several ranked result lists into one, scoring each chunk by the sum of 1 / (rank_constant + rank)
+    over the lists it appears in.
+
+    Returns:
+        List[Tuple[Document, float]]: The best k chunks with their fused scores, highest score first.
+    """
+    scores: dict[Hashable, float] = defaultdict(float)
+    documents: dict[Hashable, Document] = {}
+    for ranked_list in ranked_lists:
+        for rank, document in enumerate(ranked_list, start=1):
+            key = _document_identity(document)
+            scores[key] += 1.0 / (rank_constant + rank)
+            documents.setdefault(key, document)
+
+    ranked_keys = sorted(scores, key=lambda key: scores[key], reverse=True)[:k]
+    return [(documents[key], scores[key]) for key in ranked_keys]
+
+
+def _document_identity(document: Document) -> Hashable:
+    # the vector and the keyword search can return separate Document objects for the same chunk
+    return (
+        document.page_content,
+        tuple(sorted((key, str(value)) for key, value in document.metadata.items())),
+    )
@@ -0,0 +1,135 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+from langchain_community.vectorstores import FAISS
+
+from embeddings.chunk_store import ChunkStore
+from embeddings.documents import KnowledgeDocument
+from logger import HaivenLogger
+
+
+class RetrieverCache:
+    """
+    Loads the FAISS store of a knowledge document the first time it is searched, and keeps the
+    loaded stores within a memory budget by evicting the least recently used ones.
+
+    Attributes:
+        memory_budget_bytes (int): The estimated memory the loaded stores may use, 0 means no limit.
+    """
+
+    def __init__(
+        self,
+        load_retriever: Callable[[str], FAISS],
+        memory_budget_bytes: int = 0,
+    ):
+        self._load_retriever = load_retriever
+        self.memory_budget_bytes = memory_budget_bytes
+        self._loaded: OrderedDict[str, tuple[FAISS, int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading_locks: dict[str, threading.Lock] = {}
+
+    def get(self, document: KnowledgeDocument) -> FAISS:
+        retriever = self._get_loaded(document.key)
+        if retriever is not None:
+            return retriever
+
+        with self._loading_lock(document.key):
+            # another thread might have loaded it while we were waiting
+            retriever = self._get_loaded(document.key)
+            if retriever is not None:
+                return retriever
+
+            retriever = self._load_retriever(document.kb_path)
+            size_bytes = RetrieverCache.estimate_size_bytes(retriever)
+            with self._lock:
+                self._loaded[document.key] = (retriever, size_bytes)
+                evicted_keys = self._evict_over_budget(keep_key=document.key)
+                loaded_count = len(self._loaded)
+
+        HaivenLogger.get().info(
+            f"Loaded knowledge document {document.key} (~{size_bytes // 1024} KB), {loaded_count} documents loaded",
+            extra={
+                "INFO": "KnowledgeDocumentLoaded",
+                "document_key": document.key,
+                "size_bytes": size_bytes,
+                "loaded_bytes": self.loaded_bytes(),
+            },
+        )
+        for evicted_key in evicted_keys:
+            HaivenLogger.get().info(
+                f"Evicted knowledge document {evicted_key} to stay within the memory budget of {self.memory_budget_bytes // 1024} KB",
+                extra={
+                    "INFO": "KnowledgeDocumentEvicted",
+                    "document_key": evicted_key,
+                    "loaded_bytes": self.loaded_bytes(),
+                },
+            )
+
+        return retriever
+
+    def loaded_keys(self) -> list[str]:
+        with self._lock:
+            return list(self._loaded.keys())
+
+    def loaded_bytes(self) -> int:
+        with self._lock:
+            return sum(size_bytes for _, size_bytes in self._loaded.values())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._loaded.clear()
+            # documents being loaded right now keep their lock
+            self._loading_locks = {
+                key: loading_lock
+                for key, loading_lock in self._loading_locks.items()
+                if loading_lock.locked()
+            }
+
+    def _get_loaded(self, key: str) -> FAISS:
+        with self._lock:
+            entry = self._loaded.get(key)
+            if entry is None:
+                return None
+            self._loaded.move_to_end(key)
+            return entry[0]
+
+    def _loading_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._loading_locks.setdefault(key, threading.Lock())
+
+    def _evict_over_budget(self, keep_key: str) -> list[str]:
+        evicted_keys = []
+        if self.memory_budget_bytes <= 0:
+            return evicted_keys
+
+        total_bytes = sum(size_bytes for _, size_bytes in self._loaded.values())
+        for key in list(self._loaded.keys()):
+            if total_bytes <= self.memory_budget_bytes:
+                break
+            if key == keep_key:
+                continue
+            _, size_bytes = self._loaded.pop(key)
+            # the lock of a document lives as long as its entry, so it is never loaded twice at a time
+            loading_lock = self._loading_locks.get(key)
+            if loading_lock is not None and not loading_lock.locked():
+                del self._loading_locks[key]
+            total_bytes -= size_bytes
+            evicted_keys.append(key)
+
+        return evicted_keys
+
+    @staticmethod
+    def estimate_size_bytes(retriever: FAISS) -> int:
+        # Rough estimate: float32 vectors plus the chunks held in the docstore
+        vectors_bytes = retriever.index.ntotal * retriever.index.d * 4
+        if isinstance(retriever.docstore, ChunkStore):
+            return vectors_bytes + retriever.docstore.size_bytes()
+
+        # InMemoryDocstore, of pickled knowledge documents, only exposes its dictionary
+        docstore_entries = getattr(retriever.docstore, "_dict", {})
+        text_bytes = sum(
+            len(document.page_content) for document in docstore_entries.values()
+        )
+        return vectors_bytes + text_bytes
@@ -0,0 +1,143 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from typing import List, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.documents import Document
+
+from embeddings.client import EmbeddingsClient
+
+
+class UnifiedEmbeddingsIndex:
+    """
+    Merges the vectors of several knowledge documents into one FAISS index, with a document key column
+    next to every vector. A search embeds the query once and runs one index search, optionally restricted
+    to a subset of document keys.
+    """
+
+    def __init__(self, embeddings_client: EmbeddingsClient):
+        self._embeddings_client = embeddings_client
+        self._index = None
+        self._document_keys: List[str] = []
+        self._row_document_ids: np.ndarray = np.empty(0, dtype=np.int32)
+        self._chunks: List[Document] = []
+
+    def build(self, retrievers: dict[str, FAISS]) -> None:
+        """
+        Builds the merged index from the FAISS stores of all documents.
+
+        Parameters:
+            retrievers (dict[str, FAISS]): The FAISS store of each document, by document key.
+
+        Raises:
+            ValueError: If the stores cannot be merged, e.g. because of different dimensions or distance strategies.
+        """
+        vectors = []
+        row_document_ids = []
+        chunks = []
+        dimension = None
+
+        for document_key, retriever in retrievers.items():
+            self._validate_retriever(document_key, retriever)
+            if dimension is not None and retriever.index.d != dimension:
+                raise ValueError(
+                    f"Cannot merge document {document_key} into the unified index, its vector dimension {retriever.index.d} differs from {dimension}"
+                )
+            dimension = retriever.index.d
+
+            document_id = len(self._document_keys)
+            self._document_keys.append(document_key)
+
+            size = retriever.index.ntotal
+            if size == 0:
+                continue
+
+            vectors.append(retriever.index.reconstruct_n(0, size))
+            row_document_ids.append(np.full(size, document_id, dtype=np.int32))
+            chunks.extend(
+                retriever.docstore.search(retriever.index_to_docstore_id[row])
+                for row in range(size)
+            )
+
+        self._index = faiss.IndexFlatL2(dimension or 1)
+        if vectors:
+            self._index.add(np.vstack(vectors).astype(np.float32))
+            self._row_document_ids = np.concatenate(row_document_ids)
+        self._chunks = chunks
+
+    def size(self) -> int:
+        return len(self._chunks)
+
+    def get_document_keys(self) -> List[str]:
+        return list(self._document_keys)
+
+    def similarity_search_with_scores(
+        self,
+        query: str,
+        document_keys: List[str] = None,
+        k: int = 5,
+        score_threshold: float = None,
+    ) -> List[Tuple[Document, float]]:
+        """
+        Searches the merged index with a single query embedding.
+
+        Parameters:
+            query (str): The search query.
+            document_keys (List[str], optional): Only return chunks of these documents. Defaults to all documents.
+            k (int, optional): The number of results to return. Defaults to 5.
+            score_threshold (float, optional): The maximum distance for a chunk to be included. Defaults to None.
+
+        Returns:
+            List[Tuple[Document, float]]: The closest chunks and their distances, sorted by distance.
+        """
+        if self._index is None or self.size() == 0:
+            return []
+
+        search_parameters = None
+        if document_keys is not None:
+            selected_rows = self._rows_for_documents(document_keys)
+            if len(selected_rows) == 0:
+                return []
+            search_parameters = faiss.SearchParameters(
+                sel=faiss.IDSelectorBatch(selected_rows)
+            )
+
+        embedding = np.array(
+            [self._embeddings_client.embed_query(query)], dtype=np.float32
+        )
+        distances, rows = self._index.search(
+            embedding, min(k, self.size()), params=search_parameters
+        )
+
+        results = []
+        for distance, row in zip(distances[0], rows[0]):
+            if row == -1:
+                continue
+            if score_threshold is not None and distance > score_threshold:
+                continue
+            results.append((self._chunks[row], float(distance)))
+
+        return results
+
+    def _rows_for_documents(self, document_keys: List[str]) -> np.ndarray:
+        document_ids = [
+            document_id
+            for document_id, document_key in enumerate(self._document_keys)
+            if document_key in document_keys
+        ]
+        return np.flatnonzero(np.isin(self._row_document_ids, document_ids)).astype(
+            np.int64
+        )
+
+    @staticmethod
+    def _validate_retriever(document_key: str, retriever: FAISS) -> None:
+        if retriever.distance_strategy != DistanceStrategy.EUCLIDEAN_DISTANCE:
+            raise ValueError(
+                f"Cannot merge document {document_key} into the unified index, only euclidean distance is supported"
+            )
+        if retriever._normalize_L2:
+            raise ValueError(
+                f"Cannot merge document {document_key} into the unified index, normalized vectors are not supported"
+            )
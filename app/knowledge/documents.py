@@ -1,15 +1,24 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import heapq
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple
+from typing import Callable, Iterator, List, Tuple
 
 import frontmatter
 from langchain_core.documents import Document
 from langchain_community.vectorstores import FAISS
+from embeddings.cache import LRUCache
 from embeddings.client import EmbeddingsClient
-from embeddings.documents import KnowledgeDocument
+from embeddings.documents import KnowledgeDocument, SourceIndex
+from embeddings.keyword_index import KeywordIndex, reciprocal_rank_fusion
+from embeddings.unified_index import UnifiedEmbeddingsIndex
 from config_service import ConfigService
 from embeddings.in_memory import InMemoryEmbeddingsDB
+from embeddings.retriever_cache import RetrieverCache
+from knowledge.search_config import KnowledgeSearchConfig
+from logger import HaivenLogger
 
 
 class KnowledgeBaseDocuments:
@@ -21,14 +30,24 @@ class KnowledgeBaseDocuments:
     Attributes:
         _embeddings_stores (dict[str, InMemoryEmbeddingsDB]): The in-memory database for storing embeddings.
         _embeddings_provider (Embeddings): The provider used for generating embeddings.
+        _search_config (KnowledgeSearchConfig): The settings for how searches run over the documents.
+        _unified_index (UnifiedEmbeddingsIndex): The merged index of all documents, only built in "unified" search mode.
+        _search_executor (ThreadPoolExecutor): The bounded pool that searches documents in parallel, only used in "concurrent" search mode.
+        _retriever_cache (RetrieverCache): Loads FAISS stores on first use and evicts them under the memory budget, only used with lazy loading.
+        _retrieval_cache (LRUCache): Search results by query, sorted document keys, k and score threshold, cleared when the pack is reloaded.
+        _source_index (SourceIndex): The rendered source link and citation of each (source, page) in the pack.
+        _keyword_indexes (dict[str, KeywordIndex]): The BM25 index of each document, only used in "keyword" and "hybrid" retrieval modes.
     """
 
+    RETRIEVAL_CACHE_STATS_LOG_INTERVAL = 100
+
     _document_stores: InMemoryEmbeddingsDB = None
 
     def __init__(
         self,
         config_service: ConfigService,
         embeddings_provider: EmbeddingsClient = None,
+        search_config: KnowledgeSearchConfig = None,
     ):
         if embeddings_provider is None:
             embedding_model = config_service.load_embedding_model()
@@ -36,6 +55,31 @@ class KnowledgeBaseDocuments:
         else:
             self._embeddings_provider = embeddings_provider
 
+        self._search_config = search_config or KnowledgeSearchConfig()
+        self._unified_index: UnifiedEmbeddingsIndex = None
+        self._search_executor: ThreadPoolExecutor = None
+        if self._search_config.search_mode == KnowledgeSearchConfig.CONCURRENT:
+            self._search_executor = ThreadPoolExecutor(
+                max_workers=self._search_config.max_search_workers,
+                thread_name_prefix="knowledge-search",
+            )
+
+        self._retriever_cache: RetrieverCache = None
+        if self._search_config.lazy_loading:
+            self._retriever_cache = RetrieverCache(
+                self._get_retriever_from_file,
+                self._search_config.loaded_documents_memory_budget_mb * 1024 * 1024,
+            )
+
+        self._retrieval_cache = LRUCache(
+            max_size=self._search_config.retrieval_cache_size,
+            ttl_seconds=self._search_config.retrieval_cache_ttl_seconds,
+        )
+
+        self._keyword_indexes: dict[str, KeywordIndex] = {}
+        self._keyword_indexes_lock = threading.Lock()
+        self._source_index = SourceIndex()
+
         if self._document_stores is None:
             self._document_stores = InMemoryEmbeddingsDB()
 
@@ -46,8 +90,32 @@ class KnowledgeBaseDocuments:
         Parameters:
             knowledge_pack_path (str): The file system path to the directory containing the knowledge pack documents.
         """
+        if self._retriever_cache is not None:
+            self._retriever_cache.clear()
+        self._clear_retrieval_cache()
+        with self._keyword_indexes_lock:
+            self._keyword_indexes.clear()
+        self._source_index.clear()
+
         self._load_documents(path=knowledge_pack_path)
 
+        # with lazy loading, sources are rendered when their chunks are first returned instead
+        if not self._search_config.lazy_loading:
+            for document in self._document_stores.get_documents():
+                self._source_index.add_all(
+                    KnowledgeBaseDocuments._document_chunks(document.retriever)
+                )
+
+        if self._search_config.search_mode == KnowledgeSearchConfig.UNIFIED:
+            self._build_unified_index()
+
+        if (
+            self._search_config.retrieval_mode != KnowledgeSearchConfig.VECTOR
+            and not self._search_config.lazy_loading
+        ):
+            for document in self._document_stores.get_documents():
+                self._get_keyword_index(document)
+
     def get_documents(self) -> List[KnowledgeDocument]:
         """
         Retrieves all stored document embeddings. This method provides access to the complete set of embeddings currently managed by the service.
@@ -58,10 +126,192 @@ class KnowledgeBaseDocuments:
 
         return self._document_stores.get_documents()
 
+    def get_search_result_items(self, documents: List[Document]) -> List[str]:
+        """
+        Returns the source link and citation markdown of the distinct sources of the given chunks, in the order of the chunks.
+
+        Parameters:
+            documents (List[Document]): Chunks returned by a search.
+
+        Returns:
+            List[str]: One search result item per distinct (source, page).
+        """
+        return self._source_index.get_unique_search_result_items(documents)
+
+    def get_query_embedding_cache_stats(self) -> dict:
+        """
+        Returns the hit and miss counters of the query embeddings cache, empty if there is no cache.
+        """
+        return self._embeddings_provider.get_query_cache_stats()
+
+    def get_retrieval_cache_stats(self) -> dict:
+        """
+        Returns the hit and miss counters of the search results cache.
+        """
+        return self._retrieval_cache.stats()
+
+    def _clear_retrieval_cache(self) -> None:
+        if self._retrieval_cache.hits + self._retrieval_cache.misses > 0:
+            self._log_retrieval_cache_stats("Clearing knowledge retrieval cache")
+        self._retrieval_cache.clear()
+
+    def _cached_search(
+        self,
+        query: str,
+        document_keys: List[str],
+        k: int,
+        score_threshold: float,
+        search: Callable[[], List[Tuple[Document, float]]],
+    ) -> List[Tuple[Document, float]]:
+        if self._retrieval_cache.max_size <= 0:
+            return search()
+
+        cache_key = (
+            query,
+            None if document_keys is None else tuple(sorted(document_keys)),
+            k,
+            score_threshold,
+        )
+        documents_with_scores = self._retrieval_cache.get(cache_key)
+        if documents_with_scores is None:
+            documents_with_scores = search()
+            self._retrieval_cache.put(cache_key, documents_with_scores)
+
+        stats = self._retrieval_cache.stats()
+        if (
+            stats["hits"] + stats["misses"]
+        ) % self.RETRIEVAL_CACHE_STATS_LOG_INTERVAL == 0:
+            self._log_retrieval_cache_stats("Knowledge retrieval cache")
+
+        # callers get their own list, so they cannot change what is cached
+        return list(documents_with_scores)
+
+    def _log_retrieval_cache_stats(self, message: str) -> None:
+        stats = self._retrieval_cache.stats()
+        HaivenLogger.get().info(
+            f"{message}: {stats['hits']} hits, {stats['misses']} misses, hit rate {stats['hit_rate']}, {stats['size']} entries",
+            extra={"INFO": "KnowledgeRetrievalCacheStats", **stats},
+        )
+
+        query_embedding_stats = self.get_query_embedding_cache_stats()
+        if query_embedding_stats:
+            HaivenLogger.get().info(
+                f"Query embeddings cache: {query_embedding_stats['hits']} hits, {query_embedding_stats['misses']} misses, hit rate {query_embedding_stats['hit_rate']}, {query_embedding_stats['size']} entries",
+                extra={"INFO": "QueryEmbeddingCacheStats", **query_embedding_stats},
+            )
+
+    def _retrieve_with_scores(
+        self,
+        query: str,
+        document_keys: List[str],
+        k: int,
+        vector_search: Callable[[], List[Tuple[Document, float]]],
+    ) -> List[Tuple[Document, float]]:
+        retrieval_mode = self._search_config.retrieval_mode
+        if retrieval_mode == KnowledgeSearchConfig.VECTOR:
+            return vector_search()
+
+        keyword_results = self._keyword_search_with_scores(query, document_keys, k)
+        if retrieval_mode == KnowledgeSearchConfig.KEYWORD:
+            return keyword_results
+
+        # identifiers like ticket ids are found by the keyword search alone, no need to embed the query
+        if keyword_results and KeywordIndex.is_keyword_query(query):
+            return keyword_results
+
+        vector_results = vector_search()
+        return reciprocal_rank_fusion(
+            [
+                [document for document, _ in vector_results],
+                [document for document, _ in keyword_results],
+            ],
+            k=k,
+            rank_constant=self._search_config.rrf_rank_constant,
+        )
+
+    def _keyword_search_with_scores(
+        self, query: str, document_keys: List[str], k: int
+    ) -> List[Tuple[Document, float]]:
+        documents_with_scores = []
+        for document_key in document_keys:
+            document = self._document_stores.get_document(document_key)
+            if document is None:
+                continue
+
+            matches = self._get_keyword_index(document).search(query, k)
+            if not matches:
+                continue
+
+            retriever = self._get_document_retriever(document)
+            documents_with_scores.extend(
+                (retriever.docstore.search(retriever.index_to_docstore_id[row]), score)
+                for row, score in matches
+            )
+
+        return heapq.nlargest(k, documents_with_scores, key=lambda x: x[1])
+
+    def _get_keyword_index(self, document: KnowledgeDocument) -> KeywordIndex:
+        with self._keyword_indexes_lock:
+            keyword_index = self._keyword_indexes.get(document.key)
+        if keyword_index is not None:
+            return keyword_index
+
+        retriever = self._get_document_retriever(document)
+        keyword_index = KeywordIndex()
+        keyword_index.build(
+            chunk.page_content
+            for chunk in KnowledgeBaseDocuments._document_chunks(retriever)
+        )
+        with self._keyword_indexes_lock:
+            keyword_index = self._keyword_indexes.setdefault(
+                document.key, keyword_index
+            )
+
+        HaivenLogger.get().info(
+            f"Built keyword index for knowledge document {document.key} with {keyword_index.size()} chunks",
+            extra={"INFO": "KnowledgeKeywordIndexBuilt", "document_key": document.key},
+        )
+        return keyword_index
+
+    @staticmethod
+    def _document_chunks(retriever: FAISS) -> Iterator[Document]:
+        for row in range(retriever.index.ntotal):
+            yield retriever.docstore.search(retriever.index_to_docstore_id[row])
+
+    def _build_unified_index(self) -> None:
+        unified_index = UnifiedEmbeddingsIndex(self._embeddings_provider)
+        try:
+            unified_index.build(
+                {
+                    document.key: self._get_document_retriever(document)
+                    for document in self._document_stores.get_documents()
+                }
+            )
+        except ValueError as error:
+            self._unified_index = None
+            HaivenLogger.get().error(
+                f"{error}, falling back to searching documents one by one",
+                extra={"ERROR": "UnifiedKnowledgeIndexNotBuilt"},
+            )
+            return
+
+        self._unified_index = unified_index
+        HaivenLogger.get().info(
+            f"Built unified knowledge index with {unified_index.size()} chunks from {len(unified_index.get_document_keys())} documents",
+            extra={"INFO": "UnifiedKnowledgeIndexBuilt"},
+        )
+
+    def _get_document_retriever(self, document: KnowledgeDocument) -> FAISS:
+        if self._retriever_cache is not None:
+            return self._retriever_cache.get(document)
+        return document.retriever
+
     def _get_retriever_from_file(self, kb_path: str) -> FAISS:
         path = Path(kb_path)
 
-        faiss = self._embeddings_provider.generate_from_filesystem(path)
+        faiss = self._embeddings_provider.generate_from_filesystem(
+            path, memory_map=self._search_config.memory_map
+        )
 
         return faiss
 
@@ -99,7 +349,10 @@ class KnowledgeBaseDocuments:
                 sample_question=document.metadata.get("sample_question", ""),
                 description=document.metadata.get("description", ""),
                 provider=document.metadata.get("provider", ""),
-                retriever=self._get_retriever_from_file(kb_full_path),
+                retriever=None
+                if self._search_config.lazy_loading
+                else self._get_retriever_from_file(kb_full_path),
+                kb_path=kb_full_path,
             )
 
             self._document_stores.add_embedding(
@@ -119,7 +372,36 @@ class KnowledgeBaseDocuments:
 
         Returns:
             List[Tuple[Document, float]]: A list of tuples, each containing a Document and its similarity score.
+                In "keyword" and "hybrid" retrieval modes the scores are BM25 or fused scores, where higher is better.
         """
+        return self._cached_search(
+            query,
+            None,
+            k,
+            score_threshold,
+            lambda: self._retrieve_with_scores(
+                query,
+                self._document_stores.get_keys(),
+                k,
+                lambda: self._similarity_search_on_all_documents_with_scores(
+                    query, k, score_threshold
+                ),
+            ),
+        )
+
+    def _similarity_search_on_all_documents_with_scores(
+        self, query: str, k: int, score_threshold: float
+    ) -> List[Tuple[Document, float]]:
+        if self._unified_index is not None:
+            return self._unified_index.similarity_search_with_scores(
+                query, k=k, score_threshold=score_threshold
+            )
+
+        if self._search_executor is not None:
+            return self._concurrent_similarity_search_with_scores(
+                query, self._document_stores.get_keys(), k, score_threshold
+            )
+
         similar_documents = []
 
         for embedding_key in self._document_stores.get_keys():
@@ -146,11 +428,58 @@ class KnowledgeBaseDocuments:
         if embedding is None:
             return []
 
-        similar_documents = embedding.retriever.similarity_search_with_score(
+        similar_documents = self._get_document_retriever(
+            embedding
+        ).similarity_search_with_score(
             query=query, k=k, score_threshold=score_threshold
         )
         return similar_documents
 
+    def _concurrent_similarity_search_with_scores(
+        self,
+        query: str,
+        document_keys: List[str],
+        k: int = 5,
+        score_threshold: float = None,
+    ) -> List[Tuple[Document, float]]:
+        # Embed once up front, so the parallel searches don't all ask the provider for the same query embedding
+        query_embedding = self._embeddings_provider.embed_query(query)
+
+        futures = [
+            self._search_executor.submit(
+                self._similarity_search_on_single_document_by_vector,
+                query_embedding,
+                document_key,
+                k,
+                score_threshold,
+            )
+            for document_key in document_keys
+        ]
+
+        documents_with_scores = []
+        for future in futures:
+            documents_with_scores.extend(future.result())
+
+        return heapq.nsmallest(k, documents_with_scores, key=lambda x: x[1])
+
+    def _similarity_search_on_single_document_by_vector(
+        self,
+        query_embedding: List[float],
+        document_key: str,
+        k: int = 5,
+        score_threshold: float = None,
+    ) -> List[Tuple[Document, float]]:
+        embedding = self._document_stores.get_document(document_key)
+
+        if embedding is None:
+            return []
+
+        return self._get_document_retriever(
+            embedding
+        ).similarity_search_with_score_by_vector(
+            embedding=query_embedding, k=k, score_threshold=score_threshold
+        )
+
     def similarity_search_on_multiple_documents(
         self,
         query: str,
@@ -164,12 +493,49 @@ class KnowledgeBaseDocuments:
         Parameters:
             query (str): The search query.
             document_keys List(str): The list of document keys to search within.
-            k (int, optional): The number of results to return. Defaults to 5.
+            k (int, optional): The number of results to return per document in "sequential" search mode, or in total in the other search and retrieval modes. Defaults to 5.
             score_threshold (float, optional): The minimum similarity score for a document to be included in the results. Defaults to None.
 
         Returns:
             List[Document]: A list of documents that are similar to the query.
         """
+        documents_with_scores = self._cached_search(
+            query,
+            document_keys,
+            k,
+            score_threshold,
+            lambda: self._retrieve_with_scores(
+                query,
+                document_keys,
+                k,
+                lambda: self._similarity_search_on_multiple_documents_with_scores(
+                    query, document_keys, k, score_threshold
+                ),
+            ),
+        )
+
+        documents = [doc for doc, _ in documents_with_scores]
+        return documents
+
+    def _similarity_search_on_multiple_documents_with_scores(
+        self,
+        query: str,
+        document_keys: List[str],
+        k: int,
+        score_threshold: float,
+    ) -> List[Tuple[Document, float]]:
+        if self._unified_index is not None:
+            return self._unified_index.similarity_search_with_scores(
+                query,
+                document_keys=document_keys,
+                k=k,
+                score_threshold=score_threshold,
+            )
+
+        if self._search_executor is not None:
+            return self._concurrent_similarity_search_with_scores(
+                query, document_keys, k, score_threshold
+            )
 
         documents_with_scores = []
         for document_key in document_keys:
@@ -178,6 +544,4 @@ class KnowledgeBaseDocuments:
                     query, document_key, k, score_threshold
                 )
             )
-
-        documents = [doc for doc, _ in documents_with_scores]
-        return documents
+        return documents_with_scores
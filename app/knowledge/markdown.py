@@ -63,12 +63,14 @@ class KnowledgeBaseMarkdown:
         self, contexts: List[str], user_context: str = None
     ) -> str:
         """
-        Return all required contexts' contents appended as one string
+        Return all required contexts' contents appended as one string, in the same order
+        for the same selection, so the prompt prefix they are part of can be cached by providers
         """
         knowledgePackContextsAggregated = None
         if contexts:
             knowledgePackContextsAggregated = "\n\n".join(
-                self._knowledge[context_key].content for context_key in contexts
+                self._knowledge[context_key].content
+                for context_key in sorted(set(contexts))
             )
 
         return "\n\n".join(
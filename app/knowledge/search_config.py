@@ -0,0 +1,107 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from config_values import to_bool, to_int
+
+
+class KnowledgeSearchConfig:
+    """
+    Settings for how similarity searches run over the knowledge pack documents.
+
+    Attributes:
+        search_mode (str): "sequential" searches every document's FAISS store one after the other,
+            "concurrent" searches the documents in parallel on a thread pool and merges the results into one top k,
+            "unified" merges all document vectors into a single index when the knowledge pack is loaded.
+        retrieval_mode (str): "vector" only runs the embeddings search, "keyword" only a BM25 keyword search,
+            "hybrid" runs both and merges them with reciprocal rank fusion. In "hybrid" mode, queries that only
+            consist of identifiers like ticket ids or API names are answered by the keyword search alone, without an embeddings call.
+        rrf_rank_constant (int): The rank constant of the reciprocal rank fusion in "hybrid" retrieval mode.
+        max_search_workers (int): How many documents are searched at the same time in "concurrent" search mode.
+        lazy_loading (bool): Only read the document metadata at startup, and load a document's FAISS store when it is first searched.
+            Cannot be combined with "unified" search mode, which loads every document to build its index.
+        loaded_documents_memory_budget_mb (int): With lazy loading, evict the least recently used FAISS stores when
+            the loaded ones are estimated to use more than this, 0 means no limit.
+        memory_map (bool): Memory-map the FAISS indexes and chunk stores of the documents instead of reading them
+            into each worker process' heap, so workers on the same host share them through the page cache.
+        retrieval_cache_size (int): How many search results to keep cached by query, document keys, k and score threshold,
+            0 switches the cache off. The cache is cleared when the knowledge pack is reloaded.
+        retrieval_cache_ttl_seconds (int): How long cached search results stay valid.
+        query_embedding_cache_size (int): How many query embeddings to keep cached, 0 switches the cache off.
+        query_embedding_cache_ttl_seconds (int): How long a cached query embedding stays valid.
+    """
+
+    SEQUENTIAL = "sequential"
+    CONCURRENT = "concurrent"
+    UNIFIED = "unified"
+
+    SEARCH_MODES = [SEQUENTIAL, CONCURRENT, UNIFIED]
+
+    VECTOR = "vector"
+    KEYWORD = "keyword"
+    HYBRID = "hybrid"
+
+    RETRIEVAL_MODES = [VECTOR, KEYWORD, HYBRID]
+
+    def __init__(
+        self,
+        search_mode: str = SEQUENTIAL,
+        query_embedding_cache_size: int = 1024,
+        query_embedding_cache_ttl_seconds: int = 3600,
+        max_search_workers: int = 4,
+        lazy_loading: bool = False,
+        loaded_documents_memory_budget_mb: int = 0,
+        memory_map: bool = False,
+        retrieval_cache_size: int = 256,
+        retrieval_cache_ttl_seconds: int = 3600,
+        retrieval_mode: str = VECTOR,
+        rrf_rank_constant: int = 60,
+    ):
+        search_mode = (search_mode or KnowledgeSearchConfig.SEQUENTIAL).lower()
+        if search_mode not in KnowledgeSearchConfig.SEARCH_MODES:
+            raise ValueError(
+                f"Knowledge search mode {search_mode} not supported, use one of {', '.join(KnowledgeSearchConfig.SEARCH_MODES)}"
+            )
+        self.search_mode = search_mode
+        if lazy_loading and search_mode == KnowledgeSearchConfig.UNIFIED:
+            raise ValueError(
+                "Knowledge search mode unified loads every document to build its index, it cannot be combined with lazy loading"
+            )
+
+        retrieval_mode = (retrieval_mode or KnowledgeSearchConfig.VECTOR).lower()
+        if retrieval_mode not in KnowledgeSearchConfig.RETRIEVAL_MODES:
+            raise ValueError(
+                f"Knowledge retrieval mode {retrieval_mode} not supported, use one of {', '.join(KnowledgeSearchConfig.RETRIEVAL_MODES)}"
+            )
+        self.retrieval_mode = retrieval_mode
+        self.rrf_rank_constant = rrf_rank_constant
+        self.query_embedding_cache_size = query_embedding_cache_size
+        self.query_embedding_cache_ttl_seconds = query_embedding_cache_ttl_seconds
+        self.max_search_workers = max_search_workers
+        self.lazy_loading = lazy_loading
+        self.loaded_documents_memory_budget_mb = loaded_documents_memory_budget_mb
+        self.memory_map = memory_map
+        self.retrieval_cache_size = retrieval_cache_size
+        self.retrieval_cache_ttl_seconds = retrieval_cache_ttl_seconds
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        return cls(
+            search_mode=data.get("mode"),
+            query_embedding_cache_size=to_int(
+                data.get("query_embedding_cache_size"), 1024
+            ),
+            query_embedding_cache_ttl_seconds=to_int(
+                data.get("query_embedding_cache_ttl_seconds"), 3600
+            ),
+            max_search_workers=to_int(data.get("max_search_workers"), 4),
+            lazy_loading=to_bool(data.get("lazy_loading"), False),
+            loaded_documents_memory_budget_mb=to_int(
+                data.get("loaded_documents_memory_budget_mb"), 0
+            ),
+            memory_map=to_bool(data.get("memory_map"), False),
+            retrieval_cache_size=to_int(data.get("retrieval_cache_size"), 256),
+            retrieval_cache_ttl_seconds=to_int(
+                data.get("retrieval_cache_ttl_seconds"), 3600
+            ),
+            retrieval_mode=data.get("retrieval_mode"),
+            rrf_rank_constant=to_int(data.get("rrf_rank_constant"), 60),
+        )
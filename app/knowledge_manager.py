@@ -5,6 +5,7 @@ from config_service import ConfigService
 from logger import HaivenLogger
 from config.constants import SYSTEM_MESSAGE
 
+from embeddings.cache import LRUCache
 from embeddings.client import EmbeddingsClient
 from knowledge.markdown import KnowledgeBaseMarkdown
 from knowledge.pack import (
@@ -30,10 +31,19 @@ class KnowledgeManager:
 
     def _load_base_documents_knowledge(self):
         embedding_model = self._config_service.load_embedding_model()
+        search_config = self._config_service.load_knowledge_search_config()
         base_embeddings_path = self.knowledge_pack_definition.path + "/embeddings"
 
+        # One query embeddings cache for the whole process, shared by all chat sessions
+        query_cache = LRUCache(
+            max_size=search_config.query_embedding_cache_size,
+            ttl_seconds=search_config.query_embedding_cache_ttl_seconds,
+        )
+
         knowledge_base_documents = KnowledgeBaseDocuments(
-            self._config_service, EmbeddingsClient(embedding_model)
+            self._config_service,
+            EmbeddingsClient(embedding_model, query_cache),
+            search_config,
         )
 
         try:
@@ -1,7 +1,8 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
-from typing import List, Optional, Dict, Any
+from typing import Callable, List, Optional, Dict, Any
 from pydantic import BaseModel, Field
 from enum import Enum
+from json.encoder import encode_basestring_ascii
 import json
 
 
@@ -14,10 +15,12 @@ class EventType(str, Enum):
     ERROR = "error"
 
 
-class ChatEvent(BaseModel):
+class ChatEvent:
     """Base class for all chat events"""
 
-    event_type: EventType = Field(..., description="Type of the event")
+    __slots__ = ()
+
+    event_type: EventType
 
     def to_sse_format(self) -> str:
         """Convert event to Server-Sent Events format"""
@@ -25,19 +28,30 @@ class ChatEvent(BaseModel):
 
 
 class ContentEvent(ChatEvent):
-    """Event for streaming content chunks"""
+    """
+    Event for streaming content chunks. One is created for every chunk the model streams, so it is
+    a plain class with __slots__ instead of a Pydantic model like the other, rarer events.
+    """
 
-    event_type: EventType = Field(
-        default=EventType.CONTENT, description="Content event type"
-    )
-    content: str = Field(..., description="The content chunk to stream")
+    __slots__ = ("content",)
+
+    event_type = EventType.CONTENT
+
+    def __init__(self, content: str):
+        self.content = content
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ContentEvent) and other.content == self.content
+
+    def __repr__(self) -> str:
+        return f"ContentEvent(content={self.content!r})"
 
     def to_sse_format(self) -> str:
         """Convert to SSE format for streaming"""
         return f"data: {self.content}\n\n"
 
 
-class MetadataEvent(ChatEvent):
+class MetadataEvent(BaseModel, ChatEvent):
     """Event for metadata with citations and other information"""
 
     event_type: EventType = Field(
@@ -55,7 +69,7 @@ class MetadataEvent(ChatEvent):
         return f"data: {self.model_dump_json()}\n\n"
 
 
-class TokenUsageEvent(ChatEvent):
+class TokenUsageEvent(BaseModel, ChatEvent):
     """Event for token usage information"""
 
     event_type: EventType = Field(
@@ -65,13 +79,27 @@ class TokenUsageEvent(ChatEvent):
     completion_tokens: int = Field(..., description="Number of completion tokens used")
     total_tokens: int = Field(..., description="Total number of tokens used")
     model: str = Field(..., description="Model name used")
+    cached: bool = Field(
+        default=False,
+        description="Whether the response was replayed from the completion cache, without using tokens",
+    )
+    cached_tokens: int = Field(
+        default=0, description="Prompt tokens the provider read from its prompt cache"
+    )
+    cache_creation_tokens: int = Field(
+        default=0, description="Prompt tokens the provider wrote to its prompt cache"
+    )
+    estimated_prompt_tokens: Optional[int] = Field(
+        default=None,
+        description="Prompt tokens counted locally before the request was sent",
+    )
 
     def to_sse_format(self) -> str:
         """Convert to SSE format for streaming"""
         return f"event: token_usage\ndata: {self.model_dump_json()}\n\n"
 
 
-class ErrorEvent(ChatEvent):
+class ErrorEvent(BaseModel, ChatEvent):
     """Event for error messages"""
 
     event_type: EventType = Field(
@@ -84,51 +112,77 @@ class ErrorEvent(ChatEvent):
         return f"data: [ERROR]: {self.error_message}\n\n"
 
 
+def _json_content(event: ContentEvent) -> str:
+    content = event.content
+    # Check if content is already formatted as JSON
+    if content.startswith('{"data":') and content.endswith("}"):
+        # Content is already formatted, return as-is (preserve original formatting)
+        return content + "\n\n"
+    # Content is plain text, wrap in data format with proper JSON escaping.
+    # Same output as json.dumps({"data": content}), without building a dict per chunk
+    return '{"data": ' + encode_basestring_ascii(content) + "}\n\n"
+
+
+def _json_metadata(event: "MetadataEvent") -> str:
+    # Metadata as JSON string for JSON chat (matching test expectations)
+    metadata_dict = {"metadata": {"citations": event.citations or []}}
+    if event.metadata:
+        metadata_dict["metadata"].update(event.metadata)
+    return f"{json.dumps(metadata_dict)}\n\n"
+
+
+def _json_error(event: "ErrorEvent") -> str:
+    # Error in JSON format for JSON chat
+    error_response = {"data": f"[ERROR]: {event.error_message}"}
+    return f"data: {error_response}\n\n"
+
+
 class ChatEventFormatter:
     """Utility class to format chat events consistently"""
 
+    # looked up by the exact event type, which is cheaper than a chain of isinstance checks per chunk
+    _STREAMING_FORMATTERS: Dict[type, Callable[[ChatEvent], str]] = {
+        ContentEvent: lambda event: event.content,
+        # For streaming chat, metadata becomes separate SSE events
+        MetadataEvent: lambda event: event.to_sse_format(),
+        TokenUsageEvent: lambda event: event.to_sse_format(),
+        ErrorEvent: lambda event: event.error_message,
+    }
+    _JSON_FORMATTERS: Dict[type, Callable[[ChatEvent], str]] = {
+        ContentEvent: _json_content,
+        MetadataEvent: _json_metadata,
+        TokenUsageEvent: lambda event: event.to_sse_format(),
+        ErrorEvent: _json_error,
+    }
+
     @staticmethod
     def format_for_streaming(event: ChatEvent) -> str:
         """Format event for streaming chat (plain text)"""
-        if isinstance(event, ContentEvent):
-            return event.content
-        elif isinstance(event, MetadataEvent):
-            # For streaming chat, metadata becomes separate SSE events
-            return event.to_sse_format()
-        elif isinstance(event, TokenUsageEvent):
-            return event.to_sse_format()
-        elif isinstance(event, ErrorEvent):
-            return event.error_message
-        else:
-            raise ValueError(f"Unknown event type: {type(event)}")
+        return ChatEventFormatter._format(
+            ChatEventFormatter._STREAMING_FORMATTERS, event
+        )
 
     @staticmethod
     def format_for_json(event: ChatEvent) -> str:
         """Format event for JSON chat (structured data)"""
-        if isinstance(event, ContentEvent):
-            # Check if content is already formatted as JSON
-            content = event.content
-            if content.startswith('{"data":') and content.endswith("}"):
-                # Content is already formatted, return as-is (preserve original formatting)
-                return content + "\n\n"
-            else:
-                # Content is plain text, wrap in data format with proper JSON escaping
-                data_dict = {"data": content}
-                return json.dumps(data_dict) + "\n\n"
-        elif isinstance(event, MetadataEvent):
-            # Metadata as JSON string for JSON chat (matching test expectations)
-            metadata_dict = {"metadata": {"citations": event.citations or []}}
-            if event.metadata:
-                metadata_dict["metadata"].update(event.metadata)
-            return f"{json.dumps(metadata_dict)}\n\n"
-        elif isinstance(event, TokenUsageEvent):
-            return event.to_sse_format()
-        elif isinstance(event, ErrorEvent):
-            # Error in JSON format for JSON chat
-            error_response = {"data": f"[ERROR]: {event.error_message}"}
-            return f"data: {error_response}\n\n"
-        else:
+        return ChatEventFormatter._format(ChatEventFormatter._JSON_FORMATTERS, event)
+
+    @staticmethod
+    def _format(formatters: Dict[type, Callable[[ChatEvent], str]], event) -> str:
+        formatter = formatters.get(type(event))
+        if formatter is None:
+            # subclasses of the event types are formatted like their base type
+            formatter = next(
+                (
+                    formatter
+                    for event_type, formatter in formatters.items()
+                    if isinstance(event, event_type)
+                ),
+                None,
+            )
+        if formatter is None:
             raise ValueError(f"Unknown event type: {type(event)}")
+        return formatter(event)
 
 
 def create_content_event(content: str) -> ContentEvent:
@@ -144,7 +198,14 @@ def create_metadata_event(
 
 
 def create_token_usage_event(
-    prompt_tokens: int, completion_tokens: int, total_tokens: int, model: str
+    prompt_tokens: int,
+    completion_tokens: int,
+    total_tokens: int,
+    model: str,
+    cached: bool = False,
+    cached_tokens: int = 0,
+    cache_creation_tokens: int = 0,
+    estimated_prompt_tokens: Optional[int] = None,
 ) -> TokenUsageEvent:
     """Factory function to create token usage events"""
     return TokenUsageEvent(
@@ -152,6 +213,10 @@ def create_token_usage_event(
         completion_tokens=completion_tokens,
         total_tokens=total_tokens,
         model=model,
+        cached=cached,
+        cached_tokens=cached_tokens,
+        cache_creation_tokens=cache_creation_tokens,
+        estimated_prompt_tokens=estimated_prompt_tokens,
     )
 
 
@@ -0,0 +1,560 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import json
+import math
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import partial
+from typing import Callable, List, Optional
+
+from llms.chat_session_store_config import ChatSessionStoreConfig
+from llms.clients import (
+    HaivenAIMessage,
+    HaivenHumanMessage,
+    HaivenMessage,
+    HaivenSystemMessage,
+)
+from llms.memory_compaction import ConversationSummary
+from logger import HaivenLogger
+
+MESSAGE_TYPES = {
+    message_type.__name__: message_type
+    for message_type in [
+        HaivenSystemMessage,
+        HaivenHumanMessage,
+        HaivenAIMessage,
+        ConversationSummary,
+    ]
+}
+
+
+def serialize_messages(messages: List[HaivenMessage]) -> List[dict]:
+    return [
+        {"type": type(message).__name__, **message.to_dict()} for message in messages
+    ]
+
+
+def deserialize_messages(data: List[dict]) -> List[HaivenMessage]:
+    return [
+        MESSAGE_TYPES[item["type"]](
+            **{key: value for key, value in item.items() if key != "type"}
+        )
+        for item in data
+    ]
+
+
+def _new_session_key(category: str) -> str:
+    return category + "-" + str(uuid.uuid4())
+
+
+# reasons a session is evicted
+EXPIRED = "expired"
+CAPACITY = "capacity"
+
+
+def _log_evictions(count: int, reason: str, remaining: int) -> None:
+    HaivenLogger.get().info(
+        f"Removed {count} chat sessions ({reason}), {remaining} left",
+        extra={
+            "INFO": "ChatSessionsEvicted",
+            "count": count,
+            "reason": reason,
+            "sessions": remaining,
+        },
+    )
+
+
+def _log_new_session(category: str, session_key: str, user_identifier: str) -> None:
+    HaivenLogger.get().analytics(
+        f"Creating a new chat session for category {category} with key {session_key} for user {user_identifier}"
+    )
+
+
+class ChatSessionStore(ABC):
+    """Keeps the chat sessions between the requests of a conversation, by session key."""
+
+    @abstractmethod
+    def add_new_entry(self, category: str, user_identifier: str) -> str:
+        pass
+
+    @abstractmethod
+    def store_chat(self, session_key: str, chat_session) -> None:
+        pass
+
+    @abstractmethod
+    def get_chat(self, session_key: str):
+        pass
+
+    @abstractmethod
+    def delete_entry(self, session_key: str) -> None:
+        pass
+
+    @abstractmethod
+    def dump_as_text(self, session_key: str, user_owner: str) -> str:
+        pass
+
+    def set_chat_restorer(self, restore_chat: Callable[[dict], object]) -> None:
+        """How chats are recreated from their serialized state, only needed by stores that serialize them."""
+
+    @abstractmethod
+    def remove_expired(self) -> int:
+        """Removes the sessions whose TTL has passed, returns how many."""
+        pass
+
+    @abstractmethod
+    def stats(self) -> dict:
+        pass
+
+    @abstractmethod
+    def memory_report(self) -> dict:
+        """How much memory of the server the chat sessions take, for operators."""
+        pass
+
+    def start_sweeper(self, interval_seconds: float) -> Optional["SessionSweeper"]:
+        """Removes expired sessions in the background every interval_seconds, instead of on the request path."""
+        if interval_seconds <= 0:
+            return None
+        sweeper = SessionSweeper(self, interval_seconds)
+        sweeper.start()
+        return sweeper
+
+    def get_or_create_chat(
+        self,
+        fn_create_chat,
+        chat_session_key_value: str = None,
+        chat_category: str = "unknown",
+        user_identifier: str = "unknown",
+    ):
+        if chat_session_key_value is None or chat_session_key_value == "":
+            chat_session_key_value = self.add_new_entry(chat_category, user_identifier)
+            chat_session = fn_create_chat()
+
+            self.store_chat(chat_session_key_value, chat_session)
+        else:
+            chat_session = self.get_chat(chat_session_key_value)
+
+        return chat_session_key_value, chat_session
+
+
+class ServerChatSessionMemory(ChatSessionStore):
+    """
+    Keeps the chat sessions in the process, so they are lost on restart and only known to one worker.
+
+    The sessions are ordered by their last access, least recent first, so touching a session and
+    removing the expired or least recently used ones takes constant time, no matter how many there are.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: int = 1800,
+        max_sessions: int = 0,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self._clock = clock
+        self._lock = threading.RLock()
+        self.USER_CHATS: OrderedDict[str, dict] = OrderedDict()
+        self.evictions = {EXPIRED: 0, CAPACITY: 0}
+
+    def remove_expired(self) -> int:
+        """Removes the sessions not accessed within the TTL, by looking at the least recently used ones only."""
+        expired_before = self._clock() - self.ttl_seconds
+        removed = 0
+        with self._lock:
+            while self.USER_CHATS:
+                key, entry = next(iter(self.USER_CHATS.items()))
+                if entry["last_access"] >= expired_before:
+                    break
+                del self.USER_CHATS[key]
+                removed += 1
+            self.evictions[EXPIRED] += removed
+            remaining = len(self.USER_CHATS)
+        if removed:
+            _log_evictions(removed, EXPIRED, remaining)
+        return removed
+
+    def clear_old_entries(self):
+        self.remove_expired()
+
+    def add_new_entry(self, category: str, user_identifier: str):
+        session_key = _new_session_key(category)
+
+        _log_new_session(category, session_key, user_identifier)
+        now = self._clock()
+        evicted = 0
+        with self._lock:
+            self.USER_CHATS[session_key] = {
+                "created_at": now,
+                "last_access": now,
+                "user": user_identifier,
+                "chat": None,
+            }
+            if self.max_sessions > 0:
+                while len(self.USER_CHATS) > self.max_sessions:
+                    self.USER_CHATS.popitem(last=False)
+                    evicted += 1
+                self.evictions[CAPACITY] += evicted
+            remaining = len(self.USER_CHATS)
+        if evicted:
+            _log_evictions(evicted, CAPACITY, remaining)
+        return session_key
+
+    def store_chat(self, session_key: str, chat_session):
+        with self._lock:
+            self.USER_CHATS[session_key]["chat"] = chat_session
+
+    def get_chat(self, session_key: str):
+        now = self._clock()
+        with self._lock:
+            entry = self.USER_CHATS.get(session_key)
+            if entry is not None and entry["last_access"] < now - self.ttl_seconds:
+                # expired, but not swept yet
+                del self.USER_CHATS[session_key]
+                self.evictions[EXPIRED] += 1
+                entry = None
+            if entry is None:
+                raise ValueError(
+                    f"Invalid identifier {session_key}, your chat session might have expired"
+                )
+            entry["last_access"] = now
+            self.USER_CHATS.move_to_end(session_key)
+            return entry["chat"]
+
+    def delete_entry(self, session_key):
+        with self._lock:
+            self.USER_CHATS.pop(session_key, None)
+
+    def dump_as_text(self, session_key: str, user_owner: str):
+        with self._lock:
+            chat_session_data = self.USER_CHATS.get(session_key, None)
+        if chat_session_data is None:
+            return f"Chat session with ID {session_key} not found"
+        if chat_session_data["user"] != user_owner:
+            return f"Chat session with ID {session_key} not found for this user"
+
+        chat_session = chat_session_data["chat"]
+        if chat_session is None:
+            return f"Chat session with ID {session_key} has no chat data"
+
+        return chat_session.memory_as_text()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self.USER_CHATS),
+                "max_sessions": self.max_sessions,
+                "evictions": dict(self.evictions),
+            }
+
+    def memory_report(self, largest: int = 10) -> dict:
+        now = self._clock()
+        with self._lock:
+            entries = list(self.USER_CHATS.items())
+
+        sessions = []
+        shared_texts = {}
+        for session_key, entry in entries:
+            chat_session = entry["chat"]
+            if chat_session is None:
+                continue
+            sessions.append(
+                {
+                    # not the whole key, which is all that is needed to continue the session
+                    "category": session_key.rsplit("-", 5)[0],
+                    "messages": len(chat_session.memory),
+                    "bytes": chat_session.memory_footprint_bytes(),
+                    "idle_seconds": round(now - entry["last_access"]),
+                }
+            )
+            for message in chat_session.memory:
+                for text in message.shared_texts():
+                    shared_texts[id(text)] = sys.getsizeof(text)
+
+        sessions.sort(key=lambda session: session["bytes"], reverse=True)
+        return {
+            "sessions": len(entries),
+            "in_process": True,
+            "session_bytes": sum(session["bytes"] for session in sessions),
+            # the system prompts and contexts, each counted once however many sessions use it
+            "shared_texts": len(shared_texts),
+            "shared_bytes": sum(shared_texts.values()),
+            "largest_sessions": sessions[:largest],
+        }
+
+
+class SessionSweeper:
+    """Calls remove_expired() of a session store every interval in a daemon thread."""
+
+    def __init__(self, store: ChatSessionStore, interval_seconds: float):
+        self.store = store
+        self.interval_seconds = interval_seconds
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="chat-session-sweeper", daemon=True
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval_seconds):
+            try:
+                self.store.remove_expired()
+            except Exception as error:
+                # a backend that is briefly unavailable must not end the sweeping
+                HaivenLogger.get().error(
+                    f"Could not remove expired chat sessions: {error}"
+                )
+
+
+class SessionBackend(ABC):
+    """Stores serialized sessions by key, each until its TTL has passed."""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def put(self, key: str, value: str, ttl_seconds: float) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        pass
+
+    @abstractmethod
+    def remove_expired(self) -> int:
+        pass
+
+    @abstractmethod
+    def size(self) -> Optional[int]:
+        """How many sessions are stored, None if the backend cannot tell cheaply."""
+        pass
+
+
+class SqliteSessionBackend(SessionBackend):
+    """
+    Keeps the sessions in a local SQLite file, which all workers on the same machine share.
+    Write-ahead logging lets them read while another one writes.
+    """
+
+    def __init__(self, path: str, clock: Callable[[], float] = time.time):
+        self.path = path
+        self._clock = clock
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # waits for the write lock of other workers instead of failing right away
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS chat_sessions ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS chat_sessions_expires_at ON chat_sessions (expires_at)"
+            )
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM chat_sessions WHERE key = ? AND expires_at > ?",
+                (key, self._clock()),
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, key: str, value: str, ttl_seconds: float) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO chat_sessions (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, self._clock() + ttl_seconds),
+            )
+
+    def delete(self, key: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM chat_sessions WHERE key = ?", (key,))
+
+    def remove_expired(self) -> int:
+        # uses the index on expires_at, so only the expired rows are visited
+        with self._lock, self._connection:
+            return self._connection.execute(
+                "DELETE FROM chat_sessions WHERE expires_at <= ?", (self._clock(),)
+            ).rowcount
+
+    def size(self) -> Optional[int]:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM chat_sessions"
+            ).fetchone()[0]
+
+
+class RedisSessionBackend(SessionBackend):
+    """
+    Keeps the sessions in Redis, or a server speaking its protocol like Valkey, so every replica
+    can continue every session. Redis expires the keys by their TTL itself.
+    """
+
+    KEY_PREFIX = "haiven:chat-session:"
+
+    def __init__(self, url: str, client=None):
+        if client is None:
+            # only this backend needs the redis package
+            import redis
+
+            client = redis.Redis.from_url(url)
+        self.client = client
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.client.get(self.KEY_PREFIX + key)
+        if isinstance(value, bytes):
+            return value.decode("utf-8")
+        return value
+
+    def put(self, key: str, value: str, ttl_seconds: float) -> None:
+        self.client.set(self.KEY_PREFIX + key, value, ex=math.ceil(ttl_seconds))
+
+    def delete(self, key: str) -> None:
+        self.client.delete(self.KEY_PREFIX + key)
+
+    def remove_expired(self) -> int:
+        return 0
+
+    def size(self) -> Optional[int]:
+        # counting would scan the whole keyspace
+        return None
+
+
+class SerializedChatSessionStore(ChatSessionStore):
+    """
+    Stores the chat sessions serialized in a backend shared by all processes: the memory messages of
+    the chat, its type, model and category, and who owns it. Chats are recreated from that state on
+    every request, and saved again at the end of every turn.
+    """
+
+    def __init__(
+        self,
+        backend: SessionBackend,
+        ttl_seconds: int = 1800,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self.restore_chat = None
+        self.evictions = {EXPIRED: 0}
+
+    def set_chat_restorer(self, restore_chat: Callable[[dict], object]) -> None:
+        self.restore_chat = restore_chat
+
+    def remove_expired(self) -> int:
+        removed = self.backend.remove_expired()
+        self.evictions[EXPIRED] += removed
+        if removed:
+            _log_evictions(removed, EXPIRED, self.backend.size())
+        return removed
+
+    def stats(self) -> dict:
+        return {"sessions": self.backend.size(), "evictions": dict(self.evictions)}
+
+    def memory_report(self) -> dict:
+        # the sessions are only in the memory of the server while one of their requests runs
+        return {"sessions": self.backend.size(), "in_process": False}
+
+    def add_new_entry(self, category: str, user_identifier: str) -> str:
+        session_key = _new_session_key(category)
+
+        _log_new_session(category, session_key, user_identifier)
+        now = self._clock()
+        self._put_entry(
+            session_key,
+            {
+                "created_at": now,
+                "last_access": now,
+                "user": user_identifier,
+                "chat": None,
+            },
+        )
+        return session_key
+
+    def store_chat(self, session_key: str, chat_session) -> None:
+        self._save_chat(session_key, chat_session)
+        self._save_after_each_turn(session_key, chat_session)
+
+    def get_chat(self, session_key: str):
+        entry = self._get_entry(session_key)
+        if entry is None:
+            raise ValueError(
+                f"Invalid identifier {session_key}, your chat session might have expired"
+            )
+        entry["last_access"] = self._clock()
+        self._put_entry(session_key, entry)
+        if entry["chat"] is None:
+            return None
+
+        chat_session = self.restore_chat(entry["chat"])
+        self._save_after_each_turn(session_key, chat_session)
+        return chat_session
+
+    def delete_entry(self, session_key: str) -> None:
+        self.backend.delete(session_key)
+
+    def dump_as_text(self, session_key: str, user_owner: str) -> str:
+        entry = self._get_entry(session_key)
+        if entry is None:
+            return f"Chat session with ID {session_key} not found"
+        if entry["user"] != user_owner:
+            return f"Chat session with ID {session_key} not found for this user"
+        if entry["chat"] is None:
+            return f"Chat session with ID {session_key} has no chat data"
+
+        return "\n".join(
+            str(message) for message in deserialize_messages(entry["chat"]["memory"])
+        )
+
+    def _save_after_each_turn(self, session_key: str, chat_session) -> None:
+        chat_session.on_turn_end = partial(self._save_chat, session_key)
+
+    def _save_chat(self, session_key: str, chat_session) -> None:
+        entry = self._get_entry(session_key)
+        if entry is None:
+            # deleted or expired while the turn was running
+            return
+        entry["chat"] = chat_session.to_state()
+        entry["last_access"] = self._clock()
+        self._put_entry(session_key, entry)
+
+    def _get_entry(self, session_key: str) -> Optional[dict]:
+        value = self.backend.get(session_key)
+        return json.loads(value) if value is not None else None
+
+    def _put_entry(self, session_key: str, entry: dict) -> None:
+        self.backend.put(
+            session_key,
+            json.dumps(entry, separators=(",", ":"), ensure_ascii=False),
+            self.ttl_seconds,
+        )
+
+
+def create_chat_session_store(config: ChatSessionStoreConfig) -> ChatSessionStore:
+    if config.backend == ChatSessionStoreConfig.SQLITE:
+        return SerializedChatSessionStore(
+            SqliteSessionBackend(config.path), config.ttl_seconds
+        )
+    if config.backend == ChatSessionStoreConfig.REDIS:
+        return SerializedChatSessionStore(
+            RedisSessionBackend(config.redis_url), config.ttl_seconds
+        )
+    return ServerChatSessionMemory(config.ttl_seconds, config.max_sessions)
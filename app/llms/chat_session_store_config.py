@@ -0,0 +1,78 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from config_values import to_int
+
+
+class ChatSessionStoreConfig:
+    """
+    Settings for where the chat sessions are kept between the requests of a conversation.
+
+    Attributes:
+        backend (str): "memory" keeps the sessions in the process, like before. "sqlite" and "redis"
+            store them serialized, so they survive restarts and any worker (sqlite: on the same machine)
+            or replica (redis) can continue a session.
+        path (str): The database file of the "sqlite" backend.
+        redis_url (str): The server of the "redis" backend, e.g. redis://localhost:6379/0.
+        ttl_seconds (int): How long a session is kept after it was last used.
+        max_sessions (int): How many sessions the "memory" backend keeps at most, the least recently
+            used are evicted beyond it. 0 means no limit. The serialized backends are only bounded by the TTL.
+        sweep_interval_seconds (int): How often expired sessions are removed in the background.
+            0 turns the sweeper off, expired sessions are then only removed when they are accessed.
+        concurrent_requests (str): What happens to a request to a session that is still answering an earlier
+            one: "queue" runs it once the earlier ones are done, "reject" answers it with 409 Conflict,
+            "fork" continues it in a new session with the memory as it was before the running turn.
+    """
+
+    MEMORY = "memory"
+    SQLITE = "sqlite"
+    REDIS = "redis"
+
+    BACKENDS = [MEMORY, SQLITE, REDIS]
+
+    QUEUE = "queue"
+    REJECT = "reject"
+    FORK = "fork"
+
+    CONCURRENT_REQUESTS = [QUEUE, REJECT, FORK]
+
+    def __init__(
+        self,
+        backend: str = MEMORY,
+        path: str = "chat_sessions.sqlite",
+        redis_url: str = "redis://localhost:6379/0",
+        ttl_seconds: int = 1800,
+        max_sessions: int = 10000,
+        sweep_interval_seconds: int = 60,
+        concurrent_requests: str = QUEUE,
+    ):
+        backend = (backend or ChatSessionStoreConfig.MEMORY).lower()
+        if backend not in ChatSessionStoreConfig.BACKENDS:
+            raise ValueError(
+                f"Chat session backend {backend} not supported, use one of {', '.join(ChatSessionStoreConfig.BACKENDS)}"
+            )
+        concurrent_requests = (
+            concurrent_requests or ChatSessionStoreConfig.QUEUE
+        ).lower()
+        if concurrent_requests not in ChatSessionStoreConfig.CONCURRENT_REQUESTS:
+            raise ValueError(
+                f"Concurrent requests setting {concurrent_requests} not supported, use one of {', '.join(ChatSessionStoreConfig.CONCURRENT_REQUESTS)}"
+            )
+        self.backend = backend
+        self.path = path or "chat_sessions.sqlite"
+        self.redis_url = redis_url or "redis://localhost:6379/0"
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self.concurrent_requests = concurrent_requests
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        return cls(
+            backend=data.get("backend"),
+            path=data.get("path"),
+            redis_url=data.get("redis_url"),
+            ttl_seconds=to_int(data.get("ttl_seconds"), 1800),
+            max_sessions=to_int(data.get("max_sessions"), 10000),
+            sweep_interval_seconds=to_int(data.get("sweep_interval_seconds"), 60),
+            concurrent_requests=data.get("concurrent_requests"),
+        )
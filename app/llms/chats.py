@@ -1,20 +1,42 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
-import json
-import time
-import uuid
-from typing import List
+import asyncio
+from contextlib import nullcontext
+from typing import Callable, List
 
 from pydantic import BaseModel
 from config_service import ConfigService
 from knowledge_manager import KnowledgeManager
-from embeddings.documents import DocumentsUtils
 from llms.clients import (
     ChatClient,
     ChatClientFactory,
     HaivenAIMessage,
     HaivenHumanMessage,
+    HaivenMessage,
     HaivenSystemMessage,
     ModelConfig,
+    STREAM_ABORTED,
+)
+from llms.chat_session_store_config import ChatSessionStoreConfig
+from llms.chat_session_store import (
+    ChatSessionStore,
+    ServerChatSessionMemory,  # noqa: F401 - imported from here by the app and tests
+    deserialize_messages,
+    serialize_messages,
+)
+from llms.session_locks import SessionBusy, SessionClaim, SessionLocks
+from llms.memory_compaction import (
+    MemoryCompactor,
+    count_bytes,
+    create_memory_compactor,
+)
+from llms.model_routing_config import QUERY_REWRITE, TEXT_GENERATION
+from llms.telemetry import ChatTelemetry
+from llms.query_rewrite_config import QueryRewriteConfig
+from llms.query_rewrite import (
+    ModelQueryRewriter,
+    QueryRewriter,
+    QueryRewriteStats,
+    create_query_rewriter,
 )
 from logger import HaivenLogger
 from llms.chat_events import (
@@ -28,6 +50,11 @@ from llms.chat_events import (
 )
 
 
+# tokens of the instructions around the context documents in the prompt, and of the separator between two documents
+CONTEXT_PROMPT_TOKENS = 50
+CONTEXT_SEPARATOR_TOKENS = 2
+
+
 class HaivenBaseChat:
     def __init__(
         self,
@@ -35,22 +62,42 @@ class HaivenBaseChat:
         knowledge_manager: KnowledgeManager,
         contexts: List[str] = None,
         user_context: str = None,
+        query_rewriter: QueryRewriter = None,
+        memory_compactor: MemoryCompactor = None,
+        telemetry: ChatTelemetry = None,
+        category: str = None,
     ):
         self.knowledge_manager = knowledge_manager
+        self.query_rewriter = query_rewriter or ModelQueryRewriter()
+        self.memory_compactor = memory_compactor
+        self.telemetry = telemetry
+        self.category = category or "unknown"
+        # whether a turn is in progress, and its span, the parent of the spans of its phases
+        self._turn_active = False
+        self._turn_span = None
+        # the memory as it was when the turn in progress started
+        self._memory_before_turn = None
+        # called with the chat after each turn, e.g. to save it to the session store
+        self.on_turn_end = None
         self.system = knowledge_manager.get_system_message()
+        system_segments = [self.system]
         aggregatedContext = (
             knowledge_manager.knowledge_base_markdown.aggregate_all_contexts(
                 contexts, user_context
             )
         )
         if aggregatedContext:
-            self.system += (
+            context_segment = (
                 "\n\nMultiple contexts will be given. Consider "
                 + "all contexts when responding to the given prompt "
                 + aggregatedContext
             )
+            self.system += context_segment
+            system_segments.append(context_segment)
 
-        self.memory = [HaivenSystemMessage(content=self.system)]
+        self.memory = [
+            HaivenSystemMessage(content=self.system, segments=system_segments)
+        ]
         self.chat_client = chat_client
 
     def log_run(self, extra={}):
@@ -66,44 +113,150 @@ class HaivenBaseChat:
     def memory_as_text(self):
         return "\n".join([str(message) for message in self.memory])
 
-    def _similarity_query(self, message):
-        if len(self.memory) == 1:
-            return message
+    def memory_footprint_bytes(self) -> int:
+        """The memory the messages of the chat take, without the texts shared with other chats."""
+        return count_bytes(self.memory)
+
+    def _compact_memory(self):
+        if self.memory_compactor is not None:
+            with self._phase("memory_compaction"):
+                self.memory = self.memory_compactor.compact(self.memory)
+
+    async def _compact_memory_async(self):
+        if self.memory_compactor is not None:
+            with self._phase("memory_compaction"):
+                # summarizing dropped turns calls the model
+                self.memory = await asyncio.to_thread(
+                    self.memory_compactor.compact, self.memory
+                )
+
+    def _metric_labels(self) -> dict:
+        return {
+            "chat_type": self.__class__.__name__,
+            "model": self.chat_client.model_config.lite_id,
+            "category": self.category,
+        }
+
+    def completed_memory(self) -> List[HaivenMessage]:
+        """The memory without the messages of the turn in progress."""
+        if self._turn_active:
+            return self._memory_before_turn
+        return self.memory
+
+    def to_state(self) -> dict:
+        """What is needed to continue the chat in another process, see ChatManager.restore_chat."""
+        model_config = self.chat_client.model_config
+        return {
+            "chat_type": self.__class__.__name__,
+            "model": {
+                "id": model_config.id,
+                "provider": model_config.provider,
+                "name": model_config.name,
+            },
+            "category": self.category,
+            "memory": serialize_messages(self.memory),
+        }
 
-        if len(self.memory) > 5:
-            conversation = "\n".join(
-                [message.content for message in (self.memory[:2] + self.memory[-4:])]
+    def _start_turn(self) -> bool:
+        """Starts a turn unless one is in progress already, e.g. when run() is called by run_with_document()."""
+        if self._turn_active:
+            return False
+        self._turn_active = True
+        self._memory_before_turn = list(self.memory)
+        if self.telemetry is not None:
+            self._turn_span = self.telemetry.start_span(
+                "chat.turn",
+                {
+                    "haiven.chat_type": self.__class__.__name__,
+                    "haiven.category": self.category,
+                    "gen_ai.request.model": self.chat_client.model_config.lite_id,
+                },
             )
-        else:
-            conversation = "\n".join([message.content for message in self.memory])
-
-        system_message = f"""You are a helpful assistant.
-        Your task is create a single search query to find relevant information, based on the conversation and the current user message.
-        Rules: 
-        - Search query should find relevant information for the current user message only.
-        - Include all important key words and phrases in query that would help to search for relevant information.
-        - If the current user message does not need to search for additional information, return NONE.
-        - Only return the single standalone search query or NONE. No explanations needed.
-        
-        Conversation:
-        {conversation}
-        """
-        prompt = [HaivenSystemMessage(content=system_message)]
-        prompt.append(
-            HaivenHumanMessage(content=f"Current user message: {message} \n Query:")
+        return True
+
+    def _end_turn(self, turn_started: bool, error: Exception = None):
+        if not turn_started:
+            return
+        self._turn_active = False
+        self._memory_before_turn = None
+        if isinstance(error, STREAM_ABORTED):
+            self._keep_aborted_turn()
+        if self._turn_span is not None:
+            turn_span, self._turn_span = self._turn_span, None
+            turn_span.end(error)
+        if self.on_turn_end is not None:
+            self.on_turn_end(self)
+
+    def _keep_aborted_turn(self):
+        # the answer streamed until the client went away stays in the memory, so the session can go
+        # on from it. A question that got no answer at all is dropped, so the roles keep alternating
+        if self.memory and isinstance(self.memory[-1], HaivenHumanMessage):
+            self.memory.pop()
+        HaivenLogger.get().info(
+            "Chat turn aborted, the client stopped reading the answer",
+            extra={"INFO": "ChatTurnAborted", "chat_type": self.__class__.__name__},
         )
 
-        stream = self.chat_client.stream(prompt)
-        query = ""
-        for chunk in stream:
-            query += chunk.get("content", "")
+    def _phase(self, phase: str):
+        if self.telemetry is None:
+            return nullcontext()
+        return self.telemetry.phase(phase, self._metric_labels(), self._turn_span)
 
-        if "none" in query.lower():
-            return None
-        elif "query:" in query.lower():
-            return query.split("query:")[1].strip()
-        else:
-            return query
+    def _timed_stream(self, chunks):
+        if self.telemetry is None:
+            yield from chunks
+            return
+        timer = self.telemetry.start_model_call(self._metric_labels(), self._turn_span)
+        try:
+            for chunk in chunks:
+                timer.chunk(chunk)
+                yield chunk
+        except STREAM_ABORTED:
+            self._label_answering_model(timer)
+            timer.abort()
+            raise
+        except Exception as error:
+            self._label_answering_model(timer)
+            timer.finish(error)
+            raise
+        finally:
+            # also when the stream is closed before its end
+            self._label_answering_model(timer)
+            timer.finish()
+
+    async def _atimed_stream(self, chunks):
+        if self.telemetry is None:
+            async for chunk in chunks:
+                yield chunk
+            return
+        timer = self.telemetry.start_model_call(self._metric_labels(), self._turn_span)
+        try:
+            async for chunk in chunks:
+                timer.chunk(chunk)
+                yield chunk
+        except STREAM_ABORTED:
+            self._label_answering_model(timer)
+            timer.abort()
+            raise
+        except Exception as error:
+            self._label_answering_model(timer)
+            timer.finish(error)
+            raise
+        finally:
+            self._label_answering_model(timer)
+            timer.finish()
+
+    def _label_answering_model(self, timer):
+        # a fallback model may have answered instead of the chat's own model
+        if timer.finished:
+            return
+        model = self.chat_client.answered_by.lite_id
+        timer.labels = {**timer.labels, "model": model}
+        timer.span.attributes["gen_ai.response.model"] = model
+
+    def _similarity_query(self, message):
+        with self._phase("query_rewrite"):
+            return self.query_rewriter.rewrite(message, self.memory, self.chat_client)
 
     def _similarity_search_based_on_history(self, message, knowledge_document_keys):
         similarity_query = self._similarity_query(message)
@@ -112,30 +265,64 @@ class HaivenBaseChat:
             return None, None
 
         if knowledge_document_keys:
-            context_documents = self.knowledge_manager.knowledge_base_documents.similarity_search_on_multiple_documents(
-                query=similarity_query,
-                document_keys=knowledge_document_keys,
-            )
+            with self._phase("retrieval"):
+                context_documents = self.knowledge_manager.knowledge_base_documents.similarity_search_on_multiple_documents(
+                    query=similarity_query,
+                    document_keys=knowledge_document_keys,
+                )
         else:
             return None, None
+        context_documents = self._fit_context_documents(context_documents, message)
 
         context_for_prompt = "\n---".join(
             [f"{document.page_content}" for document in context_documents]
         )
-        de_duplicated_sources = DocumentsUtils.get_unique_sources(context_documents)
+        search_result_items = (
+            self.knowledge_manager.knowledge_base_documents.get_search_result_items(
+                context_documents
+            )
+        )
         sources_markdown = (
             "**These articles might be relevant:**\n"
-            + "\n".join(
-                [
-                    f"- {DocumentsUtils.get_search_result_item(source.metadata)}"
-                    for source in de_duplicated_sources
-                ]
-            )
+            + "\n".join([f"- {item}" for item in search_result_items])
             + "\n\n"
         )
 
         return context_for_prompt, sources_markdown
 
+    def _fit_context_documents(self, context_documents, message):
+        """
+        Keeps the best ranked documents that still fit into the model's context window next to
+        the memory and the message, so the request is not rejected for its size.
+        """
+        remaining_tokens = self.chat_client.remaining_input_tokens(
+            self.memory + [HaivenHumanMessage(content=message or "")]
+        )
+        if remaining_tokens is None:
+            return context_documents
+
+        remaining_tokens -= CONTEXT_PROMPT_TOKENS
+        fitted_documents = []
+        for document in context_documents:
+            document_tokens = (
+                self.chat_client.count_tokens(document.page_content)
+                + CONTEXT_SEPARATOR_TOKENS
+            )
+            if document_tokens <= remaining_tokens:
+                fitted_documents.append(document)
+                remaining_tokens -= document_tokens
+
+        if len(fitted_documents) < len(context_documents):
+            HaivenLogger.get().info(
+                f"Left out {len(context_documents) - len(fitted_documents)} of {len(context_documents)} context documents to fit the context window",
+                extra={
+                    "INFO": "ContextDocumentsTrimmed",
+                    "documents": len(context_documents),
+                    "keptDocuments": len(fitted_documents),
+                },
+            )
+        return fitted_documents
+
 
 class StreamingChat(HaivenBaseChat):
     def __init__(
@@ -145,38 +332,101 @@ class StreamingChat(HaivenBaseChat):
         stream_in_chunks: bool = False,
         contexts: List[str] = None,
         user_context: str = None,
+        query_rewriter: QueryRewriter = None,
+        memory_compactor: MemoryCompactor = None,
+        telemetry: ChatTelemetry = None,
+        category: str = None,
     ):
-        super().__init__(chat_client, knowledge_manager, contexts, user_context)
+        super().__init__(
+            chat_client,
+            knowledge_manager,
+            contexts,
+            user_context,
+            query_rewriter,
+            memory_compactor,
+            telemetry,
+            category,
+        )
         self.stream_in_chunks = stream_in_chunks
 
+    def to_state(self) -> dict:
+        return {**super().to_state(), "stream_in_chunks": self.stream_in_chunks}
+
     def run(self, message: str, user_query: str = None):
         """Run streaming chat with unified event system"""
+        turn_started = self._start_turn()
         self.memory.append(HaivenHumanMessage(content=message))
+        turn_error = None
 
         try:
-            for i, chunk in enumerate(self.chat_client.stream(self.memory)):
-                if i == 0:
-                    if user_query:
-                        self.memory[-1].content = user_query
-                    self.memory.append(HaivenAIMessage(content=""))
+            self._compact_memory()
+            for i, chunk in enumerate(
+                self._timed_stream(self.chat_client.stream(self.memory))
+            ):
+                event_str = self._process_chunk(i, chunk, user_query)
+                if event_str is not None:
+                    yield event_str
+
+        except STREAM_ABORTED as error:
+            turn_error = error
+            raise
+        except Exception as error:
+            turn_error = error
+            yield self._format_error(error)
+        finally:
+            self._end_turn(turn_started, turn_error)
+
+    async def run_async(self, message: str, user_query: str = None):
+        """Same events as run(), streamed from the event loop without blocking a worker thread"""
+        turn_started = self._start_turn()
+        self.memory.append(HaivenHumanMessage(content=message))
+        turn_error = None
 
-                # Convert raw chunks to standardized events
-                event = self._convert_chunk_to_event(chunk)
-                if event:
-                    # Format event for streaming chat
-                    yield ChatEventFormatter.format_for_streaming(event)
+        try:
+            await self._compact_memory_async()
+            i = 0
+            async for chunk in self._atimed_stream(
+                self.chat_client.astream(self.memory)
+            ):
+                event_str = self._process_chunk(i, chunk, user_query)
+                i += 1
+                if event_str is not None:
+                    yield event_str
+
+        except STREAM_ABORTED as error:
+            turn_error = error
+            raise
+        except Exception as error:
+            turn_error = error
+            yield self._format_error(error)
+        finally:
+            self._end_turn(turn_started, turn_error)
+
+    def _process_chunk(self, i: int, chunk, user_query: str = None):
+        if i == 0:
+            if user_query:
+                self.memory[-1].content = user_query
+            self.memory.append(HaivenAIMessage(content=""))
+
+        # Convert raw chunks to standardized events
+        event = self._convert_chunk_to_event(chunk)
+        if not event:
+            return None
 
-                    # Update memory for content events
-                    if isinstance(event, ContentEvent):
-                        self.memory[-1].content += event.content
+        # Update memory for content events
+        if isinstance(event, ContentEvent):
+            self.memory[-1].content += event.content
 
-        except Exception as error:
-            error_msg = (
-                str(error).strip() or "Error while the model was processing the input"
-            )
-            print(f"[ERROR]: {error_msg}")
-            error_event = create_error_event(error_msg)
-            yield ChatEventFormatter.format_for_streaming(error_event)
+        # Format event for streaming chat
+        return ChatEventFormatter.format_for_streaming(event)
+
+    def _format_error(self, error: Exception) -> str:
+        error_msg = (
+            str(error).strip() or "Error while the model was processing the input"
+        )
+        print(f"[ERROR]: {error_msg}")
+        error_event = create_error_event(error_msg)
+        return ChatEventFormatter.format_for_streaming(error_event)
 
     def _convert_chunk_to_event(self, chunk) -> ChatEvent:
         """Convert raw chunk from chat client to standardized event"""
@@ -196,6 +446,10 @@ class StreamingChat(HaivenBaseChat):
                     completion_tokens=usage_data.get("completion_tokens", 0),
                     total_tokens=usage_data.get("total_tokens", 0),
                     model=usage_data.get("model", "unknown"),
+                    cached=usage_data.get("cached", False),
+                    cached_tokens=usage_data.get("cached_tokens", 0),
+                    cache_creation_tokens=usage_data.get("cache_creation_tokens", 0),
+                    estimated_prompt_tokens=usage_data.get("estimated_prompt_tokens"),
                 )
         return None
 
@@ -205,48 +459,88 @@ class StreamingChat(HaivenBaseChat):
         message: str = None,
     ):
         """Run streaming chat with document context"""
+        turn_started = self._start_turn()
+        turn_error = None
         try:
-            context_for_prompt, sources_markdown = (
-                self._similarity_search_based_on_history(
-                    message, knowledge_document_keys
-                )
+            prompt, user_request, sources_markdown = self._prompt_with_document(
+                knowledge_document_keys, message
             )
 
-            user_request = (
-                message
-                or "Based on our conversation so far, what do you think is relevant to me with the CONTEXT information I gathered?"
+            # Stream content events
+            for event_str in self.run(prompt, user_request):
+                yield event_str, sources_markdown
+
+            # Add sources at the end if available
+            if sources_markdown:
+                yield self._format_sources(sources_markdown), sources_markdown
+
+        except STREAM_ABORTED as error:
+            turn_error = error
+            raise
+        except Exception as error:
+            turn_error = error
+            yield self._format_error(error), ""
+        finally:
+            self._end_turn(turn_started, turn_error)
+
+    async def run_with_document_async(
+        self,
+        knowledge_document_keys: List[str],
+        message: str = None,
+    ):
+        """Same events as run_with_document(), streamed from the event loop"""
+        turn_started = self._start_turn()
+        turn_error = None
+        try:
+            # The similarity search embeds the query and searches the indexes synchronously,
+            # so it runs in a worker thread while only the model response is awaited
+            prompt, user_request, sources_markdown = await asyncio.to_thread(
+                self._prompt_with_document, knowledge_document_keys, message
             )
 
-            if context_for_prompt:
-                prompt = f"""
+            async for event_str in self.run_async(prompt, user_request):
+                yield event_str, sources_markdown
+
+            if sources_markdown:
+                yield self._format_sources(sources_markdown), sources_markdown
+
+        except STREAM_ABORTED as error:
+            turn_error = error
+            raise
+        except Exception as error:
+            turn_error = error
+            yield self._format_error(error), ""
+        finally:
+            self._end_turn(turn_started, turn_error)
+
+    def _prompt_with_document(
+        self, knowledge_document_keys: List[str], message: str = None
+    ):
+        context_for_prompt, sources_markdown = self._similarity_search_based_on_history(
+            message, knowledge_document_keys
+        )
+
+        user_request = (
+            message
+            or "Based on our conversation so far, what do you think is relevant to me with the CONTEXT information I gathered?"
+        )
+
+        if context_for_prompt:
+            prompt = f"""
                 {user_request}
                 ---- Here is some additional CONTEXT that might be relevant to this:
                 {context_for_prompt} 
                 -------
                 Do not provide any advice that is outside of the CONTEXT I provided.
                 """
-            else:
-                prompt = user_request
+        else:
+            prompt = user_request
 
-            # Stream content events
-            for event_str in self.run(prompt, user_request):
-                yield event_str, sources_markdown
+        return prompt, user_request, sources_markdown
 
-            # Add sources at the end if available
-            if sources_markdown:
-                sources_event = create_content_event("\n\n" + sources_markdown)
-                yield (
-                    ChatEventFormatter.format_for_streaming(sources_event),
-                    sources_markdown,
-                )
-
-        except Exception as error:
-            error_msg = (
-                str(error).strip() or "Error while the model was processing the input"
-            )
-            print(f"[ERROR]: {error_msg}")
-            error_event = create_error_event(error_msg)
-            yield ChatEventFormatter.format_for_streaming(error_event), ""
+    def _format_sources(self, sources_markdown: str) -> str:
+        sources_event = create_content_event("\n\n" + sources_markdown)
+        return ChatEventFormatter.format_for_streaming(sources_event)
 
 
 class JSONChat(HaivenBaseChat):
@@ -256,54 +550,117 @@ class JSONChat(HaivenBaseChat):
         knowledge_manager: KnowledgeManager,
         contexts: List[str] = None,
         user_context: str = None,
+        memory_compactor: MemoryCompactor = None,
+        telemetry: ChatTelemetry = None,
+        category: str = None,
     ):
-        super().__init__(chat_client, knowledge_manager, contexts, user_context)
+        super().__init__(
+            chat_client,
+            knowledge_manager,
+            contexts,
+            user_context,
+            memory_compactor=memory_compactor,
+            telemetry=telemetry,
+            category=category,
+        )
+        # the message the answer of the current turn is streamed into
+        self._answer = None
 
-    def stream_from_model(self, new_message):
+    def stream_from_model(self, new_message, state_snapshot: bool = False):
         """Stream raw events from the model"""
+        turn_started = self._start_turn()
+        turn_error = None
         try:
-            self.memory.append(HaivenHumanMessage(content=new_message))
-            stream = self.chat_client.stream(self.memory)
+            self.memory.append(
+                HaivenHumanMessage(content=new_message, state_snapshot=state_snapshot)
+            )
+            self._compact_memory()
+            stream = self._timed_stream(self.chat_client.stream(self.memory))
 
             for chunk in stream:
                 event = self._convert_chunk_to_event(chunk)
                 if event:
                     yield event
 
+        except STREAM_ABORTED as error:
+            turn_error = error
+            raise
         except Exception as error:
-            error_msg = (
-                str(error).strip() or "Error while the model was processing the input"
+            turn_error = error
+            yield create_error_event(self._error_message(error))
+        finally:
+            self._end_turn(turn_started, turn_error)
+
+    async def stream_from_model_async(self, new_message, state_snapshot: bool = False):
+        """Same events as stream_from_model(), awaiting the model response"""
+        turn_started = self._start_turn()
+        turn_error = None
+        try:
+            self.memory.append(
+                HaivenHumanMessage(content=new_message, state_snapshot=state_snapshot)
             )
-            print(f"[ERROR]: {error_msg}")
-            yield create_error_event(error_msg)
+            await self._compact_memory_async()
 
-    def run(self, message: str):
-        """Run JSON chat with unified event system"""
+            async for chunk in self._atimed_stream(
+                self.chat_client.astream(self.memory)
+            ):
+                event = self._convert_chunk_to_event(chunk)
+                if event:
+                    yield event
 
-        def create_data_chunk(chunk):
-            message = json.dumps({"data": chunk})
-            return f"{message}\n\n"
+        except STREAM_ABORTED as error:
+            turn_error = error
+            raise
+        except Exception as error:
+            turn_error = error
+            yield create_error_event(self._error_message(error))
+        finally:
+            self._end_turn(turn_started, turn_error)
 
+    def run(self, message: str, state_snapshot: bool = False):
+        """
+        Run JSON chat with unified event system. A state_snapshot message carries the complete
+        current data of the session, so the earlier messages that sent it can be dropped.
+        """
+        self._answer = None
         try:
-            for event in self.stream_from_model(message):
-                if isinstance(event, ContentEvent):
-                    # Update memory for content events
-                    if not hasattr(self, "_first_chunk"):
-                        self.memory.append(HaivenAIMessage(content=""))
-                        self._first_chunk = True
-                    self.memory[-1].content += event.content
-
-                # Format event for JSON chat - all formatting handled by ChatEventFormatter
-                formatted_event = ChatEventFormatter.format_for_json(event)
-                yield formatted_event
+            for event in self.stream_from_model(message, state_snapshot):
+                yield self._process_event(event)
 
         except Exception as error:
-            error_msg = (
-                str(error).strip() or "Error while the model was processing the input"
-            )
-            print(f"[ERROR]: {error_msg}")
-            error_event = create_error_event(error_msg)
-            yield ChatEventFormatter.format_for_json(error_event) + "\n\n"
+            yield self._format_error(error)
+
+    async def run_async(self, message: str, state_snapshot: bool = False):
+        """Same events as run(), streamed from the event loop without blocking a worker thread"""
+        self._answer = None
+        try:
+            async for event in self.stream_from_model_async(message, state_snapshot):
+                yield self._process_event(event)
+
+        except Exception as error:
+            yield self._format_error(error)
+
+    def _process_event(self, event: ChatEvent) -> str:
+        if isinstance(event, ContentEvent):
+            # Update memory for content events, the first one of each turn starts its answer
+            if self._answer is None:
+                self._answer = HaivenAIMessage(content="")
+                self.memory.append(self._answer)
+            self._answer.content += event.content
+
+        # Format event for JSON chat - all formatting handled by ChatEventFormatter
+        return ChatEventFormatter.format_for_json(event)
+
+    def _error_message(self, error: Exception) -> str:
+        error_msg = (
+            str(error).strip() or "Error while the model was processing the input"
+        )
+        print(f"[ERROR]: {error_msg}")
+        return error_msg
+
+    def _format_error(self, error: Exception) -> str:
+        error_event = create_error_event(self._error_message(error))
+        return ChatEventFormatter.format_for_json(error_event) + "\n\n"
 
     def _convert_chunk_to_event(self, chunk) -> ChatEvent:
         """Convert raw chunk from chat client to standardized event"""
@@ -326,6 +683,10 @@ class JSONChat(HaivenBaseChat):
                     completion_tokens=usage_data.get("completion_tokens", 0),
                     total_tokens=usage_data.get("total_tokens", 0),
                     model=usage_data.get("model", "unknown"),
+                    cached=usage_data.get("cached", False),
+                    cached_tokens=usage_data.get("cached_tokens", 0),
+                    cache_creation_tokens=usage_data.get("cache_creation_tokens", 0),
+                    estimated_prompt_tokens=usage_data.get("estimated_prompt_tokens"),
                 )
         elif isinstance(chunk, str):
             # Handle pre-formatted JSON strings from mocks
@@ -338,93 +699,6 @@ class JSONChat(HaivenBaseChat):
         return None
 
 
-class ServerChatSessionMemory:
-    def __init__(self):
-        self.USER_CHATS = {}
-
-    def clear_old_entries(self):
-        allowed_age_in_minutes = 30
-        allowed_age_in_seconds = 60 * allowed_age_in_minutes
-        print(
-            f"CLEANUP: Removing chat sessions with last user access > {allowed_age_in_minutes} mins from memory. Currently {len(self.USER_CHATS)} entries in memory"
-        )
-
-        entries_to_remove = list(
-            filter(
-                lambda key: self.USER_CHATS[key]["last_access"]
-                < time.time() - allowed_age_in_seconds,
-                self.USER_CHATS,
-            )
-        )
-
-        for key in entries_to_remove:
-            print("CLEANUP: Removing entry", key)
-            del self.USER_CHATS[key]
-
-    def add_new_entry(self, category: str, user_identifier: str):
-        # Currently the crude rhythm of checking for old entries: whenever a new one gets created
-        self.clear_old_entries()
-
-        session_key = category + "-" + str(uuid.uuid4())
-
-        HaivenLogger.get().analytics(
-            f"Creating a new chat session for category {category} with key {session_key} for user {user_identifier}"
-        )
-        self.USER_CHATS[session_key] = {
-            "created_at": time.time(),
-            "last_access": time.time(),
-            "user": user_identifier,
-            "chat": None,
-        }
-        return session_key
-
-    def store_chat(self, session_key: str, chat_session: HaivenBaseChat):
-        self.USER_CHATS[session_key]["chat"] = chat_session
-
-    def get_chat(self, session_key: str):
-        if session_key not in self.USER_CHATS:
-            raise ValueError(
-                f"Invalid identifier {session_key}, your chat session might have expired"
-            )
-        self.USER_CHATS[session_key]["last_access"] = time.time()
-        return self.USER_CHATS[session_key]["chat"]
-
-    def delete_entry(self, session_key):
-        if session_key in self.USER_CHATS:
-            print("Discarding a chat session from memory", session_key)
-            del self.USER_CHATS[session_key]
-
-    def get_or_create_chat(
-        self,
-        fn_create_chat,
-        chat_session_key_value: str = None,
-        chat_category: str = "unknown",
-        user_identifier: str = "unknown",
-    ):
-        if chat_session_key_value is None or chat_session_key_value == "":
-            chat_session_key_value = self.add_new_entry(chat_category, user_identifier)
-            chat_session = fn_create_chat()
-
-            self.store_chat(chat_session_key_value, chat_session)
-        else:
-            chat_session = self.get_chat(chat_session_key_value)
-
-        return chat_session_key_value, chat_session
-
-    def dump_as_text(self, session_key: str, user_owner: str):
-        chat_session_data = self.USER_CHATS.get(session_key, None)
-        if chat_session_data is None:
-            return f"Chat session with ID {session_key} not found"
-        if chat_session_data["user"] != user_owner:
-            return f"Chat session with ID {session_key} not found for this user"
-
-        chat_session = chat_session_data["chat"]
-        if chat_session is None:
-            return f"Chat session with ID {session_key} has no chat data"
-
-        return chat_session.memory_as_text()
-
-
 class ChatOptions(BaseModel):
     category: str = None
     in_chunks: bool = False
@@ -435,14 +709,53 @@ class ChatManager:
     def __init__(
         self,
         config_service: ConfigService,
-        chat_session_memory: ServerChatSessionMemory,
+        chat_session_memory: ChatSessionStore,
         llm_chat_factory: ChatClientFactory,
         knowledge_manager: KnowledgeManager,
+        concurrent_requests: str = ChatSessionStoreConfig.QUEUE,
     ):
         self.config_service = config_service
         self.chat_session_memory = chat_session_memory
         self.llm_chat_factory = llm_chat_factory
         self.knowledge_manager = knowledge_manager
+        self.query_rewriter = self._create_query_rewriter()
+        self.memory_compaction_config = config_service.load_memory_compaction_config()
+        # one for all sessions, so the metrics cover the whole process
+        self.telemetry = ChatTelemetry()
+        self.chat_session_memory.set_chat_restorer(self.restore_chat)
+        self.concurrent_requests = concurrent_requests
+        self.session_locks = SessionLocks()
+
+    def _create_query_rewriter(self) -> QueryRewriter:
+        query_rewrite_config = self.config_service.load_query_rewrite_config()
+        small_model_chat_client = None
+        if query_rewrite_config.strategy == QueryRewriteConfig.SMALL_MODEL:
+            small_model_chat_client = self.llm_chat_factory.new_chat_client(
+                self.config_service.get_model(query_rewrite_config.model), QUERY_REWRITE
+            )
+        # one rewriter for all sessions, so its latency stats cover the whole process
+        return create_query_rewriter(
+            query_rewrite_config, small_model_chat_client, QueryRewriteStats()
+        )
+
+    def check_rate_limit(self, model_config: ModelConfig) -> None:
+        """Raises RateLimitExceeded if a new chat message for the model would wait too long for its turn."""
+        self.llm_chat_factory.check_rate_limit(model_config)
+
+    def get_http_pool_stats(self) -> dict:
+        return self.llm_chat_factory.get_http_pool_stats()
+
+    def get_model_latency_stats(self) -> dict:
+        return self.llm_chat_factory.get_latency_stats()
+
+    def get_memory_report(self) -> dict:
+        return self.chat_session_memory.memory_report()
+
+    def get_metrics_text(self) -> str:
+        """The chat and model metrics in the Prometheus text format."""
+        return self.telemetry.to_prometheus(
+            self.llm_chat_factory.latency_stats, self.chat_session_memory.stats()
+        )
 
     def clear_session(self, session_id: str):
         self.chat_session_memory.delete_entry(session_id)
@@ -450,6 +763,114 @@ class ChatManager:
     def get_session(self, chat_session_key_value):
         return self.chat_session_memory.get_chat(chat_session_key_value)
 
+    def session_turn(
+        self, session_key: str, chat_session: HaivenBaseChat
+    ) -> "ChatSessionTurn":
+        """
+        Claims a turn of a chat session, to run after the turns claimed before it. Call it when the
+        request arrives, right after streaming_chat or json_chat, and run the turn with `async with`
+        when the answer streams. A turn that never runs has to be given up with release().
+        """
+        if self.concurrent_requests == ChatSessionStoreConfig.REJECT:
+            # checked again here, a turn of the session may have been claimed since streaming_chat
+            claim = self.session_locks.try_claim(session_key)
+            if claim is None:
+                raise SessionBusy(session_key)
+        else:
+            claim = self.session_locks.claim(session_key)
+        return ChatSessionTurn(claim, chat_session, self.get_session)
+
+    def _claim_session(
+        self, session_key: str, chat_session: HaivenBaseChat, user_identifier: str
+    ):
+        if not self.session_locks.is_busy(session_key):
+            return session_key, chat_session
+        if self.concurrent_requests == ChatSessionStoreConfig.REJECT:
+            raise SessionBusy(session_key)
+        if self.concurrent_requests == ChatSessionStoreConfig.FORK:
+            return self._fork_session(chat_session, user_identifier)
+        return session_key, chat_session
+
+    def _fork_session(self, chat_session: HaivenBaseChat, user_identifier: str):
+        state = chat_session.to_state()
+        state["memory"] = serialize_messages(chat_session.completed_memory())
+        forked_key = self.chat_session_memory.add_new_entry(
+            chat_session.category, user_identifier
+        )
+        forked_chat = self.restore_chat(state)
+        self.chat_session_memory.store_chat(forked_key, forked_chat)
+        HaivenLogger.get().info(
+            f"Forked chat session {forked_key}, the session it continues is still answering",
+            extra={"INFO": "ChatSessionForked"},
+        )
+        return forked_key, forked_chat
+
+    def restore_chat(self, state: dict) -> HaivenBaseChat:
+        """Recreates a chat from the state a serializing session store saved with HaivenBaseChat.to_state."""
+        model = state["model"]
+        try:
+            model_config = self.config_service.get_model(model["id"])
+        except ValueError:
+            # models set up per request, like the one for grounded prompts, are not in the config
+            model_config = ModelConfig(model["id"], model["provider"], model["name"])
+        options = ChatOptions(
+            category=state.get("category"),
+            in_chunks=state.get("stream_in_chunks", False),
+        )
+        if state["chat_type"] == JSONChat.__name__:
+            chat = self._new_json_chat(model_config, options)
+        else:
+            chat = self._new_streaming_chat(model_config, options)
+        # the system message in the memory already has the contexts of the chat
+        chat.memory = deserialize_messages(state["memory"])
+        return chat
+
+    def _new_streaming_chat(
+        self,
+        model_config: ModelConfig,
+        options: ChatOptions = None,
+        contexts: List[str] = None,
+        user_context: str = None,
+    ) -> StreamingChat:
+        chat_client = self.llm_chat_factory.new_chat_client(
+            model_config, TEXT_GENERATION
+        )
+        return StreamingChat(
+            chat_client,
+            self.knowledge_manager,
+            stream_in_chunks=options.in_chunks if options else False,
+            contexts=contexts,
+            user_context=user_context,
+            query_rewriter=self.query_rewriter,
+            memory_compactor=create_memory_compactor(
+                self.memory_compaction_config, model_config, chat_client
+            ),
+            telemetry=self.telemetry,
+            category=options.category if options else None,
+        )
+
+    def _new_json_chat(
+        self,
+        model_config: ModelConfig,
+        options: ChatOptions = None,
+        contexts: List[str] = None,
+        user_context: str = None,
+    ) -> JSONChat:
+        chat_client = self.llm_chat_factory.new_chat_client(
+            model_config, TEXT_GENERATION
+        )
+        return JSONChat(
+            chat_client,
+            self.knowledge_manager,
+            contexts=contexts,
+            user_context=user_context,
+            memory_compactor=create_memory_compactor(
+                self.memory_compaction_config, model_config, chat_client
+            ),
+            telemetry=self.telemetry,
+            category=options.category if options else None,
+        )
+
     def streaming_chat(
         self,
         model_config: ModelConfig,
@@ -459,20 +880,21 @@ class ChatManager:
         user_context: str = None,
     ):
         def create_chat():
-            return StreamingChat(
-                self.llm_chat_factory.new_chat_client(model_config),
-                self.knowledge_manager,
-                stream_in_chunks=options.in_chunks if options else False,
-                contexts=contexts,
-                user_context=user_context,
+            return self._new_streaming_chat(
+                model_config, options, contexts, user_context
             )
 
-        return self.chat_session_memory.get_or_create_chat(
+        session_key, chat_session = self.chat_session_memory.get_or_create_chat(
             create_chat,
             session_id,
             options.category if options else "streaming",
             options.user_identifier if options else "unknown",
         )
+        return self._claim_session(
+            session_key,
+            chat_session,
+            options.user_identifier if options else "unknown",
+        )
 
     def json_chat(
         self,
@@ -483,16 +905,53 @@ class ChatManager:
         user_context: str = None,
     ):
         def create_chat():
-            return JSONChat(
-                self.llm_chat_factory.new_chat_client(model_config),
-                self.knowledge_manager,
-                contexts=contexts,
-                user_context=user_context,
-            )
+            return self._new_json_chat(model_config, options, contexts, user_context)
 
-        return self.chat_session_memory.get_or_create_chat(
+        session_key, chat_session = self.chat_session_memory.get_or_create_chat(
             create_chat,
             session_id,
             options.category if options else "json",
             options.user_identifier if options else "unknown",
         )
+        return self._claim_session(
+            session_key,
+            chat_session,
+            options.user_identifier if options else "unknown",
+        )
+
+
+class ChatSessionTurn:
+    """
+    A claimed turn of a chat session, run with `async with`. release() gives up the claim of a
+    turn that never ran, and does nothing once the turn has run.
+    """
+
+    def __init__(
+        self,
+        claim: SessionClaim,
+        chat_session: HaivenBaseChat,
+        get_session: Callable[[str], HaivenBaseChat],
+    ):
+        self.claim = claim
+        self._chat_session = chat_session
+        self._get_session = get_session
+
+    async def __aenter__(self):
+        try:
+            waited = await self.claim.acquire()
+            if waited:
+                # serializing session stores recreate the chat on every request, so this one
+                # does not have the messages of the turns it waited for yet
+                self._chat_session.memory = self._get_session(
+                    self.claim.session_key
+                ).memory
+        except BaseException:
+            self.claim.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.claim.release()
+
+    def release(self):
+        self.claim.release()
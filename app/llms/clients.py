@@ -1,23 +1,79 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
 import json
 import os
+import sys
+import time
+from functools import partial
 from typing import List, Dict, Any, Optional
 from config_service import ConfigService
 from llms.model_config import ModelConfig
 from pydantic import BaseModel
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, BaseMessage
-from llms.litellm_wrapper import llmCompletion
-
-
-class HaivenMessage(BaseModel):
-    content: str
+from llms.litellm_wrapper import llmCompletion, llmCompletionAsync
+from llms.prompt_prefix import to_json_messages
+from llms.completion_cache import (
+    CompletionCache,
+    completion_cache_key,
+    create_completion_cache,
+    replay_chunks,
+)
+from llms.http_pool import HttpPools
+from llms.latency_stats import ProviderLatencyStats
+from llms.model_routing import RoutedChatClient
+from llms.rate_limit import RateLimiter
+from llms.token_counter import (
+    TokenCounter,
+    estimate_tokens,
+    estimate_tokens_of_length,
+)
+from logger import HaivenLogger
+
+# how a stream ends when its consumer stops reading it, e.g. because the client disconnected:
+# a closed generator raises GeneratorExit at its yield, a cancelled task CancelledError at its await
+STREAM_ABORTED = (GeneratorExit, asyncio.CancelledError)
+
+
+class HaivenMessage:
+    """
+    A message of a chat session. Sessions keep all their messages in memory for as long as they live,
+    so this is a plain class with __slots__ instead of a Pydantic model.
+    """
+
+    __slots__ = ("content",)
+
+    def __init__(self, content: str):
+        self.content = content
 
     def to_json(self) -> dict:
         # Default implementation - subclasses should override with proper role
         return {"content": self.content, "role": "user"}
 
+    def to_dict(self) -> dict:
+        """The fields of the message, leaving out those with their default value."""
+        return {"content": self.content}
+
+    def footprint_bytes(self) -> int:
+        """The memory the message takes in its session, not counting text shared with other sessions."""
+        return sys.getsizeof(self.content)
+
+    def shared_texts(self) -> List[str]:
+        """The texts of the message that are shared with other sessions."""
+        return []
+
+    def __eq__(self, other) -> bool:
+        return type(other) is type(self) and other.to_dict() == self.to_dict()
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self})"
+
+    def __str__(self) -> str:
+        return f"content={self.content!r}"
+
 
 class HaivenAIMessage(HaivenMessage):
+    __slots__ = ()
+
     def to_json(self) -> dict:
         # TODO: Is it really always "assistant", for all APIs? ...
         return {"content": self.content, "role": "assistant"}
@@ -27,17 +83,62 @@ class HaivenAIMessage(HaivenMessage):
 
 
 class HaivenHumanMessage(HaivenMessage):
+    # state_snapshot: Whether the message carries the complete current state of the session, which supersedes the state sent before
+    __slots__ = ("state_snapshot",)
+
+    def __init__(self, content: str, state_snapshot: bool = False):
+        super().__init__(content)
+        self.state_snapshot = state_snapshot
+
     def to_json(self) -> dict:
         return {"content": self.content, "role": "user"}
 
+    def to_dict(self) -> dict:
+        data = super().to_dict()
+        if self.state_snapshot:
+            data["state_snapshot"] = True
+        return data
+
     def to_langchain(self) -> BaseMessage:
         return HumanMessage(content=self.content)
 
 
 class HaivenSystemMessage(HaivenMessage):
+    # segments: The parts of the content that stay the same across requests, in order, so providers can cache them.
+    # The content is the segments joined, it is built from them when only the segments are given
+    __slots__ = ("segments",)
+
+    def __init__(self, content: str = None, segments: Optional[List[str]] = None):
+        if content is None:
+            content = "".join(segments)
+        if segments is not None:
+            # the system prompt and knowledge contexts are the same for many sessions, interning lets
+            # them all reference one copy of the text instead of each keeping its own
+            content = sys.intern(content)
+            segments = [sys.intern(segment) for segment in segments]
+        super().__init__(content)
+        self.segments = segments
+
     def to_json(self) -> dict:
         return {"content": self.content, "role": "system"}
 
+    def to_dict(self) -> dict:
+        if self.segments is not None:
+            # the content is rebuilt from the segments, so the texts are stored once
+            return {"segments": self.segments}
+        return super().to_dict()
+
+    def footprint_bytes(self) -> int:
+        if self.segments is not None:
+            # only the list of references to the shared texts belongs to the session
+            return sys.getsizeof(self.segments)
+        return super().footprint_bytes()
+
+    def shared_texts(self) -> List[str]:
+        if self.segments is not None:
+            return [self.content, *self.segments]
+        return []
+
     def to_langchain(self) -> BaseMessage:
         return SystemMessage(content=self.content)
 
@@ -81,7 +182,7 @@ class MockModelClient:
                 ' "title": ',
                 ' "Mock scenario 1"',
                 ', "summary": ',
-                ' "scenario description" ' " }, { ",
+                ' "scenario description"  }, { ',
                 ' "title": ',
                 ' "Hello scenario 2" }',
                 json.dumps(full_test_scenario),
@@ -98,10 +199,46 @@ class MockModelClient:
                 result.usage = mock_usage
             yield result
 
+    async def acompletion(self, messages, model=None, **kwargs):
+        async def results():
+            for result in self.completion(messages, model=model, **kwargs):
+                yield result
+
+        return results()
+
+
+class _StreamState:
+    # What a streamed model response reports besides its content, collected while reading the chunks
+    def __init__(self):
+        self.citations = None
+        self.usage_data = None
+        self.estimated_prompt_tokens = None
+        self.started_at = time.monotonic()
+        self.first_chunk_sent = False
+        self.content_chars = 0
+
 
 class ChatClient:
-    def __init__(self, model_config: ModelConfig):
+    def __init__(
+        self,
+        model_config: ModelConfig,
+        rate_limiter: RateLimiter = None,
+        http_pools: HttpPools = None,
+        completion_cache: CompletionCache = None,
+        token_counter: TokenCounter = None,
+        latency_stats: ProviderLatencyStats = None,
+    ):
         self.model_config = model_config
+        self.rate_limiter = rate_limiter
+        self.http_pools = http_pools
+        self.completion_cache = completion_cache
+        self.token_counter = token_counter
+        self.latency_stats = latency_stats
+
+    @property
+    def answered_by(self) -> ModelConfig:
+        """The model that answers the streams of this client, see RoutedChatClient.answered_by."""
+        return self.model_config
 
     def _get_kwargs(self) -> dict:
         if self.model_config.provider == "ollama":
@@ -109,55 +246,230 @@ class ChatClient:
         else:
             return {}
 
+    def count_tokens(self, text: str) -> int:
+        if self.token_counter is None:
+            return estimate_tokens(text)
+        return self.token_counter.count_text(text, self.model_config)
+
+    def remaining_input_tokens(self, messages: List[HaivenMessage]) -> Optional[int]:
+        """How many more prompt tokens the model accepts besides the messages, None if its limit is unknown."""
+        if self.token_counter is None:
+            return None
+        max_input_tokens = self.token_counter.max_input_tokens(self.model_config)
+        if max_input_tokens is None:
+            return None
+        return max_input_tokens - self.token_counter.count_messages(
+            messages, self.model_config
+        )
+
     def stream(self, messages: List[HaivenMessage], mock: bool = False):
-        json_messages = [message.to_json() for message in messages]
+        cache_key = self._completion_cache_key(messages)
+        cached_chunks = self._cached_chunks(cache_key)
+        if cached_chunks is not None:
+            yield from cached_chunks
+            return
+
+        chunks = []
+        for chunk in self._stream_from_model(messages):
+            chunks.append(chunk)
+            yield chunk
+        self._cache_chunks(cache_key, chunks)
+
+    async def astream(self, messages: List[HaivenMessage]):
+        """
+        Same chunks as stream(), but awaits the model response instead of blocking a thread while
+        waiting for it, so many concurrent streams can be served from the event loop.
+        """
+        cache_key = self._completion_cache_key(messages)
+        cached_chunks = self._cached_chunks(cache_key)
+        if cached_chunks is not None:
+            for chunk in cached_chunks:
+                yield chunk
+            return
+
+        chunks = []
+        async for chunk in self._astream_from_model(messages):
+            chunks.append(chunk)
+            yield chunk
+        self._cache_chunks(cache_key, chunks)
+
+    def _stream_from_model(self, messages: List[HaivenMessage]):
         if os.environ.get("MOCK_AI", False):
             completion_fn = MockModelClient().completion
         else:
-            completion_fn = llmCompletion
-
-        citations = None
-        usage_data = None
-        for result in completion_fn(
-            model=self.model_config.lite_id,
-            messages=json_messages,
-            stream=True,
-            stream_options={"include_usage": True},
+            completion_fn = partial(
+                llmCompletion,
+                rate_limiter=self.rate_limiter,
+                **self._http_pool_kwargs(is_async=False),
+            )
+
+        stream_state = _StreamState()
+        stream_state.estimated_prompt_tokens = self._check_context_window(messages)
+        response = None
+        try:
+            response = completion_fn(**self._completion_kwargs(messages))
+            for result in response:
+                chunk = self._read_result(result, stream_state)
+                if chunk is not None:
+                    self._record_first_chunk(stream_state)
+                    yield chunk
+        except STREAM_ABORTED:
+            if hasattr(response, "close"):
+                response.close()
+            self._log_aborted_stream(stream_state)
+            raise
+        except Exception:
+            self._record_failure(stream_state)
+            raise
+
+        yield from self._final_chunks(stream_state)
+
+    async def _astream_from_model(self, messages: List[HaivenMessage]):
+        if os.environ.get("MOCK_AI", False):
+            completion_fn = MockModelClient().acompletion
+        else:
+            completion_fn = partial(
+                llmCompletionAsync,
+                rate_limiter=self.rate_limiter,
+                **self._http_pool_kwargs(is_async=True),
+            )
+
+        stream_state = _StreamState()
+        stream_state.estimated_prompt_tokens = self._check_context_window(messages)
+        response = None
+        try:
+            response = await completion_fn(**self._completion_kwargs(messages))
+            async for result in response:
+                chunk = self._read_result(result, stream_state)
+                if chunk is not None:
+                    self._record_first_chunk(stream_state)
+                    yield chunk
+        except STREAM_ABORTED:
+            # closes the connection to the provider, which stops generating the response
+            if hasattr(response, "aclose"):
+                await response.aclose()
+            self._log_aborted_stream(stream_state)
+            raise
+        except Exception:
+            self._record_failure(stream_state)
+            raise
+
+        for chunk in self._final_chunks(stream_state):
+            yield chunk
+
+    def _record_first_chunk(self, stream_state: "_StreamState") -> None:
+        if stream_state.first_chunk_sent:
+            return
+        stream_state.first_chunk_sent = True
+        if self.latency_stats is not None:
+            self.latency_stats.record_first_chunk(
+                self.model_config.provider.lower(),
+                (time.monotonic() - stream_state.started_at) * 1000,
+            )
+
+    def _log_aborted_stream(self, stream_state: "_StreamState") -> None:
+        # the provider only reports the usage at the end of the response, so it is estimated here
+        completion_tokens = estimate_tokens_of_length(stream_state.content_chars)
+        HaivenLogger.get().info(
+            f"Stopped streaming {self.model_config.lite_id} after about {completion_tokens} tokens, nobody reads the response anymore",
+            extra={
+                "INFO": "ModelStreamAborted",
+                "model": self.model_config.lite_id,
+                "estimatedPromptTokens": stream_state.estimated_prompt_tokens,
+                "estimatedCompletionTokens": completion_tokens,
+            },
+        )
+
+    def _record_failure(self, stream_state: "_StreamState") -> None:
+        # only failures before the first chunk count, those are the ones a fallback model can make up for
+        if not stream_state.first_chunk_sent and self.latency_stats is not None:
+            self.latency_stats.record_failure(self.model_config.provider.lower())
+
+    def _check_context_window(self, messages: List[HaivenMessage]) -> Optional[int]:
+        # fails before the request is sent if the provider would reject it anyway
+        if self.token_counter is None:
+            return None
+        return self.token_counter.check_context_window(messages, self.model_config)
+
+    def _completion_cache_key(self, messages: List[HaivenMessage]) -> Optional[str]:
+        if self.completion_cache is None:
+            return None
+        return completion_cache_key(
+            self.model_config.lite_id, [message.to_json() for message in messages]
+        )
+
+    def _cached_chunks(self, cache_key: Optional[str]) -> Optional[List[dict]]:
+        if cache_key is None:
+            return None
+        chunks = self.completion_cache.get(cache_key)
+        if chunks is None:
+            return None
+        HaivenLogger.get().info(
+            f"Replaying cached response of {self.model_config.lite_id}",
+            extra={"INFO": "CompletionCacheHit", "model": self.model_config.lite_id},
+        )
+        return replay_chunks(chunks)
+
+    def _cache_chunks(self, cache_key: Optional[str], chunks: List[dict]) -> None:
+        # only complete responses with content get here, streams that failed or were abandoned do not
+        if cache_key is not None and any("content" in chunk for chunk in chunks):
+            self.completion_cache.put(cache_key, chunks)
+
+    def _completion_kwargs(self, messages: List[HaivenMessage]) -> dict:
+        return {
+            "model": self.model_config.lite_id,
+            "messages": to_json_messages(messages, self.model_config),
+            "stream": True,
+            "stream_options": {"include_usage": True},
             **self._get_kwargs(),
-        ):
-            # Handle different response types safely
-            try:
-                if isinstance(result, dict):
-                    citations = citations or result.get("citations", None)
-                    if self._is_token_usage_result(result):
-                        usage_data = result.get("usage")
-                else:
-                    # Handle object-like responses
-                    if hasattr(result, "usage") and getattr(result, "usage", None):
-                        usage_data = getattr(result, "usage")
-                    if hasattr(result, "get"):
-                        citations = citations or getattr(result, "get")(
-                            "citations", None
-                        )
-
-                # Extract content from streaming response
-                if hasattr(result, "choices") and getattr(result, "choices", None):
-                    choices = getattr(result, "choices")
-                    if choices and len(choices) > 0 and hasattr(choices[0], "delta"):
-                        delta = getattr(choices[0], "delta")
-                        if (
-                            hasattr(delta, "content")
-                            and getattr(delta, "content") is not None
-                        ):
-                            yield {"content": getattr(delta, "content")}
-            except (AttributeError, TypeError, IndexError):
-                # Skip malformed responses
-                continue
+        }
 
-        if citations is not None:
-            yield {"metadata": {"citations": citations}}
+    def _http_pool_kwargs(self, is_async: bool) -> dict:
+        if self.http_pools is None:
+            return {}
+        return self.http_pools.completion_kwargs(self.model_config, is_async)
+
+    def _read_result(self, result, stream_state: "_StreamState") -> Optional[dict]:
+        # Handle different response types safely
+        try:
+            if isinstance(result, dict):
+                stream_state.citations = stream_state.citations or result.get(
+                    "citations", None
+                )
+                if self._is_token_usage_result(result):
+                    stream_state.usage_data = result.get("usage")
+            else:
+                # Handle object-like responses
+                if hasattr(result, "usage") and getattr(result, "usage", None):
+                    stream_state.usage_data = getattr(result, "usage")
+                if hasattr(result, "get"):
+                    stream_state.citations = stream_state.citations or getattr(
+                        result, "get"
+                    )("citations", None)
+
+            # Extract content from streaming response
+            if hasattr(result, "choices") and getattr(result, "choices", None):
+                choices = getattr(result, "choices")
+                if choices and len(choices) > 0 and hasattr(choices[0], "delta"):
+                    delta = getattr(choices[0], "delta")
+                    if (
+                        hasattr(delta, "content")
+                        and getattr(delta, "content") is not None
+                    ):
+                        content = getattr(delta, "content")
+                        stream_state.content_chars += len(content)
+                        return {"content": content}
+        except (AttributeError, TypeError, IndexError):
+            # Skip malformed responses
+            pass
+        return None
+
+    def _final_chunks(self, stream_state: "_StreamState"):
+        if stream_state.citations is not None:
+            yield {"metadata": {"citations": stream_state.citations}}
 
         # Yield usage data if available - simplified
+        usage_data = stream_state.usage_data
         if usage_data is not None:
             # Simple normalization - just extract basic fields
             try:
@@ -165,7 +477,12 @@ class ChatClient:
                     "prompt_tokens": getattr(usage_data, "prompt_tokens", 0),
                     "completion_tokens": getattr(usage_data, "completion_tokens", 0),
                     "total_tokens": getattr(usage_data, "total_tokens", 0),
+                    **_prompt_cache_usage(usage_data),
                 }
+                if stream_state.estimated_prompt_tokens is not None:
+                    normalized_usage["estimated_prompt_tokens"] = (
+                        stream_state.estimated_prompt_tokens
+                    )
                 yield {"usage": normalized_usage}
             except Exception:
                 # If we can't extract, just provide zeros
@@ -207,7 +524,90 @@ class ChatClient:
 class ChatClientFactory:
     def __init__(self, config_service: ConfigService):
         self.config_service = config_service
+        # shared by all chat clients, so the rate limit of a model covers every session using it
+        self.rate_limiter = RateLimiter(config_service.load_rate_limit_config())
+        # shared by all chat clients, so sessions reuse the open connections to a provider
+        self.http_pools = HttpPools(config_service.load_http_pool_config())
+        # None unless enabled in the config
+        self.completion_cache = create_completion_cache(
+            config_service.load_completion_cache_config()
+        )
+        # shared by all chat clients, so token encodings are loaded once
+        self.token_counter = TokenCounter()
+        # shared by all chat clients, so the latencies cover every request to a provider
+        self.latency_stats = ProviderLatencyStats()
+        self.model_routing_config = config_service.load_model_routing_config()
 
     # Factory method gives us some extra control over how the ChatClients are created
-    def new_chat_client(self, model: ModelConfig) -> ChatClient:
-        return ChatClient(model_config=model)
+    def new_chat_client(self, model: ModelConfig, feature: str):
+        """
+        A chat client for the model, which fails over to the fallback models configured for the feature
+        it is used for, e.g. "text-generation" or "query-rewrite", if there are any.
+        """
+        chat_client = self._new_model_client(model)
+        route = self.model_routing_config.route(feature)
+        fallback_clients = [
+            self._new_model_client(fallback_model)
+            for fallback_model in self._fallback_models(model, route.fallback_models)
+        ]
+        if not fallback_clients:
+            return chat_client
+        return RoutedChatClient(
+            [chat_client] + fallback_clients,
+            hedge_after_seconds=route.hedge_after_ms / 1000,
+        )
+
+    def _new_model_client(self, model: ModelConfig) -> ChatClient:
+        self.rate_limiter.configure_model(model)
+        return ChatClient(
+            model_config=model,
+            rate_limiter=self.rate_limiter,
+            http_pools=self.http_pools,
+            completion_cache=self.completion_cache,
+            token_counter=self.token_counter,
+            latency_stats=self.latency_stats,
+        )
+
+    def _fallback_models(
+        self, model: ModelConfig, fallback_model_ids: List[str]
+    ) -> List[ModelConfig]:
+        fallback_models = []
+        for model_id in fallback_model_ids:
+            if model_id == model.id:
+                continue
+            try:
+                fallback_models.append(self.config_service.get_model(model_id))
+            except ValueError as error:
+                # e.g. a model of a provider that is not enabled in this deployment
+                HaivenLogger.get().warn(
+                    f"Skipping fallback model {model_id}: {error}",
+                    extra={"INFO": "FallbackModelUnavailable"},
+                )
+        return fallback_models
+
+    def get_latency_stats(self) -> dict:
+        return self.latency_stats.get_stats()
+
+    def get_http_pool_stats(self) -> dict:
+        return self.http_pools.get_stats()
+
+    def check_rate_limit(self, model: ModelConfig) -> None:
+        """Raises RateLimitExceeded if a new request for the model would wait too long for its turn."""
+        self.rate_limiter.configure_model(model)
+        self.rate_limiter.check_admission(model.lite_id)
+
+
+def _prompt_cache_usage(usage_data) -> dict:
+    # OpenAI, Azure and Gemini report cache reads in the prompt token details,
+    # Anthropic reports reads and writes as separate input token counts
+    details = getattr(usage_data, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or getattr(
+        usage_data, "cache_read_input_tokens", None
+    )
+    return {
+        "cached_tokens": cached_tokens or 0,
+        "cache_creation_tokens": getattr(
+            usage_data, "cache_creation_input_tokens", None
+        )
+        or 0,
+    }
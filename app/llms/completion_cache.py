@@ -0,0 +1,178 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, List, Optional
+
+from embeddings.cache import LRUCache
+from llms.completion_cache_config import CompletionCacheConfig
+
+
+def completion_cache_key(lite_id: str, json_messages: List[dict]) -> str:
+    messages_json = json.dumps(
+        json_messages, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return f"{lite_id}:{hashlib.sha256(messages_json.encode('utf-8')).hexdigest()}"
+
+
+def replay_chunks(chunks: List[dict]) -> List[dict]:
+    """
+    The chunks of a cached response as they are streamed again, with the token usage marked as
+    cached. A response that was stored without usage still gets a cached usage chunk with zero tokens.
+    """
+    replayed = [chunk for chunk in chunks if "usage" not in chunk]
+    usage = next((chunk["usage"] for chunk in chunks if "usage" in chunk), None) or {
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "total_tokens": 0,
+    }
+    replayed.append({"usage": {**usage, "cached": True}})
+    return replayed
+
+
+class CompletionCache(ABC):
+    """
+    Stores the chunks of complete model responses by model and request, so byte-identical
+    requests can be answered without calling the model again.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[List[dict]]:
+        pass
+
+    @abstractmethod
+    def put(self, key: str, chunks: List[dict]) -> None:
+        pass
+
+    @abstractmethod
+    def stats(self) -> dict:
+        pass
+
+
+class InMemoryCompletionCache(CompletionCache):
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl_seconds: float = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._cache = LRUCache(max_entries, ttl_seconds, clock)
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        chunks = self._cache.get(key)
+        return list(chunks) if chunks is not None else None
+
+    def put(self, key: str, chunks: List[dict]) -> None:
+        self._cache.put(key, tuple(chunks))
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+class SqliteCompletionCache(CompletionCache):
+    """
+    Keeps the cached responses in a local SQLite file, so they survive restarts. Entries are evicted
+    by their TTL and, beyond max_entries, by least recent use.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 1000,
+        ttl_seconds: float = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, chunks TEXT NOT NULL, "
+                "stored_at REAL NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS completions_used_at ON completions (used_at)"
+            )
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        now = self._clock()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT chunks, stored_at FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self._is_expired(row[1], now):
+                self._connection.execute(
+                    "DELETE FROM completions WHERE key = ?", (key,)
+                )
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute(
+                "UPDATE completions SET used_at = ? WHERE key = ?", (now, key)
+            )
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key: str, chunks: List[dict]) -> None:
+        if self.max_entries <= 0:
+            return
+        now = self._clock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO completions (key, chunks, stored_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(chunks), now, now),
+            )
+            if self.ttl_seconds is not None:
+                self._connection.execute(
+                    "DELETE FROM completions WHERE stored_at < ?",
+                    (now - self.ttl_seconds,),
+                )
+            self._connection.execute(
+                "DELETE FROM completions WHERE key IN ("
+                "SELECT key FROM completions ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = self._connection.execute(
+                "SELECT COUNT(*) FROM completions"
+            ).fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "size": size,
+                "max_size": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def _is_expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - stored_at > self.ttl_seconds
+
+
+def create_completion_cache(
+    config: CompletionCacheConfig,
+) -> Optional[CompletionCache]:
+    if not config.enabled:
+        return None
+    if config.backend == CompletionCacheConfig.SQLITE:
+        return SqliteCompletionCache(
+            config.path, config.max_entries, config.ttl_seconds
+        )
+    return InMemoryCompletionCache(config.max_entries, config.ttl_seconds)
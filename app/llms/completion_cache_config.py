@@ -0,0 +1,52 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from config_values import to_bool, to_int
+
+
+class CompletionCacheConfig:
+    """
+    Settings for replaying model responses to byte-identical requests instead of calling the model again.
+
+    Attributes:
+        enabled (bool): Whether responses are cached at all. Off by default, since a cached answer
+            never varies, which is only wanted for deterministic prompt flows.
+        backend (str): "memory" keeps the responses in the process, "sqlite" in a local database file
+            that survives restarts and is shared by processes on the same machine.
+        path (str): The database file of the "sqlite" backend.
+        max_entries (int): How many responses are kept at most, the least recently used are evicted first.
+        ttl_seconds (int): How long a response is replayed before the model is asked again.
+    """
+
+    MEMORY = "memory"
+    SQLITE = "sqlite"
+
+    BACKENDS = [MEMORY, SQLITE]
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        backend: str = MEMORY,
+        path: str = "completion_cache.sqlite",
+        max_entries: int = 1000,
+        ttl_seconds: int = 86400,
+    ):
+        backend = (backend or CompletionCacheConfig.MEMORY).lower()
+        if backend not in CompletionCacheConfig.BACKENDS:
+            raise ValueError(
+                f"Completion cache backend {backend} not supported, use one of {', '.join(CompletionCacheConfig.BACKENDS)}"
+            )
+        self.enabled = enabled
+        self.backend = backend
+        self.path = path or "completion_cache.sqlite"
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        return cls(
+            enabled=to_bool(data.get("enabled"), False),
+            backend=data.get("backend"),
+            path=data.get("path"),
+            max_entries=to_int(data.get("max_entries"), 1000),
+            ttl_seconds=to_int(data.get("ttl_seconds"), 86400),
+        )
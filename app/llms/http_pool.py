@@ -0,0 +1,272 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+import threading
+from typing import Dict, List, Optional, Set
+
+import httpx
+import litellm
+from litellm.llms.custom_httpx.http_handler import AsyncHTTPHandler, HTTPHandler
+
+from llms.http_pool_config import HttpPoolConfig
+from llms.model_config import ModelConfig
+from logger import HaivenLogger
+
+# LiteLLM calls these providers with its own HTTP handler, which it accepts per call as "client"
+HANDLER_PROVIDERS = {"aws", "anthropic", "gcp", "ollama"}
+# LiteLLM calls these providers through the OpenAI SDK, which uses the module wide litellm.client_session
+OPENAI_SDK_POOL = "openai_sdk"
+OPENAI_SDK_PROVIDERS = {"azure", "openai", "perplexity"}
+
+
+class HttpPoolStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.recycles = 0
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.requests += 1
+            self.consecutive_failures = 0
+
+    def record_failure(self) -> int:
+        with self._lock:
+            self.requests += 1
+            self.failures += 1
+            self.consecutive_failures += 1
+            return self.consecutive_failures
+
+    def record_recycle(self) -> None:
+        with self._lock:
+            self.recycles += 1
+            self.consecutive_failures = 0
+
+
+class _PooledClient(httpx.Client):
+    def __init__(self, pool: "ProviderHttpPool", **kwargs):
+        super().__init__(**kwargs)
+        self._http_pool = pool
+
+    def send(self, request, **kwargs):
+        try:
+            response = super().send(request, **kwargs)
+        except httpx.TransportError:
+            self._http_pool.record_failure()
+            raise
+        self._http_pool.stats.record_success()
+        return response
+
+
+class _AsyncPooledClient(httpx.AsyncClient):
+    def __init__(self, pool: "ProviderHttpPool", **kwargs):
+        super().__init__(**kwargs)
+        self._http_pool = pool
+
+    async def send(self, request, **kwargs):
+        try:
+            response = await super().send(request, **kwargs)
+        except httpx.TransportError:
+            self._http_pool.record_failure()
+            raise
+        self._http_pool.stats.record_success()
+        return response
+
+
+class _PooledAsyncHTTPHandler(AsyncHTTPHandler):
+    # AsyncHTTPHandler takes no client, it creates its own in its constructor through create_client
+    def __init__(self, client: httpx.AsyncClient, timeout: float):
+        self._pooled_client = client
+        super().__init__(timeout=timeout)
+        # the pool closes the client, not the handler
+        self._owns_client = False
+
+    def create_client(self, *args, **kwargs) -> httpx.AsyncClient:
+        return self._pooled_client
+
+
+class ProviderHttpPool:
+    """
+    The keep-alive HTTP connections to one model provider, shared by all chat sessions, with a sync
+    and an async client. When requests keep failing with connection errors, the pool is considered
+    unhealthy and its clients are closed and replaced on next use. The async client is closed on the
+    event loop, by the next call to async_client when the pool is recycled outside of one.
+    """
+
+    def __init__(self, name: str, config: HttpPoolConfig):
+        self.name = name
+        self.config = config
+        self.stats = HttpPoolStats()
+        self._lock = threading.Lock()
+        self._client: Optional[httpx.Client] = None
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._handler: Optional[HTTPHandler] = None
+        self._async_handler: Optional[AsyncHTTPHandler] = None
+        self._retired_async_clients: List[httpx.AsyncClient] = []
+        # the event loop only keeps weak references to its tasks
+        self._closing_tasks: Set[asyncio.Task] = set()
+
+    def client(self) -> httpx.Client:
+        with self._lock:
+            if self._client is None or self._client.is_closed:
+                self._client = _PooledClient(self, **self._client_kwargs())
+                self._handler = None
+            return self._client
+
+    def async_client(self) -> httpx.AsyncClient:
+        self._close_retired_async_clients()
+        with self._lock:
+            if self._async_client is None or self._async_client.is_closed:
+                self._async_client = _AsyncPooledClient(self, **self._client_kwargs())
+                self._async_handler = None
+            return self._async_client
+
+    def handler(self) -> HTTPHandler:
+        client = self.client()
+        with self._lock:
+            if self._handler is None:
+                self._handler = HTTPHandler(
+                    timeout=self.config.timeout_seconds, client=client
+                )
+            return self._handler
+
+    def async_handler(self) -> AsyncHTTPHandler:
+        client = self.async_client()
+        with self._lock:
+            if self._async_handler is None:
+                self._async_handler = _PooledAsyncHTTPHandler(
+                    client, timeout=self.config.timeout_seconds
+                )
+            return self._async_handler
+
+    def record_failure(self) -> None:
+        consecutive_failures = self.stats.record_failure()
+        if consecutive_failures >= self.config.max_consecutive_failures:
+            self.recycle()
+
+    def recycle(self) -> None:
+        self._close_clients()
+        self.stats.record_recycle()
+        HaivenLogger.get().warn(
+            f"Replaced the HTTP connection pool for {self.name} after repeated connection errors",
+            extra={"INFO": "HttpPoolRecycled", "pool": self.name},
+        )
+
+    def close(self) -> None:
+        self._close_clients()
+
+    def _close_clients(self) -> None:
+        with self._lock:
+            client, async_client = self._client, self._async_client
+            self._client = None
+            self._async_client = None
+            self._handler = None
+            self._async_handler = None
+            if async_client is not None:
+                self._retired_async_clients.append(async_client)
+        if client is not None:
+            client.close()
+        self._close_retired_async_clients()
+
+    def _close_retired_async_clients(self) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # an async client can only be closed on an event loop
+            return
+        with self._lock:
+            async_clients = self._retired_async_clients
+            self._retired_async_clients = []
+        for async_client in async_clients:
+            task = loop.create_task(async_client.aclose())
+            self._closing_tasks.add(task)
+            task.add_done_callback(self._closing_tasks.discard)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            clients = [self._client, self._async_client]
+        connections = [
+            connection for client in clients for connection in _connections(client)
+        ]
+        return {
+            "requests": self.stats.requests,
+            "failures": self.stats.failures,
+            "consecutive_failures": self.stats.consecutive_failures,
+            "recycles": self.stats.recycles,
+            "open_connections": len(connections),
+            "idle_connections": len(
+                [connection for connection in connections if connection.is_idle()]
+            ),
+        }
+
+    def _client_kwargs(self) -> dict:
+        return {
+            "limits": httpx.Limits(
+                max_connections=self.config.max_connections,
+                max_keepalive_connections=self.config.max_keepalive_connections,
+                keepalive_expiry=self.config.keepalive_expiry_seconds,
+            ),
+            "timeout": self.config.timeout_seconds,
+            "follow_redirects": True,
+        }
+
+
+class HttpPools:
+    """
+    One pooled HTTP client per model provider, so chat sessions reuse open TLS connections
+    instead of negotiating new ones for every model call.
+    """
+
+    def __init__(self, config: HttpPoolConfig = None):
+        self.config = config or HttpPoolConfig()
+        self._lock = threading.Lock()
+        self._pools: Dict[str, ProviderHttpPool] = {}
+
+    def pool(self, name: str) -> ProviderHttpPool:
+        with self._lock:
+            pool = self._pools.get(name)
+            if pool is None:
+                pool = self._pools[name] = ProviderHttpPool(name, self.config)
+            return pool
+
+    def completion_kwargs(self, model_config: ModelConfig, is_async: bool) -> dict:
+        """The extra completion arguments that make LiteLLM use the pool of the model's provider."""
+        provider = model_config.provider.lower()
+        if provider in HANDLER_PROVIDERS:
+            pool = self.pool(provider)
+            return {"client": pool.async_handler() if is_async else pool.handler()}
+        if provider in OPENAI_SDK_PROVIDERS:
+            self._use_openai_sdk_pool(is_async)
+        return {}
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            pools = list(self._pools.values())
+        return {pool.name: pool.get_stats() for pool in pools}
+
+    def close(self) -> None:
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.close()
+
+    def _use_openai_sdk_pool(self, is_async: bool) -> None:
+        # LiteLLM caches its OpenAI SDK clients and hands them these sessions when creating them
+        pool = self.pool(OPENAI_SDK_POOL)
+        if is_async:
+            client = pool.async_client()
+            if litellm.aclient_session is not client:
+                litellm.aclient_session = client
+        else:
+            client = pool.client()
+            if litellm.client_session is not client:
+                litellm.client_session = client
+
+
+def _connections(client: Optional[httpx.Client]) -> list:
+    # httpx does not expose its connection pool publicly, so this reads it defensively
+    if client is None or client.is_closed:
+        return []
+    connection_pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    return list(getattr(connection_pool, "connections", []) or [])
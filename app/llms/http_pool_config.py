@@ -0,0 +1,51 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from config_values import to_float
+
+
+class HttpPoolConfig:
+    """
+    Settings for the pooled HTTP connections to the model providers.
+
+    Attributes:
+        max_connections (int): How many connections one provider pool may open at the same time.
+        max_keepalive_connections (int): How many idle connections one provider pool keeps open for reuse.
+        keepalive_expiry_seconds (float): How long an idle connection is kept open before it is closed.
+        timeout_seconds (float): Timeout for connecting to and reading from a provider.
+        max_consecutive_failures (int): After how many connection errors in a row a pool is considered
+            unhealthy and replaced by a fresh one.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry_seconds: float = 30.0,
+        timeout_seconds: float = 600.0,
+        max_consecutive_failures: int = 3,
+    ):
+        if max_connections < 1 or max_keepalive_connections < 0:
+            raise ValueError(
+                "HTTP pool needs max_connections >= 1 and max_keepalive_connections >= 0"
+            )
+        self.max_connections = max_connections
+        self.max_keepalive_connections = min(max_keepalive_connections, max_connections)
+        self.keepalive_expiry_seconds = keepalive_expiry_seconds
+        self.timeout_seconds = timeout_seconds
+        self.max_consecutive_failures = max_consecutive_failures
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        return cls(
+            max_connections=int(to_float(data.get("max_connections"), 100)),
+            max_keepalive_connections=int(
+                to_float(data.get("max_keepalive_connections"), 20)
+            ),
+            keepalive_expiry_seconds=to_float(
+                data.get("keepalive_expiry_seconds"), 30.0
+            ),
+            timeout_seconds=to_float(data.get("timeout_seconds"), 600.0),
+            max_consecutive_failures=int(
+                to_float(data.get("max_consecutive_failures"), 3)
+            ),
+        )
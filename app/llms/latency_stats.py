@@ -0,0 +1,96 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import bisect
+import copy
+import threading
+from typing import Dict, List, Tuple
+
+# upper bounds of the histogram buckets, in milliseconds
+DEFAULT_BUCKETS_MS = [100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+
+class LatencyHistogram:
+    """Counts latencies into fixed buckets, so percentiles can be estimated without keeping every value."""
+
+    def __init__(self, buckets_ms: List[float] = None):
+        self.buckets_ms = list(buckets_ms or DEFAULT_BUCKETS_MS)
+        # one more bucket for everything above the last bound
+        self.counts = [0] * (len(self.buckets_ms) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+
+    def record(self, latency_ms: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets_ms, latency_ms)] += 1
+        self.count += 1
+        self.sum_ms += latency_ms
+
+    def percentile(self, fraction: float) -> float:
+        """The upper bound of the bucket the percentile falls into, 0 without any values."""
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return (
+                    self.buckets_ms[index]
+                    if index < len(self.buckets_ms)
+                    else float("inf")
+                )
+        return float("inf")
+
+    def to_dict(self) -> dict:
+        bounds = [str(bound) for bound in self.buckets_ms] + ["+Inf"]
+        return {
+            "count": self.count,
+            "sum_ms": round(self.sum_ms, 1),
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "buckets": dict(zip(bounds, self.counts)),
+        }
+
+
+class ProviderLatencyStats:
+    """
+    How long each model provider takes to send the first chunk of a response, and how often its
+    requests fail before that, shared by all chat clients.
+    """
+
+    def __init__(self, buckets_ms: List[float] = None):
+        self.buckets_ms = buckets_ms
+        self._lock = threading.Lock()
+        self._first_chunk: Dict[str, LatencyHistogram] = {}
+        self._failures: Dict[str, int] = {}
+
+    def record_first_chunk(self, provider: str, latency_ms: float) -> None:
+        with self._lock:
+            histogram = self._first_chunk.get(provider)
+            if histogram is None:
+                histogram = self._first_chunk[provider] = LatencyHistogram(
+                    self.buckets_ms
+                )
+            histogram.record(latency_ms)
+
+    def record_failure(self, provider: str) -> None:
+        with self._lock:
+            self._failures[provider] = self._failures.get(provider, 0) + 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            providers = sorted(set(self._first_chunk) | set(self._failures))
+            return {
+                provider: {
+                    "first_chunk": (
+                        self._first_chunk[provider]
+                        if provider in self._first_chunk
+                        else LatencyHistogram(self.buckets_ms)
+                    ).to_dict(),
+                    "failures": self._failures.get(provider, 0),
+                }
+                for provider in providers
+            }
+
+    def snapshot(self) -> Tuple[Dict[str, LatencyHistogram], Dict[str, int]]:
+        """Copies of the first chunk histograms and the failure counts, by provider."""
+        with self._lock:
+            return copy.deepcopy(self._first_chunk), dict(self._failures)
@@ -1,13 +1,18 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
-from litellm import completion
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
-from litellm import RateLimitError
-
-
-@retry(
-    stop=stop_after_attempt(2),
-    wait=wait_fixed(60),
-    retry=retry_if_exception_type(RateLimitError),
-)
-def llmCompletion(**kwargs):
-    return completion(**kwargs)
+from litellm import acompletion, completion
+
+from llms.rate_limit import RateLimiter
+
+# used by callers without a rate limiter of their own, retries rate limit errors but does not throttle
+DEFAULT_RATE_LIMITER = RateLimiter()
+
+
+def llmCompletion(rate_limiter: RateLimiter = None, **kwargs):
+    return (rate_limiter or DEFAULT_RATE_LIMITER).call(completion, **kwargs)
+
+
+async def llmCompletionAsync(rate_limiter: RateLimiter = None, **kwargs):
+    # waits for the rate limit with asyncio.sleep, so a throttled call does not hold a worker thread
+    return await (rate_limiter or DEFAULT_RATE_LIMITER).call_async(
+        acompletion, **kwargs
+    )
@@ -0,0 +1,241 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from typing import Callable, ClassVar, List, Optional, Tuple
+
+from llms.clients import (
+    ChatClient,
+    HaivenHumanMessage,
+    HaivenMessage,
+    HaivenSystemMessage,
+)
+from llms.memory_compaction_config import MemoryCompactionConfig
+from llms.model_config import ModelConfig
+from llms.token_counter import MESSAGE_OVERHEAD_TOKENS, estimate_tokens
+from logger import HaivenLogger
+
+
+class ConversationSummary(HaivenSystemMessage):
+    """Stands in for the turns of a chat session that were dropped from its memory."""
+
+    __slots__ = ()
+
+    PREFIX: ClassVar[str] = "Summary of the earlier conversation:\n"
+
+    @classmethod
+    def of(cls, summary: str) -> "ConversationSummary":
+        return cls(content=cls.PREFIX + summary)
+
+    @property
+    def summary(self) -> str:
+        return self.content[len(self.PREFIX) :]
+
+
+class ModelMemorySummarizer:
+    """Summarizes dropped turns with the chat's own model."""
+
+    PROMPT = """Summarize the conversation below between a user and an AI assistant in at most {max_words} words.
+Keep the decisions, facts and constraints the user gave, and what the assistant produced, leave out the details.
+Only return the summary.
+
+{previous_summary}{conversation}"""
+
+    def __init__(self, chat_client: ChatClient, max_words: int = 200):
+        self.chat_client = chat_client
+        self.max_words = max_words
+
+    def summarize(
+        self, previous_summary: Optional[str], messages: List[HaivenMessage]
+    ) -> str:
+        conversation = "\n\n".join(
+            f"{message.to_json()['role']}: {message.content}" for message in messages
+        )
+        prompt = self.PROMPT.format(
+            max_words=self.max_words,
+            previous_summary=f"{previous_summary}\n\n" if previous_summary else "",
+            conversation=conversation,
+        )
+        chunks = self.chat_client.stream([HaivenHumanMessage(content=prompt)])
+        return "".join(
+            chunk.get("content") or "" for chunk in chunks if isinstance(chunk, dict)
+        ).strip()
+
+
+class MemoryCompactor:
+    """
+    Keeps the memory of a chat session under a prompt token budget before it is sent to the model.
+    The system message always stays. Whole turns - a user message and the replies to it - are dropped
+    from the oldest on, so the newest turns fit the budget, and are summarized if there is a summarizer.
+    The newest turn always stays, even if it does not fit on its own.
+
+    The same way, the memory can be kept under a byte budget, see HaivenMessage.footprint_bytes, so
+    long sessions cannot grow the memory of the server without bound.
+
+    Independent of the budgets, turns that sent the complete current state of the session (see
+    HaivenHumanMessage.state_snapshot) are dropped once a newer turn sends the state again.
+    """
+
+    def __init__(
+        self,
+        max_prompt_tokens: int = 0,
+        max_session_bytes: int = 0,
+        summarizer: ModelMemorySummarizer = None,
+        drop_superseded_state: bool = True,
+        token_counter: Callable[[str], int] = estimate_tokens,
+    ):
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_session_bytes = max_session_bytes
+        self.summarizer = summarizer
+        self.drop_superseded_state = drop_superseded_state
+        self.token_counter = token_counter
+
+    def compact(self, memory: List[HaivenMessage]) -> List[HaivenMessage]:
+        prefix, summary, turns = _split_turns(memory)
+        if not turns:
+            return memory
+
+        superseded = []
+        if self.drop_superseded_state:
+            turns, superseded = _drop_superseded_state(turns)
+
+        dropped = []
+        kept_before = prefix + ([summary] if summary is not None else [])
+        if self.max_prompt_tokens > 0:
+            turns, dropped = _fit_budget(
+                turns,
+                self.max_prompt_tokens - self.count_tokens(kept_before),
+                self.count_tokens,
+            )
+        if self.max_session_bytes > 0:
+            turns, dropped_for_bytes = _fit_budget(
+                turns,
+                self.max_session_bytes - count_bytes(kept_before),
+                count_bytes,
+            )
+            dropped += dropped_for_bytes
+        if dropped and self.summarizer is not None:
+            summary = self._summarize(summary, dropped)
+
+        if superseded or dropped:
+            HaivenLogger.get().info(
+                f"Compacted chat memory, dropped {len(superseded)} superseded and {len(dropped)} old turns",
+                extra={
+                    "INFO": "ChatMemoryCompacted",
+                    "supersededTurns": len(superseded),
+                    "droppedTurns": len(dropped),
+                    "summarized": bool(dropped) and self.summarizer is not None,
+                },
+            )
+
+        return (
+            prefix
+            + ([summary] if summary is not None else [])
+            + [message for turn in turns for message in turn]
+        )
+
+    def count_tokens(self, messages: List[HaivenMessage]) -> int:
+        return sum(
+            self.token_counter(message.content) + MESSAGE_OVERHEAD_TOKENS
+            for message in messages
+        )
+
+    def _summarize(
+        self,
+        summary: Optional[ConversationSummary],
+        dropped: List[List[HaivenMessage]],
+    ) -> Optional[ConversationSummary]:
+        try:
+            new_summary = self.summarizer.summarize(
+                summary.summary if summary is not None else None,
+                [message for turn in dropped for message in turn],
+            )
+        except Exception as error:
+            # the turns are dropped anyway, the chat goes on without their summary
+            HaivenLogger.get().warn(
+                f"Could not summarize the dropped chat turns: {error}",
+                extra={"INFO": "ChatMemorySummaryFailed"},
+            )
+            return summary
+        return ConversationSummary.of(new_summary) if new_summary else summary
+
+
+def count_bytes(messages: List[HaivenMessage]) -> int:
+    return sum(message.footprint_bytes() for message in messages)
+
+
+def _fit_budget(
+    turns: List[List[HaivenMessage]],
+    budget: int,
+    cost: Callable[[List[HaivenMessage]], int],
+) -> Tuple[List[List[HaivenMessage]], List[List[HaivenMessage]]]:
+    first_kept = len(turns) - 1
+    used = cost(turns[first_kept])
+    while first_kept > 0:
+        turn_cost = cost(turns[first_kept - 1])
+        if used + turn_cost > budget:
+            break
+        used += turn_cost
+        first_kept -= 1
+    return turns[first_kept:], turns[:first_kept]
+
+
+def create_memory_compactor(
+    config: MemoryCompactionConfig, model_config: ModelConfig, chat_client: ChatClient
+) -> Optional[MemoryCompactor]:
+    max_prompt_tokens = config.max_prompt_tokens_for(model_config)
+    if (
+        max_prompt_tokens <= 0
+        and config.max_session_bytes <= 0
+        and not config.drop_superseded_state
+    ):
+        return None
+    return MemoryCompactor(
+        max_prompt_tokens,
+        max_session_bytes=config.max_session_bytes,
+        summarizer=ModelMemorySummarizer(chat_client) if config.summarize else None,
+        drop_superseded_state=config.drop_superseded_state,
+        token_counter=chat_client.count_tokens,
+    )
+
+
+def _split_turns(
+    memory: List[HaivenMessage],
+) -> Tuple[
+    List[HaivenMessage], Optional[ConversationSummary], List[List[HaivenMessage]]
+]:
+    prefix = []
+    summary = None
+    index = 0
+    while index < len(memory) and isinstance(memory[index], HaivenSystemMessage):
+        if isinstance(memory[index], ConversationSummary):
+            summary = memory[index]
+        else:
+            prefix.append(memory[index])
+        index += 1
+
+    turns = []
+    for message in memory[index:]:
+        if isinstance(message, HaivenHumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return prefix, summary, turns
+
+
+def _drop_superseded_state(
+    turns: List[List[HaivenMessage]],
+) -> Tuple[List[List[HaivenMessage]], List[List[HaivenMessage]]]:
+    latest_state = max(
+        (
+            index
+            for index, turn in enumerate(turns)
+            if getattr(turn[0], "state_snapshot", False)
+        ),
+        default=None,
+    )
+    if latest_state is None:
+        return turns, []
+    kept, superseded = [], []
+    for index, turn in enumerate(turns):
+        is_old_state = index < latest_state and getattr(
+            turn[0], "state_snapshot", False
+        )
+        (superseded if is_old_state else kept).append(turn)
+    return kept, superseded
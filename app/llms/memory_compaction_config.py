@@ -0,0 +1,50 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from config_values import to_bool, to_int
+
+
+class MemoryCompactionConfig:
+    """
+    Settings for keeping the prompt of long chat sessions under a token budget.
+
+    Attributes:
+        max_prompt_tokens (int): The token budget of the prompt sent on every turn, for models that do not
+            set their own with max_prompt_tokens in their config. 0 means no budget.
+        max_session_bytes (int): The memory a chat session may take, beyond it the oldest turns are dropped
+            before the next turn. The system prompt and knowledge contexts shared by sessions do not count.
+            0 means no budget.
+        summarize (bool): Whether the turns that no longer fit the budget are summarized by the model,
+            instead of just being dropped. Costs an extra model call whenever turns are dropped.
+        drop_superseded_state (bool): Whether earlier turns of a session are dropped when a newer message
+            carries the complete current state, like the JSON data sent with every iteration request.
+    """
+
+    def __init__(
+        self,
+        max_prompt_tokens: int = 0,
+        max_session_bytes: int = 0,
+        summarize: bool = False,
+        drop_superseded_state: bool = True,
+    ):
+        if max_prompt_tokens < 0:
+            raise ValueError("max_prompt_tokens must not be negative")
+        if max_session_bytes < 0:
+            raise ValueError("max_session_bytes must not be negative")
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_session_bytes = max_session_bytes
+        self.summarize = summarize
+        self.drop_superseded_state = drop_superseded_state
+
+    def max_prompt_tokens_for(self, model_config) -> int:
+        return to_int(
+            model_config.config.get("max_prompt_tokens"), self.max_prompt_tokens
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        return cls(
+            max_prompt_tokens=to_int(data.get("max_prompt_tokens"), 0),
+            max_session_bytes=to_int(data.get("max_session_bytes"), 0),
+            summarize=to_bool(data.get("summarize"), False),
+            drop_superseded_state=to_bool(data.get("drop_superseded_state"), True),
+        )
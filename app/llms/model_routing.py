@@ -0,0 +1,155 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+from typing import List
+
+from llms.rate_limit import RateLimitExceeded
+from llms.token_counter import ContextWindowExceeded
+from logger import HaivenLogger
+
+# raised by our own guards before a request is sent, another model would not fare better
+NOT_FAILED_OVER = (ContextWindowExceeded, RateLimitExceeded)
+
+
+class RoutedChatClient:
+    """
+    Streams the answer of the first of several chat clients that starts answering, a chat's own
+    model first and then its fallback models in order. Once a model has sent its first chunk, the
+    answer is streamed from it to the end, errors after that are not retried with another model.
+
+    With hedge_after_seconds, the next model is also asked if the current one has not sent its first
+    chunk in time, and whichever answers first is streamed while the other request is cancelled.
+    Hedging needs to wait for two requests at once, so only astream() hedges, stream() fails over.
+
+    answered_by is the model whose answer the last stream returned, the chat's own model until one answers.
+    """
+
+    def __init__(self, chat_clients: List, hedge_after_seconds: float = 0):
+        self.chat_clients = chat_clients
+        self.model_config = chat_clients[0].model_config
+        self.answered_by = self.model_config
+        self.hedge_after_seconds = hedge_after_seconds
+
+    def count_tokens(self, text: str) -> int:
+        return self.chat_clients[0].count_tokens(text)
+
+    def remaining_input_tokens(self, messages):
+        return self.chat_clients[0].remaining_input_tokens(messages)
+
+    def stream(self, messages, mock: bool = False):
+        self.answered_by = self.model_config
+        for index, chat_client in enumerate(self.chat_clients):
+            chunks = chat_client.stream(messages)
+            try:
+                first_chunk = next(chunks)
+            except StopIteration:
+                self.answered_by = chat_client.model_config
+                return
+            except NOT_FAILED_OVER:
+                raise
+            except Exception as error:
+                if index == len(self.chat_clients) - 1:
+                    raise
+                self._log_failover(chat_client, self.chat_clients[index + 1], error)
+                continue
+
+            self.answered_by = chat_client.model_config
+            yield first_chunk
+            yield from chunks
+            return
+
+    async def astream(self, messages):
+        # the pending first chunk of every model asked so far, with the model's client and stream
+        attempts = {}
+        next_index = 0
+        hedged = False
+        self.answered_by = self.model_config
+
+        def ask_next_model():
+            nonlocal next_index
+            chat_client = self.chat_clients[next_index]
+            next_index += 1
+            chunks = chat_client.astream(messages)
+            attempts[asyncio.ensure_future(chunks.__anext__())] = (chat_client, chunks)
+
+        ask_next_model()
+        last_error = None
+        # once a guard refused a request no other model is asked, a pending one may still answer
+        guard_error = None
+        try:
+            while attempts:
+                can_hedge = (
+                    self.hedge_after_seconds > 0
+                    and not hedged
+                    and guard_error is None
+                    and next_index < len(self.chat_clients)
+                )
+                done, _ = await asyncio.wait(
+                    attempts,
+                    timeout=self.hedge_after_seconds if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    hedged = True
+                    self._log_hedge(self.chat_clients[next_index])
+                    ask_next_model()
+                    continue
+
+                for attempt in done:
+                    chat_client, chunks = attempts.pop(attempt)
+                    error = attempt.exception()
+                    if error is None or isinstance(error, StopAsyncIteration):
+                        await _cancel(attempts)
+                        self.answered_by = chat_client.model_config
+                        if error is None:
+                            yield attempt.result()
+                            async for chunk in chunks:
+                                yield chunk
+                        return
+
+                    if isinstance(error, NOT_FAILED_OVER):
+                        guard_error = error
+                    last_error = error
+                    if (
+                        not attempts
+                        and guard_error is None
+                        and next_index < len(self.chat_clients)
+                    ):
+                        self._log_failover(
+                            chat_client, self.chat_clients[next_index], error
+                        )
+                        ask_next_model()
+            raise guard_error or last_error
+        finally:
+            await _cancel(attempts)
+
+    def _log_failover(self, failed_client, next_client, error: Exception) -> None:
+        HaivenLogger.get().warn(
+            f"{failed_client.model_config.lite_id} failed before answering, asking {next_client.model_config.lite_id} instead: {error}",
+            extra={
+                "INFO": "ModelFailover",
+                "model": failed_client.model_config.lite_id,
+                "fallbackModel": next_client.model_config.lite_id,
+            },
+        )
+
+    def _log_hedge(self, next_client) -> None:
+        HaivenLogger.get().info(
+            f"{self.model_config.lite_id} has not answered within {self.hedge_after_seconds}s, also asking {next_client.model_config.lite_id}",
+            extra={
+                "INFO": "ModelHedge",
+                "model": self.model_config.lite_id,
+                "fallbackModel": next_client.model_config.lite_id,
+            },
+        )
+
+
+async def _cancel(attempts: dict) -> None:
+    for attempt in attempts:
+        attempt.cancel()
+    await asyncio.gather(*attempts, return_exceptions=True)
+    for _, chunks in attempts.values():
+        try:
+            await chunks.aclose()
+        except Exception:
+            pass
+    attempts.clear()
@@ -0,0 +1,62 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from typing import Dict, List
+from config_values import to_int
+
+# the features chat clients are routed by
+TEXT_GENERATION = "text-generation"
+QUERY_REWRITE = "query-rewrite"
+
+
+class ModelRoute:
+    """
+    Which models answer instead of a chat's own model, for one model feature.
+
+    Attributes:
+        fallback_models (List[str]): Ids of the models tried in this order when the chat's model fails
+            before it starts answering.
+        hedge_after_ms (int): If the chat's model has not sent its first chunk after this many milliseconds,
+            the first fallback model is asked in parallel and whichever answers first is streamed.
+            0 means no hedging, fallbacks are only tried after a failure.
+    """
+
+    def __init__(self, fallback_models: List[str] = None, hedge_after_ms: int = 0):
+        if hedge_after_ms < 0:
+            raise ValueError("hedge_after_ms must not be negative")
+        self.fallback_models = fallback_models or []
+        self.hedge_after_ms = hedge_after_ms
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        return cls(
+            fallback_models=_to_list(data.get("fallback_models")),
+            hedge_after_ms=to_int(data.get("hedge_after_ms"), 0),
+        )
+
+
+class ModelRoutingConfig:
+    """The model routes by model feature, e.g. "text-generation"."""
+
+    def __init__(self, routes: Dict[str, ModelRoute] = None):
+        self.routes = routes or {}
+
+    def route(self, feature: str) -> ModelRoute:
+        return self.routes.get(feature) or ModelRoute()
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        return cls(
+            routes={
+                feature: ModelRoute.from_dict(route) for feature, route in data.items()
+            }
+        )
+
+
+def _to_list(value) -> List[str]:
+    # a YAML list, or a comma separated string when set from an env var
+    if value is None or value == "":
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [item.strip() for item in value if item and item.strip()]
@@ -0,0 +1,75 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from typing import Dict, List, Tuple
+
+from llms.latency_stats import LatencyHistogram
+
+# labels of one time series, as sorted (name, value) pairs so they can be used as dict keys
+Labels = Tuple[Tuple[str, str], ...]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def to_labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_counter(name: str, help_text: str, values: Dict[Labels, float]) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+    for labels, value in sorted(values.items()):
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return lines
+
+
+def format_gauge(name: str, help_text: str, values: Dict[Labels, float]) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    for labels, value in sorted(values.items()):
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return lines
+
+
+def format_histogram(
+    name: str,
+    help_text: str,
+    histograms: Dict[Labels, LatencyHistogram],
+    unit_scale: float = 0.001,
+) -> List[str]:
+    """
+    The histograms in the Prometheus text format. Latencies are recorded in milliseconds,
+    unit_scale converts them to the seconds Prometheus expects.
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for labels, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets_ms, histogram.counts):
+            cumulative += count
+            bucket_labels = labels + (("le", _format_value(bound * unit_scale)),)
+            lines.append(f"{name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+        inf_labels = labels + (("le", "+Inf"),)
+        lines.append(f"{name}_bucket{_format_labels(inf_labels)} {histogram.count}")
+        lines.append(
+            f"{name}_sum{_format_labels(labels)} {_format_value(histogram.sum_ms * unit_scale)}"
+        )
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+    return lines
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in labels)
+        + "}"
+    )
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    # integers without a fraction, and no float noise like 0.30000000000000004
+    rounded = round(value, 6)
+    if rounded == int(rounded):
+        return str(int(rounded))
+    return repr(rounded)
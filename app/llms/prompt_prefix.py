@@ -0,0 +1,41 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from typing import List
+
+from llms.model_config import ModelConfig
+
+# Anthropic caches the prompt up to each block marked like this, for a few minutes after last use
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def supports_cache_control(model_config: ModelConfig) -> bool:
+    """
+    Whether the model only caches prompt prefixes that are explicitly marked. OpenAI, Azure and Gemini
+    models cache long prompt prefixes automatically, they only need the prefix to be byte-identical.
+    """
+    provider = model_config.provider.lower()
+    if provider == "anthropic":
+        return True
+    # Claude models on Bedrock support the same markers
+    return provider == "aws" and "anthropic" in model_config.lite_id
+
+
+def to_json_messages(messages: List, model_config: ModelConfig) -> List[dict]:
+    """
+    The messages as they are sent to the model. A message with segments, like the system message with
+    the knowledge pack contexts, is sent as one content block per segment, each marked as cacheable
+    for models that need it. Other models get the plain message, which starts with the same stable prefix.
+    """
+    cache_control = supports_cache_control(model_config)
+    return [_to_json(message, cache_control) for message in messages]
+
+
+def _to_json(message, cache_control: bool) -> dict:
+    json_message = message.to_json()
+    segments = getattr(message, "segments", None)
+    if cache_control and segments:
+        json_message["content"] = [
+            {"type": "text", "text": segment, "cache_control": CACHE_CONTROL}
+            for segment in segments
+            if segment
+        ]
+    return json_message
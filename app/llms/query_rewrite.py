@@ -0,0 +1,246 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import List, Optional
+
+from llms.clients import (
+    ChatClient,
+    HaivenHumanMessage,
+    HaivenMessage,
+    HaivenSystemMessage,
+)
+from llms.query_rewrite_config import QueryRewriteConfig
+from logger import HaivenLogger
+
+STOP_WORDS = frozenset(
+    """
+    a about above after again against all also am an and any are as at be because been before being below
+    between both but by can could did do does doing down during each few for from further had has have having
+    he her here hers herself him himself his how i if in into is it its itself just let me more most my myself
+    no nor not now of off on once only or other our ours ourselves out over own please same she should so some
+    such than that the their theirs them themselves then there these they this those through to too under until
+    up very was we were what when where which while who whom why will with would you your yours yourself
+    yourselves tell give show explain describe know think want need like make get use using used
+    """.split()
+)
+
+KEYWORD_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_\-./#]*[A-Za-z0-9]|[A-Za-z0-9]")
+
+
+class QueryRewriteStats:
+    """
+    Keeps the number of rewrites and their total duration per strategy, so the latency of the
+    configured strategy can be compared to the full LLM rewrite.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._total_ms = Counter()
+
+    def record(self, strategy: str, duration_ms: float) -> None:
+        with self._lock:
+            self._counts[strategy] += 1
+            self._total_ms[strategy] += duration_ms
+
+    def average_ms(self, strategy: str) -> Optional[float]:
+        with self._lock:
+            if self._counts[strategy] == 0:
+                return None
+            return self._total_ms[strategy] / self._counts[strategy]
+
+    def latency_saved_ms(self, strategy: str, duration_ms: float) -> Optional[float]:
+        if strategy == QueryRewriteConfig.LLM:
+            return 0.0
+        llm_average_ms = self.average_ms(QueryRewriteConfig.LLM)
+        if llm_average_ms is None:
+            return None
+        return llm_average_ms - duration_ms
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                strategy: {
+                    "count": self._counts[strategy],
+                    "average_ms": round(
+                        self._total_ms[strategy] / self._counts[strategy], 2
+                    ),
+                }
+                for strategy in self._counts
+            }
+
+
+class QueryRewriter(ABC):
+    """
+    Derives the search query for knowledge documents from the current user message and the chat memory.
+    Returns None when no search is needed. Every rewrite is timed and logged with its strategy.
+    """
+
+    strategy: str = None
+
+    def __init__(self, stats: QueryRewriteStats = None):
+        self.stats = stats or QueryRewriteStats()
+
+    def rewrite(
+        self, message: str, memory: List[HaivenMessage], chat_client: ChatClient
+    ) -> Optional[str]:
+        # Nothing to rewrite on the first message of a conversation
+        if len(memory) == 1:
+            return message
+
+        started_at = time.perf_counter()
+        query = self._rewrite(message, memory, chat_client)
+        duration_ms = (time.perf_counter() - started_at) * 1000
+
+        self.stats.record(self.strategy, duration_ms)
+        latency_saved_ms = self.stats.latency_saved_ms(self.strategy, duration_ms)
+        HaivenLogger.get().info(
+            f"Rewrote similarity query with strategy {self.strategy} in {duration_ms:.1f} ms",
+            extra={
+                "INFO": "SimilarityQueryRewritten",
+                "strategy": self.strategy,
+                "duration_ms": round(duration_ms, 2),
+                "latency_saved_ms": None
+                if latency_saved_ms is None
+                else round(latency_saved_ms, 2),
+            },
+        )
+        return query
+
+    @abstractmethod
+    def _rewrite(
+        self, message: str, memory: List[HaivenMessage], chat_client: ChatClient
+    ) -> Optional[str]:
+        pass
+
+
+class NoQueryRewriter(QueryRewriter):
+    strategy = QueryRewriteConfig.NONE
+
+    def _rewrite(self, message, memory, chat_client):
+        return message
+
+
+class HeuristicQueryRewriter(QueryRewriter):
+    """
+    Adds the most frequent keywords of the recent user messages to the current message, so follow-up
+    questions like "and what about its cost?" still find chunks about the earlier topic.
+    """
+
+    strategy = QueryRewriteConfig.HEURISTIC
+
+    def __init__(
+        self,
+        recent_turns: int = 2,
+        max_keywords: int = 8,
+        stats: QueryRewriteStats = None,
+    ):
+        super().__init__(stats)
+        self.recent_turns = recent_turns
+        self.max_keywords = max_keywords
+
+    def _rewrite(self, message, memory, chat_client):
+        user_messages = [
+            entry.content for entry in memory if isinstance(entry, HaivenHumanMessage)
+        ]
+        recent_user_messages = (
+            user_messages[-self.recent_turns :] if self.recent_turns > 0 else []
+        )
+
+        message_keywords = set(
+            keyword.lower() for keyword in HeuristicQueryRewriter.keywords(message)
+        )
+        counts = Counter()
+        first_seen = {}
+        for recent_message in recent_user_messages:
+            for keyword in HeuristicQueryRewriter.keywords(recent_message):
+                normalized = keyword.lower()
+                if normalized in message_keywords:
+                    continue
+                counts[normalized] += 1
+                first_seen.setdefault(normalized, keyword)
+
+        keywords = [
+            first_seen[normalized]
+            for normalized, _ in counts.most_common(self.max_keywords)
+        ]
+        if not keywords:
+            return message
+        return f"{message} {' '.join(keywords)}"
+
+    @staticmethod
+    def keywords(text: str) -> List[str]:
+        return [
+            word
+            for word in KEYWORD_PATTERN.findall(text or "")
+            if len(word) > 2 and word.lower() not in STOP_WORDS
+        ]
+
+
+class ModelQueryRewriter(QueryRewriter):
+    """
+    Asks a model to turn the conversation into a standalone search query. Uses the chat's own model,
+    unless it is given a chat client of a separate, usually smaller model.
+    """
+
+    def __init__(self, chat_client: ChatClient = None, stats: QueryRewriteStats = None):
+        super().__init__(stats)
+        self.chat_client = chat_client
+        self.strategy = (
+            QueryRewriteConfig.LLM
+            if chat_client is None
+            else QueryRewriteConfig.SMALL_MODEL
+        )
+
+    def _rewrite(self, message, memory, chat_client):
+        if len(memory) > 5:
+            conversation = "\n".join(
+                [entry.content for entry in (memory[:2] + memory[-4:])]
+            )
+        else:
+            conversation = "\n".join([entry.content for entry in memory])
+
+        system_message = f"""You are a helpful assistant.
+        Your task is create a single search query to find relevant information, based on the conversation and the current user message.
+        Rules: 
+        - Search query should find relevant information for the current user message only.
+        - Include all important key words and phrases in query that would help to search for relevant information.
+        - If the current user message does not need to search for additional information, return NONE.
+        - Only return the single standalone search query or NONE. No explanations needed.
+        
+        Conversation:
+        {conversation}
+        """
+        prompt = [HaivenSystemMessage(content=system_message)]
+        prompt.append(
+            HaivenHumanMessage(content=f"Current user message: {message} \n Query:")
+        )
+
+        stream = (self.chat_client or chat_client).stream(prompt)
+        query = ""
+        for chunk in stream:
+            query += chunk.get("content", "")
+
+        if "none" in query.lower():
+            return None
+        elif "query:" in query.lower():
+            return query.split("query:")[1].strip()
+        else:
+            return query
+
+
+def create_query_rewriter(
+    config: QueryRewriteConfig,
+    small_model_chat_client: ChatClient = None,
+    stats: QueryRewriteStats = None,
+) -> QueryRewriter:
+    if config.strategy == QueryRewriteConfig.NONE:
+        return NoQueryRewriter(stats)
+    if config.strategy == QueryRewriteConfig.HEURISTIC:
+        return HeuristicQueryRewriter(config.recent_turns, config.max_keywords, stats)
+    if config.strategy == QueryRewriteConfig.SMALL_MODEL:
+        return ModelQueryRewriter(small_model_chat_client, stats)
+    return ModelQueryRewriter(stats=stats)
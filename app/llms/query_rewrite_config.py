@@ -0,0 +1,55 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from config_values import to_int
+
+
+class QueryRewriteConfig:
+    """
+    Settings for how the search query for knowledge documents is derived from a chat conversation.
+
+    Attributes:
+        strategy (str): "none" searches with the user message as it is,
+            "heuristic" adds keywords from the recent user messages without any model call,
+            "small_model" asks a separate, cheaper model to rewrite the query,
+            "llm" asks the chat's own model to rewrite the query.
+        model (str): The id of the model to use with the "small_model" strategy.
+        recent_turns (int): How many previous user messages the "heuristic" strategy takes keywords from.
+        max_keywords (int): How many keywords the "heuristic" strategy adds to the user message at most.
+    """
+
+    NONE = "none"
+    HEURISTIC = "heuristic"
+    SMALL_MODEL = "small_model"
+    LLM = "llm"
+
+    STRATEGIES = [NONE, HEURISTIC, SMALL_MODEL, LLM]
+
+    def __init__(
+        self,
+        strategy: str = LLM,
+        model: str = None,
+        recent_turns: int = 2,
+        max_keywords: int = 8,
+    ):
+        strategy = (strategy or QueryRewriteConfig.LLM).lower()
+        if strategy not in QueryRewriteConfig.STRATEGIES:
+            raise ValueError(
+                f"Query rewrite strategy {strategy} not supported, use one of {', '.join(QueryRewriteConfig.STRATEGIES)}"
+            )
+        if strategy == QueryRewriteConfig.SMALL_MODEL and not model:
+            raise ValueError(
+                "Query rewrite strategy small_model needs the id of the model to use"
+            )
+        self.strategy = strategy
+        self.model = model or None
+        self.recent_turns = recent_turns
+        self.max_keywords = max_keywords
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        return cls(
+            strategy=data.get("strategy"),
+            model=data.get("model"),
+            recent_turns=to_int(data.get("recent_turns"), 2),
+            max_keywords=to_int(data.get("max_keywords"), 8),
+        )
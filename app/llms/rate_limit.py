@@ -0,0 +1,258 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+import math
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional, Tuple
+
+from litellm import RateLimitError
+
+from llms.model_config import ModelConfig
+from llms.rate_limit_config import RateLimitConfig
+from logger import HaivenLogger
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a model call would have to wait longer than allowed for its turn."""
+
+    def __init__(self, model: str, retry_after: float):
+        self.model = model
+        self.retry_after = retry_after
+        super().__init__(
+            f"Too many requests for model {model}, please try again in {math.ceil(retry_after)} seconds"
+        )
+
+
+class TokenBucket:
+    """
+    Hands out one token per request, refilled at a steady rate up to a burst capacity.
+    Tokens are reserved up front and can go into debt, so concurrent callers queue up in the order
+    they arrived. Without a rate the bucket never runs empty, but can still be paused when the
+    provider asks to back off.
+    """
+
+    def __init__(
+        self,
+        rate_per_second: Optional[float] = None,
+        capacity: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity or 1.0
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated_at = clock()
+        self._paused_until = 0.0
+
+    def wait_time(self) -> float:
+        with self._lock:
+            return self._wait_time(self._refill())
+
+    def reserve(self, max_wait: float) -> Tuple[bool, float]:
+        """
+        Takes a token, unless the caller would have to wait longer than max_wait for it.
+
+        Returns:
+            Tuple[bool, float]: Whether the token was taken, and how long to wait before using it.
+        """
+        with self._lock:
+            now = self._refill()
+            wait = self._wait_time(now)
+            if wait > max_wait:
+                return False, wait
+            if self.rate_per_second:
+                self._tokens -= 1
+            return True, wait
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+    def _refill(self) -> float:
+        now = self._clock()
+        if self.rate_per_second:
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._updated_at) * self.rate_per_second,
+            )
+        self._updated_at = now
+        return now
+
+    def _wait_time(self, now: float) -> float:
+        wait = max(0.0, self._paused_until - now)
+        if self.rate_per_second and self._tokens < 1:
+            wait = max(wait, (1 - self._tokens) / self.rate_per_second)
+        return wait
+
+
+class RateLimiter:
+    """
+    Throttles model calls with a token bucket per model and retries rate limit errors of the provider
+    with exponential backoff and jitter, honoring the Retry-After header when there is one.
+    Waiting, whether for a token or for a retry, is bounded by max_wait_seconds per call, and async
+    calls wait with asyncio.sleep so they do not hold a thread.
+    """
+
+    def __init__(
+        self,
+        config: RateLimitConfig = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+        async_sleep=asyncio.sleep,
+        jitter: Callable[[], float] = random.random,
+    ):
+        self.config = config or RateLimitConfig()
+        self._clock = clock
+        self._sleep = sleep
+        self._async_sleep = async_sleep
+        self._jitter = jitter
+        self._lock = threading.Lock()
+        self._buckets: dict[str, TokenBucket] = {}
+
+    def configure_model(self, model_config: ModelConfig) -> None:
+        """Sets up the bucket of a model from "requests_per_minute" and "rate_limit_burst" in its config."""
+        with self._lock:
+            if model_config.lite_id in self._buckets:
+                return
+            requests_per_minute = _to_float(
+                model_config.config.get("requests_per_minute")
+            )
+            burst = _to_float(model_config.config.get("rate_limit_burst"))
+            self._buckets[model_config.lite_id] = TokenBucket(
+                requests_per_minute / 60 if requests_per_minute else None,
+                burst or requests_per_minute,
+                self._clock,
+            )
+
+    def check_admission(self, model: str) -> None:
+        """Raises RateLimitExceeded if a new call for the model would wait longer than allowed."""
+        wait = self._bucket(model).wait_time()
+        if wait > self.config.max_wait_seconds:
+            self._log_rejected(model, wait)
+            raise RateLimitExceeded(model, wait)
+
+    def call(self, completion_fn: Callable, **kwargs):
+        model = kwargs.get("model")
+        deadline = self._clock() + self.config.max_wait_seconds
+        attempt = 0
+        while True:
+            self._sleep(self._reserve(model, deadline))
+            try:
+                return completion_fn(**kwargs)
+            except RateLimitError as error:
+                attempt += 1
+                self._sleep(self._retry_delay(model, error, attempt, deadline))
+
+    async def call_async(self, completion_fn: Callable, **kwargs):
+        model = kwargs.get("model")
+        deadline = self._clock() + self.config.max_wait_seconds
+        attempt = 0
+        while True:
+            await self._async_sleep(self._reserve(model, deadline))
+            try:
+                return await completion_fn(**kwargs)
+            except RateLimitError as error:
+                attempt += 1
+                await self._async_sleep(
+                    self._retry_delay(model, error, attempt, deadline)
+                )
+
+    def backoff_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        if retry_after is not None:
+            # spread the retries a little, so callers told the same Retry-After do not all retry at once
+            return retry_after + self._jitter() * self.config.base_delay_seconds
+        # "full jitter": anywhere between 0 and the exponential delay of this attempt
+        exponential_delay = min(
+            self.config.max_delay_seconds,
+            self.config.base_delay_seconds * 2 ** (attempt - 1),
+        )
+        return self._jitter() * exponential_delay
+
+    def _bucket(self, model: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(model)
+            if bucket is None:
+                bucket = self._buckets[model] = TokenBucket(clock=self._clock)
+            return bucket
+
+    def _reserve(self, model: str, deadline: float) -> float:
+        reserved, wait = self._bucket(model).reserve(max(0.0, deadline - self._clock()))
+        if not reserved:
+            self._log_rejected(model, wait)
+            raise RateLimitExceeded(model, wait)
+        return wait
+
+    def _retry_delay(
+        self, model: str, error: RateLimitError, attempt: int, deadline: float
+    ) -> float:
+        if attempt > self.config.max_retries:
+            raise error
+
+        delay = self.backoff_delay(attempt, retry_after_seconds(error))
+        if self._clock() + delay > deadline:
+            self._log_rejected(model, delay)
+            raise RateLimitExceeded(model, delay) from error
+
+        # the provider limit applies to every caller of the model, not just this one
+        self._bucket(model).pause(delay)
+        HaivenLogger.get().warn(
+            f"Rate limited by the provider of {model}, retry {attempt} in {delay:.1f} seconds",
+            extra={
+                "INFO": "ModelRateLimitRetry",
+                "model": model,
+                "attempt": attempt,
+                "delay_seconds": round(delay, 2),
+            },
+        )
+        return delay
+
+    def _log_rejected(self, model: str, wait: float) -> None:
+        HaivenLogger.get().warn(
+            f"Rejected call to {model}, it would wait {wait:.1f} seconds for the rate limit",
+            extra={
+                "INFO": "ModelRateLimitRejected",
+                "model": model,
+                "wait_seconds": round(wait, 2),
+            },
+        )
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Reads how long the provider asked to wait from the Retry-After headers of a rate limit error."""
+    headers = (
+        getattr(error, "headers", None)
+        or getattr(error, "litellm_response_headers", None)
+        or getattr(getattr(error, "response", None), "headers", None)
+    )
+    if not headers:
+        return None
+    headers = {str(name).lower(): value for name, value in headers.items()}
+
+    retry_after_ms = _to_float(headers.get("retry-after-ms"))
+    if retry_after_ms is not None:
+        return max(0.0, retry_after_ms / 1000)
+
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    seconds = _to_float(retry_after)
+    if seconds is not None:
+        return max(0.0, seconds)
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def _to_float(value) -> Optional[float]:
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,44 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from config_values import to_float
+
+
+class RateLimitConfig:
+    """
+    Settings for how model calls are throttled and retried when a provider rate limits them.
+    The request rate itself is configured per model, with "requests_per_minute" in the model's config.
+
+    Attributes:
+        max_retries (int): How often a call is retried after the provider answered with a rate limit error.
+        base_delay_seconds (float): The first backoff delay, doubled with every further retry.
+        max_delay_seconds (float): The longest backoff delay between two retries.
+        max_wait_seconds (float): How long a request may wait for its turn and its retries in total.
+            Requests that would have to wait longer are rejected right away with a 429.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 3,
+        base_delay_seconds: float = 1.0,
+        max_delay_seconds: float = 30.0,
+        max_wait_seconds: float = 20.0,
+    ):
+        if max_retries < 0:
+            raise ValueError("Rate limit max_retries can not be negative")
+        if base_delay_seconds <= 0 or max_delay_seconds < base_delay_seconds:
+            raise ValueError(
+                "Rate limit delays need 0 < base_delay_seconds <= max_delay_seconds"
+            )
+        self.max_retries = max_retries
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.max_wait_seconds = max_wait_seconds
+
+    @classmethod
+    def from_dict(cls, data):
+        data = data or {}
+        return cls(
+            max_retries=int(to_float(data.get("max_retries"), 3)),
+            base_delay_seconds=to_float(data.get("base_delay_seconds"), 1.0),
+            max_delay_seconds=to_float(data.get("max_delay_seconds"), 30.0),
+            max_wait_seconds=to_float(data.get("max_wait_seconds"), 20.0),
+        )
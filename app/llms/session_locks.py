@@ -0,0 +1,119 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+
+class SessionBusy(Exception):
+    """Raised when a chat session already has a turn in progress, and new requests to it are rejected."""
+
+    def __init__(self, session_key: str):
+        self.session_key = session_key
+        super().__init__(
+            "This chat session is still answering a previous message, please try again when it is done"
+        )
+
+
+class _SessionLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        # the claimed turns that have not finished, the one holding the lock among them
+        self.users = 0
+
+
+class SessionClaim:
+    """
+    A turn of a chat session, registered when its request arrives, so that requests arriving
+    before its stream has started already see the session as busy. acquire waits for the turns
+    claimed before it, release ends the turn, or gives up the claim if the turn never ran.
+    """
+
+    def __init__(
+        self,
+        session_locks: "SessionLocks",
+        session_key: str,
+        session_lock: _SessionLock,
+        waited: bool,
+    ):
+        self.session_key = session_key
+        # whether turns claimed before this one had not finished yet
+        self.waited = waited
+        self._session_locks = session_locks
+        self._session_lock = session_lock
+        self._holds_lock = False
+        self._released = False
+
+    async def acquire(self) -> bool:
+        """Waits for the turns before this one, returns whether there were any."""
+        # asyncio.Lock wakes up its waiters in the order they started waiting
+        await self._session_lock.lock.acquire()
+        self._holds_lock = True
+        return self.waited
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        if self._holds_lock:
+            self._holds_lock = False
+            self._session_lock.lock.release()
+        self._session_locks._release(self.session_key, self._session_lock)
+
+    @asynccontextmanager
+    async def turn(self):
+        """Holds the session for this turn, yields whether it had to wait for turns before it."""
+        try:
+            yield await self.acquire()
+        finally:
+            self.release()
+
+
+class SessionLocks:
+    """
+    Runs the turns of each chat session one after the other, in the order the requests arrived,
+    so that two requests to the same session cannot interleave their messages in its memory.
+    Only covers the requests of this process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, _SessionLock] = {}
+
+    def is_busy(self, session_key: str) -> bool:
+        with self._lock:
+            return session_key in self._sessions
+
+    def claim(self, session_key: str) -> SessionClaim:
+        """Registers a turn of the session, to run after the turns claimed before it."""
+        with self._lock:
+            return self._claim(session_key)
+
+    def try_claim(self, session_key: str) -> Optional[SessionClaim]:
+        """Registers a turn of the session, unless another turn of it is claimed and not finished yet."""
+        with self._lock:
+            if session_key in self._sessions:
+                return None
+            return self._claim(session_key)
+
+    @asynccontextmanager
+    async def turn(self, session_key: str):
+        """Claims and holds the session for one turn, yields whether it had to wait for turns before it."""
+        async with self.claim(session_key).turn() as waited:
+            yield waited
+
+    def _claim(self, session_key: str) -> SessionClaim:
+        session_lock = self._sessions.get(session_key)
+        if session_lock is None:
+            session_lock = self._sessions[session_key] = _SessionLock()
+        waited = session_lock.users > 0
+        session_lock.users += 1
+        return SessionClaim(self, session_key, session_lock, waited)
+
+    def _release(self, session_key: str, session_lock: _SessionLock):
+        with self._lock:
+            session_lock.users -= 1
+            if session_lock.users == 0:
+                del self._sessions[session_key]
@@ -0,0 +1,358 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from llms.latency_stats import LatencyHistogram, ProviderLatencyStats
+from llms.token_counter import estimate_tokens_of_length
+from llms.prometheus import (
+    Labels,
+    format_counter,
+    format_gauge,
+    format_histogram,
+    to_labels,
+)
+from logger import HaivenLogger
+
+# upper bounds of the buckets for model calls, chat phases and requests, in milliseconds
+DURATION_BUCKETS_MS = [
+    10,
+    25,
+    50,
+    100,
+    250,
+    500,
+    1000,
+    2500,
+    5000,
+    10000,
+    30000,
+    60000,
+    120000,
+]
+# upper bounds of the buckets for the time between two streamed chunks, in milliseconds
+INTER_TOKEN_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+TIME_TO_FIRST_TOKEN = "haiven_llm_time_to_first_token_seconds"
+INTER_TOKEN_LATENCY = "haiven_llm_inter_token_latency_seconds"
+STREAM_DURATION = "haiven_llm_stream_duration_seconds"
+MODEL_CALLS = "haiven_llm_calls_total"
+INPUT_TOKENS = "haiven_llm_input_tokens_total"
+OUTPUT_TOKENS = "haiven_llm_output_tokens_total"
+CHAT_PHASE_DURATION = "haiven_chat_phase_duration_seconds"
+HTTP_REQUEST_DURATION = "haiven_http_request_duration_seconds"
+
+HISTOGRAMS = {
+    TIME_TO_FIRST_TOKEN: (
+        "Time from sending a model request to its first content chunk",
+        DURATION_BUCKETS_MS,
+    ),
+    INTER_TOKEN_LATENCY: (
+        "Mean time between two content chunks of a model response",
+        INTER_TOKEN_BUCKETS_MS,
+    ),
+    STREAM_DURATION: (
+        "Time from sending a model request to the end of its response",
+        DURATION_BUCKETS_MS,
+    ),
+    CHAT_PHASE_DURATION: (
+        "Time a chat turn spends in each phase before and while streaming the answer",
+        DURATION_BUCKETS_MS,
+    ),
+    HTTP_REQUEST_DURATION: (
+        "Time until a request is answered, for streamed responses until the stream starts",
+        DURATION_BUCKETS_MS,
+    ),
+}
+COUNTERS = {
+    MODEL_CALLS: "Model requests by outcome, aborted when nobody read the rest of the response",
+    INPUT_TOKENS: "Prompt tokens reported by the model providers",
+    OUTPUT_TOKENS: "Completion tokens reported by the model providers",
+}
+
+
+class MetricsRegistry:
+    """Histograms and counters by metric name and labels, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[Labels, LatencyHistogram]] = {
+            name: {} for name in HISTOGRAMS
+        }
+        self._counters: Dict[str, Dict[Labels, float]] = {name: {} for name in COUNTERS}
+
+    def observe_ms(self, name: str, labels: Dict[str, str], value_ms: float) -> None:
+        key = to_labels(labels)
+        with self._lock:
+            histograms = self._histograms[name]
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = LatencyHistogram(HISTOGRAMS[name][1])
+            histogram.record(value_ms)
+
+    def increment(self, name: str, labels: Dict[str, str], amount: float = 1) -> None:
+        key = to_labels(labels)
+        with self._lock:
+            counters = self._counters[name]
+            counters[key] = counters.get(key, 0) + amount
+
+    def histogram(
+        self, name: str, labels: Dict[str, str]
+    ) -> Optional[LatencyHistogram]:
+        with self._lock:
+            return self._histograms[name].get(to_labels(labels))
+
+    def counter(self, name: str, labels: Dict[str, str]) -> float:
+        with self._lock:
+            return self._counters[name].get(to_labels(labels), 0)
+
+    def prometheus_lines(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for name, (help_text, _) in HISTOGRAMS.items():
+                lines += format_histogram(name, help_text, self._histograms[name])
+            for name, help_text in COUNTERS.items():
+                lines += format_counter(name, help_text, self._counters[name])
+        return lines
+
+
+class Span:
+    """
+    One timed operation of a chat turn, logged with the fields of an OpenTelemetry span, so the log
+    lines can be turned into traces. Spans of the same turn share the trace id of its root span.
+    """
+
+    __slots__ = (
+        "name",
+        "trace_id",
+        "span_id",
+        "parent_span_id",
+        "attributes",
+        "start_time_unix_nano",
+        "start_monotonic",
+    )
+
+    def __init__(self, name: str, attributes: dict, parent: "Span" = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_span_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.start_time_unix_nano = time.time_ns()
+        self.start_monotonic = time.monotonic()
+
+    def elapsed_ms(self) -> float:
+        return (time.monotonic() - self.start_monotonic) * 1000
+
+    def end(self, error: Exception = None) -> float:
+        duration_ms = self.elapsed_ms()
+        HaivenLogger.get().info(
+            f"Span {self.name} took {duration_ms:.0f}ms",
+            extra={
+                "INFO": "Span",
+                "trace_id": self.trace_id,
+                "span_id": self.span_id,
+                "parent_span_id": self.parent_span_id,
+                "span_name": self.name,
+                "start_time_unix_nano": self.start_time_unix_nano,
+                "end_time_unix_nano": self.start_time_unix_nano
+                + int(duration_ms * 1_000_000),
+                "status": "ERROR" if error is not None else "OK",
+                "attributes": self.attributes,
+            },
+        )
+        return duration_ms
+
+
+class ModelCallTimer:
+    """
+    Times one streamed model response: the first content chunk, the mean gap between content
+    chunks and the whole stream. Only a few timestamps are kept per response, the histograms are
+    updated once when it ends.
+    """
+
+    __slots__ = (
+        "telemetry",
+        "labels",
+        "span",
+        "first_chunk_ms",
+        "last_chunk_ms",
+        "content_chunks",
+        "content_chars",
+        "usage",
+        "finished",
+    )
+
+    def __init__(self, telemetry: "ChatTelemetry", labels: dict, span: Span):
+        self.telemetry = telemetry
+        self.labels = labels
+        self.span = span
+        self.first_chunk_ms = None
+        self.last_chunk_ms = None
+        self.content_chunks = 0
+        self.content_chars = 0
+        self.usage = None
+        self.finished = False
+
+    def chunk(self, chunk) -> None:
+        if not isinstance(chunk, dict):
+            return
+        if "content" in chunk:
+            self.last_chunk_ms = self.span.elapsed_ms()
+            if self.first_chunk_ms is None:
+                self.first_chunk_ms = self.last_chunk_ms
+            self.content_chunks += 1
+            self.content_chars += len(chunk["content"] or "")
+        elif isinstance(chunk.get("usage"), dict):
+            self.usage = chunk["usage"]
+
+    def finish(self, error: Exception = None) -> None:
+        if self.finished:
+            return
+        self.finished = True
+        self.telemetry.record_model_call(self, error)
+
+    def abort(self) -> None:
+        """Ends the call when its stream is closed or cancelled before the response is complete."""
+        if self.finished:
+            return
+        self.finished = True
+        self.telemetry.record_model_call(self, aborted=True)
+
+
+class ChatTelemetry:
+    """
+    Metrics and spans of the chat turns and model calls of all sessions. Recording a value updates a
+    bucket count under a lock, and spans are one log line each, so it stays enabled in production.
+    The metrics are served in the Prometheus text format, which OpenTelemetry collectors can scrape too.
+    """
+
+    def __init__(self, registry: MetricsRegistry = None):
+        self.registry = registry or MetricsRegistry()
+
+    def start_span(self, name: str, attributes: dict, parent: Span = None) -> Span:
+        return Span(name, attributes, parent)
+
+    @contextmanager
+    def phase(self, phase: str, labels: dict, parent: Span = None):
+        """Times a phase of a chat turn, e.g. the query rewrite or the retrieval."""
+        span = self.start_span(
+            f"chat.{phase}", _span_attributes(labels, {"haiven.phase": phase}), parent
+        )
+        error = None
+        try:
+            yield span
+        except Exception as exception:
+            error = exception
+            raise
+        finally:
+            duration_ms = span.end(error)
+            self.registry.observe_ms(
+                CHAT_PHASE_DURATION,
+                {
+                    "chat_type": labels["chat_type"],
+                    "category": labels["category"],
+                    "phase": phase,
+                },
+                duration_ms,
+            )
+
+    def start_model_call(self, labels: dict, parent: Span = None) -> ModelCallTimer:
+        span = self.start_span(
+            "chat.generation",
+            _span_attributes(labels, {"gen_ai.operation.name": "chat"}),
+            parent,
+        )
+        return ModelCallTimer(self, labels, span)
+
+    def record_model_call(
+        self, timer: ModelCallTimer, error: Exception = None, aborted: bool = False
+    ) -> None:
+        labels = timer.labels
+        if aborted and timer.usage is None:
+            # the provider reports the usage at the end, the tokens generated until the abort are estimated
+            timer.usage = {
+                "completion_tokens": estimate_tokens_of_length(timer.content_chars)
+            }
+            timer.span.attributes["haiven.aborted"] = True
+        if timer.first_chunk_ms is not None:
+            self.registry.observe_ms(TIME_TO_FIRST_TOKEN, labels, timer.first_chunk_ms)
+            timer.span.attributes["haiven.time_to_first_token_ms"] = round(
+                timer.first_chunk_ms, 1
+            )
+        if timer.content_chunks > 1:
+            inter_token_ms = (timer.last_chunk_ms - timer.first_chunk_ms) / (
+                timer.content_chunks - 1
+            )
+            self.registry.observe_ms(INTER_TOKEN_LATENCY, labels, inter_token_ms)
+            timer.span.attributes["haiven.inter_token_latency_ms"] = round(
+                inter_token_ms, 2
+            )
+        if timer.usage is not None:
+            input_tokens = timer.usage.get("prompt_tokens") or 0
+            output_tokens = timer.usage.get("completion_tokens") or 0
+            self.registry.increment(INPUT_TOKENS, labels, input_tokens)
+            self.registry.increment(OUTPUT_TOKENS, labels, output_tokens)
+            timer.span.attributes["gen_ai.usage.input_tokens"] = input_tokens
+            timer.span.attributes["gen_ai.usage.output_tokens"] = output_tokens
+
+        duration_ms = timer.span.end(error)
+        self.registry.observe_ms(STREAM_DURATION, labels, duration_ms)
+        if aborted:
+            status = "aborted"
+        else:
+            status = "error" if error else "ok"
+        self.registry.increment(MODEL_CALLS, {**labels, "status": status})
+
+    def record_http_request(
+        self, method: str, endpoint: str, status: int, duration_ms: float
+    ) -> None:
+        self.registry.observe_ms(
+            HTTP_REQUEST_DURATION,
+            {"method": method, "endpoint": endpoint, "status": str(status)},
+            duration_ms,
+        )
+
+    def to_prometheus(
+        self, latency_stats: ProviderLatencyStats = None, session_stats: dict = None
+    ) -> str:
+        lines = self.registry.prometheus_lines()
+        if latency_stats is not None:
+            first_chunk, failures = latency_stats.snapshot()
+            lines += format_histogram(
+                "haiven_llm_provider_first_chunk_seconds",
+                "Time until a model provider sends the first chunk of a response",
+                {to_labels({"provider": p}): h for p, h in first_chunk.items()},
+            )
+            lines += format_counter(
+                "haiven_llm_provider_failures_total",
+                "Model requests that failed before their first chunk, by provider",
+                {to_labels({"provider": p}): count for p, count in failures.items()},
+            )
+        if session_stats is not None:
+            if session_stats["sessions"] is not None:
+                lines += format_gauge(
+                    "haiven_chat_sessions",
+                    "Chat sessions currently stored",
+                    {(): session_stats["sessions"]},
+                )
+            lines += format_counter(
+                "haiven_chat_session_evictions_total",
+                "Chat sessions removed because they expired or the session cap was reached",
+                {
+                    to_labels({"reason": reason}): count
+                    for reason, count in session_stats["evictions"].items()
+                },
+            )
+        return "\n".join(lines) + "\n"
+
+
+def _span_attributes(labels: dict, extra: dict) -> dict:
+    return {
+        "haiven.chat_type": labels["chat_type"],
+        "haiven.category": labels["category"],
+        "gen_ai.request.model": labels["model"],
+        **extra,
+    }
@@ -0,0 +1,141 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import threading
+from typing import Dict, List, Optional
+
+import litellm
+import tiktoken
+
+from embeddings.cache import LRUCache
+from llms.model_config import ModelConfig
+from logger import HaivenLogger
+
+# role and formatting tokens every message adds to the prompt, roughly the same for all providers
+MESSAGE_OVERHEAD_TOKENS = 4
+# tokens the provider adds to prime the reply
+REPLY_PRIMING_TOKENS = 3
+
+# models tokenized with o200k_base, all others are counted with cl100k_base. For models of other
+# providers, like Claude or Gemini, that is an approximation within a few percent for English text
+O200K_MODEL_NAMES = ("gpt-4o", "gpt-4.1", "gpt-5", "o1", "o3", "o4")
+
+
+def estimate_tokens(text: str) -> int:
+    return estimate_tokens_of_length(len(text))
+
+
+def estimate_tokens_of_length(chars: int) -> int:
+    # about 4 characters per token for English text with the common tokenizers
+    return (chars + 3) // 4
+
+
+class ContextWindowExceeded(Exception):
+    def __init__(self, model: str, prompt_tokens: int, max_input_tokens: int):
+        super().__init__(
+            f"The request has about {prompt_tokens} tokens, more than the {max_input_tokens} tokens {model} accepts. "
+            "Please start a new chat or shorten your input."
+        )
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.max_input_tokens = max_input_tokens
+
+
+class TokenCounter:
+    """
+    Counts the tokens of prompts locally, before they are sent, with the tiktoken encoding closest to the
+    model's tokenizer. Encoders are loaded once per encoding, and the counts of recently counted texts
+    are cached, since the same chat memory is counted again on every turn.
+    """
+
+    def __init__(self, max_cached_counts: int = 4096):
+        self._lock = threading.Lock()
+        self._encodings: Dict[str, Optional[tiktoken.Encoding]] = {}
+        self._max_input_tokens: Dict[str, Optional[int]] = {}
+        self._counts = LRUCache(max_cached_counts)
+
+    def encoding_name(self, model_config: ModelConfig) -> str:
+        # the lite_id of Azure models is the deployment name, so the model id is checked too
+        names = f"{model_config.id} {model_config.lite_id}".lower()
+        if any(name in names for name in O200K_MODEL_NAMES):
+            return "o200k_base"
+        return "cl100k_base"
+
+    def count_text(self, text: str, model_config: ModelConfig) -> int:
+        encoding_name = self.encoding_name(model_config)
+        key = (encoding_name, text)
+        count = self._counts.get(key)
+        if count is None:
+            encoding = self._encoding(encoding_name)
+            count = (
+                len(encoding.encode(text, disallowed_special=()))
+                if encoding is not None
+                else estimate_tokens(text)
+            )
+            self._counts.put(key, count)
+        return count
+
+    def count_messages(self, messages: List, model_config: ModelConfig) -> int:
+        return REPLY_PRIMING_TOKENS + sum(
+            self.count_text(message.content, model_config) + MESSAGE_OVERHEAD_TOKENS
+            for message in messages
+        )
+
+    def max_input_tokens(self, model_config: ModelConfig) -> Optional[int]:
+        """
+        The prompt tokens the model accepts, from max_input_tokens in the model's config or else from
+        LiteLLM's model catalog. None if neither knows the model, then requests are not checked.
+        """
+        configured = model_config.config.get("max_input_tokens")
+        if configured is not None and configured != "":
+            return int(configured)
+        with self._lock:
+            if model_config.lite_id not in self._max_input_tokens:
+                self._max_input_tokens[model_config.lite_id] = (
+                    _catalog_max_input_tokens(model_config.lite_id)
+                )
+            return self._max_input_tokens[model_config.lite_id]
+
+    def check_context_window(self, messages: List, model_config: ModelConfig) -> int:
+        """Counts the prompt tokens of the messages and raises ContextWindowExceeded if the model would reject them."""
+        prompt_tokens = self.count_messages(messages, model_config)
+        max_input_tokens = self.max_input_tokens(model_config)
+        if max_input_tokens is not None and prompt_tokens > max_input_tokens:
+            HaivenLogger.get().warn(
+                f"Rejected a request with {prompt_tokens} tokens for {model_config.lite_id}, which accepts {max_input_tokens}",
+                extra={
+                    "INFO": "ContextWindowExceeded",
+                    "model": model_config.lite_id,
+                    "promptTokens": prompt_tokens,
+                    "maxInputTokens": max_input_tokens,
+                },
+            )
+            raise ContextWindowExceeded(
+                model_config.lite_id, prompt_tokens, max_input_tokens
+            )
+        return prompt_tokens
+
+    def _encoding(self, encoding_name: str) -> Optional[tiktoken.Encoding]:
+        with self._lock:
+            if encoding_name not in self._encodings:
+                try:
+                    # loading LiteLLM's default encoding points tiktoken at the encodings bundled
+                    # with LiteLLM, so they are not downloaded
+                    litellm.encoding
+                    self._encodings[encoding_name] = tiktoken.get_encoding(
+                        encoding_name
+                    )
+                except Exception as error:
+                    # without the encoding, e.g. offline with a custom tiktoken cache, tokens are estimated
+                    HaivenLogger.get().warn(
+                        f"Could not load the {encoding_name} token encoding, estimating token counts instead: {error}",
+                        extra={"INFO": "TokenEncodingUnavailable"},
+                    )
+                    self._encodings[encoding_name] = None
+            return self._encodings[encoding_name]
+
+
+def _catalog_max_input_tokens(lite_id: str) -> Optional[int]:
+    try:
+        return litellm.get_model_info(lite_id).get("max_input_tokens")
+    except Exception:
+        # not in the catalog, e.g. Azure deployments with custom names
+        return None
@@ -259,6 +259,21 @@ class Server:
             allow_headers=["*"],
         )
 
+    def record_request_metrics(self, app):
+        @app.middleware("http")
+        async def request_metrics(request: Request, call_next):
+            started = time.monotonic()
+            response = await call_next(request)
+            # the route's path template, so ids in paths do not each add a time series
+            route = request.scope.get("route")
+            self.chat_manager.telemetry.record_http_request(
+                request.method,
+                getattr(route, "path", "unmatched"),
+                response.status_code,
+                (time.monotonic() - started) * 1000,
+            )
+            return response
+
     def serve_static_resources(self, app):
         static_dir = Path("./resources/static")
         static_dir.mkdir(parents=True, exist_ok=True)
@@ -301,6 +316,7 @@ class Server:
         app = FastAPI()
 
         self.user_endpoints(app)
+        self.record_request_metrics(app)
         self.serve_static(app)
         self.boba_api.add_endpoints(app)
 
@@ -0,0 +1,490 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+from llms.chat_session_store import (
+    RedisSessionBackend,
+    SessionBackend,
+    SessionSweeper,
+    SerializedChatSessionStore,
+    ServerChatSessionMemory,
+    SqliteSessionBackend,
+    create_chat_session_store,
+    deserialize_messages,
+    serialize_messages,
+)
+from llms.chat_session_store_config import ChatSessionStoreConfig
+from llms.chats import ChatManager, ChatOptions, JSONChat, StreamingChat
+from llms.clients import HaivenAIMessage, HaivenHumanMessage, HaivenSystemMessage
+from llms.memory_compaction import ConversationSummary
+from llms.memory_compaction_config import MemoryCompactionConfig
+from llms.session_locks import SessionBusy, SessionLocks
+from llms.telemetry import ChatTelemetry
+from llms.model_config import ModelConfig
+from llms.query_rewrite_config import QueryRewriteConfig
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        value = self.values.get(key)
+        return value[0].encode("utf-8") if value else None
+
+    def set(self, key, value, ex=None):
+        self.values[key] = (value, ex)
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+def create_chat_manager(
+    chat_session_store, concurrent_requests=ChatSessionStoreConfig.QUEUE
+):
+    config_service = MagicMock()
+    config_service.load_query_rewrite_config.return_value = QueryRewriteConfig()
+    config_service.load_memory_compaction_config.return_value = MemoryCompactionConfig()
+    config_service.get_model.side_effect = ValueError("Model not found")
+    knowledge_manager = MagicMock()
+    knowledge_manager.get_system_message.return_value = "System"
+    knowledge_manager.knowledge_base_markdown.aggregate_all_contexts.return_value = (
+        "the context"
+    )
+    llm_chat_factory = MagicMock()
+
+    def new_chat_client(model_config, feature):
+        chat_client = MagicMock()
+        chat_client.model_config = model_config
+        chat_client.stream.side_effect = lambda messages: iter([{"content": "Paris"}])
+        return chat_client
+
+    llm_chat_factory.new_chat_client.side_effect = new_chat_client
+    return ChatManager(
+        config_service,
+        chat_session_store,
+        llm_chat_factory,
+        knowledge_manager,
+        concurrent_requests=concurrent_requests,
+    )
+
+
+MODEL = ModelConfig("perplexity", "perplexity", "Perplexity")
+
+
+class TestChatSessionStore:
+    def test_messages_survive_serialization(self):
+        messages = [
+            HaivenSystemMessage(content="System", segments=["System"]),
+            ConversationSummary.of("They talked about France"),
+            HaivenHumanMessage(content="[]", state_snapshot=True),
+            HaivenAIMessage(content="[1]"),
+        ]
+
+        restored = deserialize_messages(serialize_messages(messages))
+
+        assert [type(message) for message in restored] == [
+            type(message) for message in messages
+        ]
+        assert restored == messages
+
+    def test_system_messages_store_their_text_once(self):
+        message = HaivenSystemMessage(
+            content="System\n\nContexts", segments=["System", "\n\nContexts"]
+        )
+
+        data = serialize_messages([message])
+        restored = deserialize_messages(data)[0]
+
+        assert "content" not in data[0]
+        assert restored.content == "System\n\nContexts"
+        assert restored.segments == ["System", "\n\nContexts"]
+        assert serialize_messages([HaivenSystemMessage(content="System")]) == [
+            {"type": "HaivenSystemMessage", "content": "System"}
+        ]
+
+    def test_messages_are_slotted_and_print_their_content(self):
+        message = HaivenHumanMessage(content="Hi", state_snapshot=True)
+
+        assert not hasattr(message, "__dict__")
+        assert str(message) == "content='Hi'"
+        assert message != HaivenAIMessage(content="Hi")
+
+    def test_sessions_share_the_system_prompt_and_contexts(self):
+        store = ServerChatSessionMemory()
+        chat_manager = create_chat_manager(store)
+        _, first = chat_manager.streaming_chat(
+            MODEL, options=ChatOptions(category="chat")
+        )
+        _, second = chat_manager.streaming_chat(
+            MODEL, options=ChatOptions(category="chat")
+        )
+        list(first.run("What is the capital of France?"))
+
+        report = store.memory_report()
+
+        assert first.memory[0].content is second.memory[0].content
+        assert report["sessions"] == 2
+        assert report["shared_texts"] == 3
+        assert report["session_bytes"] == (
+            first.memory_footprint_bytes() + second.memory_footprint_bytes()
+        )
+        largest = report["largest_sessions"][0]
+        assert largest["category"] == "chat"
+        assert largest["messages"] == 3
+
+    def test_sessions_continue_in_another_process(self, tmp_path):
+        path = str(tmp_path / "sessions.sqlite")
+        first_worker = create_chat_manager(
+            SerializedChatSessionStore(SqliteSessionBackend(path))
+        )
+        session_key, chat = first_worker.streaming_chat(
+            MODEL, options=ChatOptions(category="chat", in_chunks=True)
+        )
+        list(chat.run("What is the capital of France?"))
+
+        second_worker = create_chat_manager(
+            SerializedChatSessionStore(SqliteSessionBackend(path))
+        )
+        restored_key, restored_chat = second_worker.streaming_chat(
+            MODEL, session_id=session_key
+        )
+
+        assert restored_key == session_key
+        assert isinstance(restored_chat, StreamingChat)
+        assert restored_chat.stream_in_chunks
+        assert restored_chat.category == "chat"
+        assert restored_chat.memory == chat.memory
+        assert "the context" in restored_chat.memory[0].content
+        assert restored_chat.memory[-1].content == "Paris"
+
+    def test_json_chats_are_restored_as_json_chats(self):
+        chat_manager = create_chat_manager(
+            SerializedChatSessionStore(RedisSessionBackend("", client=FakeRedis()))
+        )
+        session_key, _ = chat_manager.json_chat(
+            MODEL, options=ChatOptions(category="scenarios")
+        )
+
+        assert isinstance(chat_manager.get_session(session_key), JSONChat)
+
+    def test_sessions_expire_after_their_ttl(self, tmp_path):
+        clock = FakeClock()
+        store = SerializedChatSessionStore(
+            SqliteSessionBackend(str(tmp_path / "sessions.sqlite"), clock),
+            ttl_seconds=60,
+            clock=clock,
+        )
+        session_key = store.add_new_entry("chat", "user")
+
+        clock.now += 30
+        store.get_chat(session_key)
+        clock.now += 59
+        store.get_chat(session_key)
+        clock.now += 61
+
+        with pytest.raises(ValueError, match="might have expired"):
+            store.get_chat(session_key)
+
+    def test_only_the_owner_can_dump_a_session(self):
+        store = SerializedChatSessionStore(RedisSessionBackend("", client=FakeRedis()))
+        chat_manager = create_chat_manager(store)
+        session_key, chat = chat_manager.streaming_chat(
+            MODEL, options=ChatOptions(category="chat", user_identifier="owner")
+        )
+        list(chat.run("Hello"))
+
+        assert "Paris" in store.dump_as_text(session_key, "owner")
+        assert "not found for this user" in store.dump_as_text(session_key, "other")
+        store.delete_entry(session_key)
+        assert "not found" in store.dump_as_text(session_key, "owner")
+
+    def test_redis_keys_expire_with_the_session_ttl(self):
+        redis = FakeRedis()
+        store = SerializedChatSessionStore(
+            RedisSessionBackend("", client=redis), ttl_seconds=90
+        )
+
+        session_key = store.add_new_entry("chat", "user")
+
+        assert redis.values[RedisSessionBackend.KEY_PREFIX + session_key][1] == 90
+
+    def test_memory_backend_is_the_default(self):
+        store = create_chat_session_store(ChatSessionStoreConfig.from_dict({}))
+
+        assert isinstance(store, ServerChatSessionMemory)
+        assert store.ttl_seconds == 1800
+        with pytest.raises(ValueError):
+            ChatSessionStoreConfig(backend="files")
+
+    def test_memory_sessions_expire_in_order_of_their_last_access(self):
+        clock = FakeClock()
+        store = ServerChatSessionMemory(ttl_seconds=60, clock=clock)
+        first = store.add_new_entry("chat", "user")
+        clock.now += 30
+        second = store.add_new_entry("chat", "user")
+        clock.now += 20
+        store.get_chat(first)
+        clock.now += 45
+
+        assert store.remove_expired() == 1
+        assert list(store.USER_CHATS) == [first]
+        with pytest.raises(ValueError, match="might have expired"):
+            store.get_chat(second)
+
+    def test_expired_memory_sessions_cannot_be_continued_before_the_sweep(self):
+        clock = FakeClock()
+        store = ServerChatSessionMemory(ttl_seconds=60, clock=clock)
+        session_key = store.add_new_entry("chat", "user")
+        clock.now += 61
+
+        with pytest.raises(ValueError, match="might have expired"):
+            store.get_chat(session_key)
+        assert store.stats()["evictions"] == {"expired": 1, "capacity": 0}
+
+    def test_least_recently_used_sessions_are_evicted_beyond_the_cap(self):
+        store = ServerChatSessionMemory(max_sessions=2)
+        first = store.add_new_entry("chat", "user")
+        second = store.add_new_entry("chat", "user")
+        store.get_chat(first)
+
+        third = store.add_new_entry("chat", "user")
+
+        assert list(store.USER_CHATS) == [first, third]
+        assert second not in store.USER_CHATS
+        assert store.stats() == {
+            "sessions": 2,
+            "max_sessions": 2,
+            "evictions": {"expired": 0, "capacity": 1},
+        }
+
+    def test_sweeper_removes_expired_sessions_in_the_background(self):
+        store = MagicMock()
+        swept = threading.Event()
+        store.remove_expired.side_effect = lambda: swept.set()
+        sweeper = SessionSweeper(store, 0.01)
+
+        sweeper.start()
+        assert swept.wait(1)
+        sweeper.stop()
+
+    def test_expired_sqlite_sessions_are_counted(self, tmp_path):
+        clock = FakeClock()
+        store = SerializedChatSessionStore(
+            SqliteSessionBackend(str(tmp_path / "sessions.sqlite"), clock),
+            ttl_seconds=60,
+            clock=clock,
+        )
+        store.add_new_entry("chat", "user")
+        store.add_new_entry("chat", "user")
+        clock.now += 30
+        store.add_new_entry("chat", "user")
+        clock.now += 31
+
+        assert store.remove_expired() == 2
+        assert store.stats() == {"sessions": 1, "evictions": {"expired": 2}}
+
+    def test_session_counts_are_in_the_metrics(self):
+        store = ServerChatSessionMemory(max_sessions=1)
+        store.add_new_entry("chat", "user")
+        store.add_new_entry("chat", "user")
+
+        text = ChatTelemetry().to_prometheus(session_stats=store.stats())
+
+        assert "haiven_chat_sessions 1" in text
+        assert 'haiven_chat_session_evictions_total{reason="capacity"} 1' in text
+
+    def test_turns_of_a_session_run_in_the_order_they_arrived(self):
+        session_locks = SessionLocks()
+        events = []
+
+        async def turn(name, session_key):
+            async with session_locks.turn(session_key) as waited:
+                events.append((name, "start", waited))
+                await asyncio.sleep(0.01)
+                events.append((name, "end", waited))
+
+        async def run():
+            await asyncio.gather(
+                turn("first", "a"), turn("second", "a"), turn("other", "b")
+            )
+
+        asyncio.run(run())
+
+        assert [event for event in events if event[0] != "other"] == [
+            ("first", "start", False),
+            ("first", "end", False),
+            ("second", "start", True),
+            ("second", "end", True),
+        ]
+        assert ("other", "start", False) in events
+        assert not session_locks.is_busy("a")
+
+    def test_requests_to_a_busy_session_can_be_rejected(self):
+        chat_manager = create_chat_manager(
+            ServerChatSessionMemory(), ChatSessionStoreConfig.REJECT
+        )
+        session_key, chat = chat_manager.streaming_chat(MODEL)
+
+        async def run():
+            async with chat_manager.session_turn(session_key, chat):
+                with pytest.raises(SessionBusy):
+                    chat_manager.streaming_chat(MODEL, session_id=session_key)
+            return chat_manager.streaming_chat(MODEL, session_id=session_key)
+
+        assert asyncio.run(run()) == (session_key, chat)
+
+    def test_requests_are_rejected_before_the_turn_they_wait_for_has_started(self):
+        chat_manager = create_chat_manager(
+            ServerChatSessionMemory(), ChatSessionStoreConfig.REJECT
+        )
+        session_key, chat = chat_manager.streaming_chat(MODEL)
+        first_turn = chat_manager.session_turn(session_key, chat)
+
+        # neither stream has been iterated yet
+        with pytest.raises(SessionBusy):
+            chat_manager.streaming_chat(MODEL, session_id=session_key)
+        with pytest.raises(SessionBusy):
+            chat_manager.session_turn(session_key, chat)
+
+        async def run():
+            async with first_turn:
+                pass
+
+        asyncio.run(run())
+        assert not chat_manager.session_locks.is_busy(session_key)
+
+    def test_requests_fork_before_the_turn_they_wait_for_has_started(self):
+        chat_manager = create_chat_manager(
+            ServerChatSessionMemory(), ChatSessionStoreConfig.FORK
+        )
+        session_key, chat = chat_manager.streaming_chat(MODEL)
+        first_turn = chat_manager.session_turn(session_key, chat)
+
+        forked_key, _ = chat_manager.streaming_chat(MODEL, session_id=session_key)
+
+        assert forked_key != session_key
+        first_turn.release()
+
+    def test_each_turn_keeps_the_claim_of_its_own_request(self):
+        chat_manager = create_chat_manager(
+            SerializedChatSessionStore(RedisSessionBackend("", client=FakeRedis()))
+        )
+        session_key, first_chat = chat_manager.streaming_chat(MODEL)
+        _, second_chat = chat_manager.streaming_chat(MODEL, session_id=session_key)
+        first_turn = chat_manager.session_turn(session_key, first_chat)
+        second_turn = chat_manager.session_turn(session_key, second_chat)
+        events = []
+
+        async def turn(name, session_turn, chat):
+            async with session_turn:
+                events.append((name, "start"))
+                await asyncio.sleep(0.01)
+                chat.memory.append(HaivenHumanMessage(content=name))
+                chat_manager.chat_session_memory.store_chat(session_key, chat)
+                events.append((name, "end"))
+
+        async def run():
+            await asyncio.gather(
+                turn("first", first_turn, first_chat),
+                turn("second", second_turn, second_chat),
+            )
+
+        asyncio.run(run())
+
+        assert not first_turn.claim.waited
+        assert second_turn.claim.waited
+        assert events == [
+            ("first", "start"),
+            ("first", "end"),
+            ("second", "start"),
+            ("second", "end"),
+        ]
+        # the second turn reloaded the memory the first one stored
+        assert [message.content for message in second_chat.memory[-2:]] == [
+            "first",
+            "second",
+        ]
+        assert not chat_manager.session_locks.is_busy(session_key)
+
+    def test_turns_that_never_run_can_be_released(self):
+        chat_manager = create_chat_manager(
+            ServerChatSessionMemory(), ChatSessionStoreConfig.REJECT
+        )
+        session_key, chat = chat_manager.streaming_chat(MODEL)
+        session_turn = chat_manager.session_turn(session_key, chat)
+        assert chat_manager.session_locks.is_busy(session_key)
+
+        session_turn.release()
+        session_turn.release()
+
+        assert not chat_manager.session_locks.is_busy(session_key)
+
+    def test_calling_streaming_chat_alone_does_not_claim_the_session(self):
+        chat_manager = create_chat_manager(
+            ServerChatSessionMemory(), ChatSessionStoreConfig.REJECT
+        )
+        session_key, chat = chat_manager.streaming_chat(MODEL)
+
+        assert chat_manager.streaming_chat(MODEL, session_id=session_key) == (
+            session_key,
+            chat,
+        )
+
+    def test_requests_to_a_busy_session_can_fork_it(self):
+        chat_manager = create_chat_manager(
+            ServerChatSessionMemory(), ChatSessionStoreConfig.FORK
+        )
+        session_key, chat = chat_manager.streaming_chat(
+            MODEL, options=ChatOptions(category="chat")
+        )
+        list(chat.run("What is the capital of France?"))
+
+        async def run():
+            async with chat_manager.session_turn(session_key, chat):
+                running_turn = chat.run("And of Spain?")
+                next(running_turn)
+                forked = chat_manager.streaming_chat(MODEL, session_id=session_key)
+                list(running_turn)
+                return forked
+
+        forked_key, forked_chat = asyncio.run(run())
+
+        assert forked_key != session_key
+        assert forked_key.startswith("chat-")
+        assert len(forked_chat.memory) == 3
+        assert len(chat.memory) == 5
+        assert chat_manager.get_session(forked_key) is forked_chat
+
+    def test_json_chats_answer_every_turn_in_a_message_of_its_own(self):
+        chat_manager = create_chat_manager(ServerChatSessionMemory())
+        _, chat = chat_manager.json_chat(MODEL)
+
+        list(chat.run("First"))
+        list(chat.run("Second"))
+
+        assert [type(message) for message in chat.memory[1:]] == [
+            HaivenHumanMessage,
+            HaivenAIMessage,
+            HaivenHumanMessage,
+            HaivenAIMessage,
+        ]
+        assert chat.memory[-1].content == "Paris"
+
+    def test_incomplete_session_backends_cannot_be_created(self):
+        class GetOnlyBackend(SessionBackend):
+            def get(self, key):
+                return None
+
+        with pytest.raises(TypeError):
+            GetOnlyBackend()
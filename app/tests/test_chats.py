@@ -1,4 +1,5 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
 import os
 import unittest
 
@@ -62,6 +63,98 @@ class TestChats(unittest.TestCase):
         assert isinstance(streaming_chat.memory[1], HaivenHumanMessage)
         assert isinstance(streaming_chat.memory[2], HaivenAIMessage)
 
+    def test_streaming_chat_run_async(self):
+        mock_knowledge_manager = MagicMock()
+        mock_knowledge_manager.get_system_message.return_value = (
+            "You are a test assistant"
+        )
+        mock_knowledge_manager.knowledge_base_markdown.aggregate_all_contexts.return_value = None
+
+        async def stream(memory):
+            for part in ["Pa", "ris"]:
+                yield {"content": part}
+
+        mock_chat_client = MagicMock()
+        mock_chat_client.astream.side_effect = stream
+        streaming_chat = StreamingChat(
+            chat_client=mock_chat_client, knowledge_manager=mock_knowledge_manager
+        )
+
+        async def collect():
+            return [
+                event
+                async for event in streaming_chat.run_async(
+                    "What is the capital of France?"
+                )
+            ]
+
+        assert asyncio.run(collect()) == ["Pa", "ris"]
+        mock_chat_client.stream.assert_not_called()
+        assert len(streaming_chat.memory) == 3
+        assert streaming_chat.memory[2].content == "Paris"
+
+    def test_streaming_chat_run_with_document_async_adds_sources(self):
+        mock_knowledge_manager = MagicMock()
+        mock_knowledge_manager.get_system_message.return_value = (
+            "You are a test assistant"
+        )
+        mock_knowledge_manager.knowledge_base_markdown.aggregate_all_contexts.return_value = None
+
+        async def stream(memory):
+            yield {"content": "Paris"}
+
+        mock_chat_client = MagicMock()
+        mock_chat_client.astream.side_effect = stream
+        streaming_chat = StreamingChat(
+            chat_client=mock_chat_client, knowledge_manager=mock_knowledge_manager
+        )
+        streaming_chat._similarity_search_based_on_history = MagicMock(
+            return_value=("France has Paris", "- source.pdf")
+        )
+
+        async def collect():
+            return [
+                event
+                async for event in streaming_chat.run_with_document_async(
+                    ["document-key"], "What is the capital of France?"
+                )
+            ]
+
+        events = asyncio.run(collect())
+
+        assert events[0] == ("Paris", "- source.pdf")
+        assert events[-1] == ("\n\n- source.pdf", "- source.pdf")
+        # The plain question is kept in memory instead of the prompt with the context
+        assert streaming_chat.memory[1].content == "What is the capital of France?"
+
+    def test_json_chat_run_async(self):
+        mock_knowledge_manager = MagicMock()
+        mock_knowledge_manager.get_system_message.return_value = (
+            "You are a test assistant"
+        )
+        mock_knowledge_manager.knowledge_base_markdown.aggregate_all_contexts.return_value = None
+
+        async def stream(memory):
+            for chunk in [{"content": '{"key":"v'}, {"content": 'alue"}'}]:
+                yield chunk
+
+        mock_chat_client = MagicMock()
+        mock_chat_client.astream.side_effect = stream
+        json_chat = JSONChat(
+            chat_client=mock_chat_client, knowledge_manager=mock_knowledge_manager
+        )
+
+        async def collect():
+            return [event async for event in json_chat.run_async("Give me JSON")]
+
+        events = asyncio.run(collect())
+
+        assert [event.replace("\n", "") for event in events] == [
+            '{"data": "{\\"key\\":\\"v"}',
+            '{"data": "alue\\"}"}',
+        ]
+        assert json_chat.memory[2].content == '{"key":"value"}'
+
     def test_dump_as_text(self):
         # Arrange
         category = "category"
@@ -0,0 +1,185 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
+
+from unittest import mock
+
+import faiss
+import numpy as np
+import pytest
+from embeddings.chunk_store import (
+    CHUNKS_FILE_NAME,
+    INDEX_FILE_NAME,
+    VECTORS_FILE_NAME,
+    ChunkStore,
+    RowPositions,
+    convert_docstore,
+    write_chunk_store,
+)
+from embeddings.client import EmbeddingsClient
+from embeddings.model import EmbeddingModel
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import FakeEmbeddings
+
+
+def create_kb_folder(path) -> str:
+    store = FAISS.from_embeddings(
+        text_embeddings=[
+            ("first chunk", [1.0, 0.0, 0.0, 0.0]),
+            ("second chunk", [0.0, 1.0, 0.0, 0.0]),
+            ("third chunk", [0.0, 0.0, 1.0, 0.0]),
+        ],
+        embedding=FakeEmbeddings(size=4),
+        metadatas=[{"page": 1}, {"page": 2}, {"page": 3}],
+    )
+    kb_folder_path = os.path.join(path, "document.kb")
+    store.save_local(kb_folder_path)
+    return kb_folder_path
+
+
+def create_embeddings_client() -> EmbeddingsClient:
+    return EmbeddingsClient(
+        EmbeddingModel(
+            id="ollama-embeddings",
+            name="Ollama",
+            provider="ollama",
+            config={"model": "ollama-embeddings"},
+        )
+    )
+
+
+class TestChunkStore:
+    def test_reads_chunks_by_row(self, tmp_path):
+        chunks_file_path = tmp_path / CHUNKS_FILE_NAME
+        write_chunk_store(
+            chunks_file_path,
+            [
+                Document(page_content="first", metadata={"source": "a.pdf"}),
+                Document(page_content="second", metadata={}),
+            ],
+            ["id-1", "id-2"],
+        )
+
+        chunk_store = ChunkStore(chunks_file_path)
+
+        assert len(chunk_store) == 2
+        first_chunk = chunk_store.search(0)
+        assert first_chunk.id == "id-1"
+        assert first_chunk.page_content == "first"
+        assert first_chunk.metadata == {"source": "a.pdf"}
+        assert chunk_store.search(1).page_content == "second"
+        assert chunk_store.search(2) == "ID 2 not found."
+        assert not os.path.exists(f"{chunks_file_path}.tmp")
+
+    def test_row_positions_map_rows_to_themselves(self):
+        row_positions = RowPositions(3)
+
+        assert len(row_positions) == 3
+        assert list(row_positions) == [0, 1, 2]
+        assert row_positions[2] == 2
+        with pytest.raises(KeyError):
+            row_positions[3]
+
+    def test_memory_mapped_store_returns_same_results_as_pickled_store(self, tmp_path):
+        kb_folder_path = create_kb_folder(tmp_path)
+        convert_docstore(kb_folder_path)
+        embeddings_client = create_embeddings_client()
+
+        pickled_store = embeddings_client.generate_from_filesystem(kb_folder_path)
+        memory_mapped_store = embeddings_client.generate_from_filesystem(
+            kb_folder_path, memory_map=True
+        )
+
+        assert isinstance(memory_mapped_store.docstore, ChunkStore)
+        query_vector = [0.0, 0.9, 0.1, 0.0]
+        expected = pickled_store.similarity_search_with_score_by_vector(
+            query_vector, k=2
+        )
+        actual = memory_mapped_store.similarity_search_with_score_by_vector(
+            query_vector, k=2
+        )
+        assert [(chunk.page_content, chunk.metadata) for chunk, _ in actual] == [
+            (chunk.page_content, chunk.metadata) for chunk, _ in expected
+        ]
+        assert [score for _, score in actual] == pytest.approx(
+            [score for _, score in expected]
+        )
+
+    def test_memory_mapped_loading_falls_back_to_pickled_docstore(self, tmp_path):
+        kb_folder_path = create_kb_folder(tmp_path)
+
+        store = create_embeddings_client().generate_from_filesystem(
+            kb_folder_path, memory_map=True
+        )
+
+        chunk, _ = store.similarity_search_with_score_by_vector(
+            [1.0, 0.0, 0.0, 0.0], k=1
+        )[0]
+        assert chunk.page_content == "first chunk"
+        assert not isinstance(store.docstore, ChunkStore)
+
+    def test_loads_folder_with_vectors_and_chunk_store_without_pickle(self, tmp_path):
+        kb_folder_path = tmp_path / "document.kb"
+        kb_folder_path.mkdir()
+        np.save(
+            kb_folder_path / VECTORS_FILE_NAME,
+            np.array([[1.0, 0.0], [0.0, 1.0]], dtype=np.float32),
+        )
+        write_chunk_store(
+            kb_folder_path / CHUNKS_FILE_NAME,
+            [
+                Document(page_content="first", metadata={"page": 1}),
+                Document(page_content="second", metadata={"page": 2}),
+            ],
+            ["id-1", "id-2"],
+        )
+
+        store = create_embeddings_client().generate_from_filesystem(kb_folder_path)
+
+        chunk, score = store.similarity_search_with_score_by_vector([0.1, 0.9], k=1)[0]
+        assert chunk.page_content == "second"
+        assert chunk.metadata == {"page": 2}
+        assert score == pytest.approx(0.02)
+        assert not (kb_folder_path / "index.pkl").exists()
+
+    def test_memory_maps_index_of_folder_with_vectors_and_chunk_store(self, tmp_path):
+        kb_folder_path = tmp_path / "document.kb"
+        kb_folder_path.mkdir()
+        vectors = np.array([[1.0, 0.0], [0.0, 1.0]], dtype=np.float32)
+        np.save(kb_folder_path / VECTORS_FILE_NAME, vectors)
+        index = faiss.IndexFlatL2(2)
+        index.add(vectors)
+        faiss.write_index(index, str(kb_folder_path / INDEX_FILE_NAME))
+        write_chunk_store(
+            kb_folder_path / CHUNKS_FILE_NAME,
+            [Document(page_content="first"), Document(page_content="second")],
+            ["id-1", "id-2"],
+        )
+
+        with mock.patch(
+            "embeddings.client.faiss.read_index", wraps=faiss.read_index
+        ) as read_index:
+            store = create_embeddings_client().generate_from_filesystem(
+                kb_folder_path, memory_map=True
+            )
+
+        read_index.assert_called_once_with(
+            str(kb_folder_path / INDEX_FILE_NAME),
+            faiss.IO_FLAG_MMAP | faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY,
+        )
+        assert isinstance(store.docstore, ChunkStore)
+        chunk, _ = store.similarity_search_with_score_by_vector([0.1, 0.9], k=1)[0]
+        assert chunk.page_content == "second"
+
+    def test_rejects_folder_with_mismatching_vectors_and_chunks(self, tmp_path):
+        kb_folder_path = tmp_path / "document.kb"
+        kb_folder_path.mkdir()
+        np.save(kb_folder_path / VECTORS_FILE_NAME, np.zeros((2, 2), dtype=np.float32))
+        write_chunk_store(
+            kb_folder_path / CHUNKS_FILE_NAME,
+            [Document(page_content="first")],
+            ["id-1"],
+        )
+
+        with pytest.raises(ValueError):
+            create_embeddings_client().generate_from_filesystem(kb_folder_path)
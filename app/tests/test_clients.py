@@ -0,0 +1,81 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+import os
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from llms.clients import (
+    ChatClient,
+    HaivenHumanMessage,
+    MockChoice,
+    MockDelta,
+    MockResult,
+)
+
+
+def model_results():
+    last_result = MockResult(choices=[MockChoice(delta=MockDelta(content="ris"))])
+    last_result.usage = SimpleNamespace(
+        prompt_tokens=10, completion_tokens=2, total_tokens=12
+    )
+    return [
+        MockResult(choices=[MockChoice(delta=MockDelta(content="Pa"))]),
+        last_result,
+    ]
+
+
+async def collect(async_iterable):
+    return [item async for item in async_iterable]
+
+
+class TestChatClient:
+    def setup_method(self):
+        model_config = MagicMock()
+        model_config.lite_id = "azure/gpt-4"
+        model_config.provider = "azure"
+        self.chat_client = ChatClient(model_config)
+        self.messages = [HaivenHumanMessage(content="What is the capital of France?")]
+
+    @patch("llms.clients.llmCompletionAsync")
+    @patch("llms.clients.llmCompletion")
+    def test_astream_yields_the_same_chunks_as_stream(
+        self, mock_completion, mock_completion_async
+    ):
+        async def completion_async(**kwargs):
+            async def results():
+                for result in model_results():
+                    yield result
+
+            return results()
+
+        mock_completion.return_value = iter(model_results())
+        mock_completion_async.side_effect = completion_async
+
+        chunks = list(self.chat_client.stream(self.messages))
+        async_chunks = asyncio.run(collect(self.chat_client.astream(self.messages)))
+
+        assert async_chunks == chunks
+        assert async_chunks == [
+            {"content": "Pa"},
+            {"content": "ris"},
+            {
+                "usage": {
+                    "prompt_tokens": 10,
+                    "completion_tokens": 2,
+                    "total_tokens": 12,
+                    "cached_tokens": 0,
+                    "cache_creation_tokens": 0,
+                }
+            },
+        ]
+        assert (
+            mock_completion_async.call_args.kwargs == mock_completion.call_args.kwargs
+        )
+        assert mock_completion_async.call_args.kwargs["stream"] is True
+
+    @patch.dict(os.environ, {"MOCK_AI": "true"})
+    def test_astream_uses_mock_model_when_mocking_ai(self):
+        chunks = asyncio.run(collect(self.chat_client.astream(self.messages)))
+
+        assert chunks[0] == {"content": "[Mock response]"}
+        assert "usage" in chunks[-1]
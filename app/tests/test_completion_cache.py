@@ -0,0 +1,163 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+from unittest.mock import MagicMock, patch
+
+import pytest
+from llms.chat_events import ChatEventFormatter, create_token_usage_event
+from llms.clients import ChatClient, HaivenHumanMessage, HaivenSystemMessage
+from llms.completion_cache import (
+    CompletionCache,
+    InMemoryCompletionCache,
+    SqliteCompletionCache,
+    completion_cache_key,
+    create_completion_cache,
+    replay_chunks,
+)
+from llms.completion_cache_config import CompletionCacheConfig
+
+MESSAGES = [
+    HaivenSystemMessage(content="You are a test assistant"),
+    HaivenHumanMessage(content="Give me three scenarios as JSON"),
+]
+CHUNKS = [
+    {"content": "[ {"},
+    {"content": '"title": "Scenario" } ]'},
+    {"usage": {"prompt_tokens": 25, "completion_tokens": 15, "total_tokens": 40}},
+]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def create_chat_client(completion_cache):
+    model_config = MagicMock()
+    model_config.lite_id = "azure/gpt-4o"
+    model_config.provider = "azure"
+    return ChatClient(model_config, completion_cache=completion_cache)
+
+
+class TestCompletionCache:
+    def test_key_depends_on_model_and_messages(self):
+        json_messages = [message.to_json() for message in MESSAGES]
+
+        key = completion_cache_key("azure/gpt-4o", json_messages)
+
+        assert key == completion_cache_key("azure/gpt-4o", list(json_messages))
+        assert key.startswith("azure/gpt-4o:")
+        assert key != completion_cache_key("bedrock/claude", json_messages)
+        assert key != completion_cache_key("azure/gpt-4o", json_messages[1:])
+
+    def test_replayed_usage_is_marked_cached(self):
+        assert replay_chunks(CHUNKS)[-1] == {
+            "usage": {
+                "prompt_tokens": 25,
+                "completion_tokens": 15,
+                "total_tokens": 40,
+                "cached": True,
+            }
+        }
+        assert replay_chunks(CHUNKS[:1])[-1]["usage"]["total_tokens"] == 0
+
+    def test_identical_requests_are_answered_from_the_cache(self):
+        chat_client = create_chat_client(InMemoryCompletionCache())
+
+        with patch.object(
+            ChatClient, "_stream_from_model", return_value=iter(CHUNKS)
+        ) as mock_stream_from_model:
+            first_chunks = list(chat_client.stream(MESSAGES))
+            second_chunks = list(chat_client.stream(MESSAGES))
+
+        mock_stream_from_model.assert_called_once()
+        assert first_chunks == CHUNKS
+        assert second_chunks == replay_chunks(CHUNKS)
+
+    def test_async_stream_replays_the_cached_chunks(self):
+        completion_cache = InMemoryCompletionCache()
+        chat_client = create_chat_client(completion_cache)
+        completion_cache.put(
+            completion_cache_key(
+                "azure/gpt-4o", [message.to_json() for message in MESSAGES]
+            ),
+            CHUNKS,
+        )
+
+        async def collect():
+            return [chunk async for chunk in chat_client.astream(MESSAGES)]
+
+        with patch.object(ChatClient, "_astream_from_model") as mock_from_model:
+            assert asyncio.run(collect()) == replay_chunks(CHUNKS)
+        mock_from_model.assert_not_called()
+
+    def test_failed_responses_are_not_cached(self):
+        completion_cache = InMemoryCompletionCache()
+        chat_client = create_chat_client(completion_cache)
+
+        def failing_stream(messages):
+            yield CHUNKS[0]
+            raise RuntimeError("connection reset")
+
+        with patch.object(ChatClient, "_stream_from_model", side_effect=failing_stream):
+            with pytest.raises(RuntimeError):
+                list(chat_client.stream(MESSAGES))
+
+        assert completion_cache.stats()["size"] == 0
+
+    def test_sqlite_cache_evicts_expired_and_least_recently_used(self, tmp_path):
+        clock = FakeClock()
+        path = str(tmp_path / "cache" / "completions.sqlite")
+        completion_cache = SqliteCompletionCache(
+            path, max_entries=2, ttl_seconds=60, clock=clock
+        )
+
+        completion_cache.put("a", CHUNKS)
+        clock.now += 1
+        completion_cache.put("b", CHUNKS)
+        clock.now += 1
+        assert completion_cache.get("a") == CHUNKS
+        completion_cache.put("c", CHUNKS)
+
+        assert completion_cache.get("b") is None
+        # survives being opened again, e.g. after a restart
+        reopened_cache = SqliteCompletionCache(
+            path, max_entries=2, ttl_seconds=60, clock=clock
+        )
+        assert reopened_cache.get("c") == CHUNKS
+
+        clock.now += 61
+        assert reopened_cache.get("c") is None
+        assert reopened_cache.stats()["size"] == 1
+
+    def test_cache_is_only_created_when_enabled(self, tmp_path):
+        assert create_completion_cache(CompletionCacheConfig()) is None
+        assert isinstance(
+            create_completion_cache(CompletionCacheConfig(enabled=True)),
+            InMemoryCompletionCache,
+        )
+        config = CompletionCacheConfig.from_dict(
+            {
+                "enabled": "true",
+                "backend": "sqlite",
+                "path": str(tmp_path / "completions.sqlite"),
+            }
+        )
+        assert isinstance(create_completion_cache(config), SqliteCompletionCache)
+        with pytest.raises(ValueError):
+            CompletionCacheConfig(backend="redis")
+
+    def test_cached_token_usage_event_is_flagged(self):
+        event = create_token_usage_event(25, 15, 40, "gpt-4o", cached=True)
+
+        assert '"cached":true' in ChatEventFormatter.format_for_streaming(event)
+
+    def test_incomplete_completion_caches_cannot_be_created(self):
+        class GetOnlyCache(CompletionCache):
+            def get(self, key):
+                return None
+
+        with pytest.raises(TypeError):
+            GetOnlyCache()
@@ -9,6 +9,8 @@ from llms.model_config import ModelConfig
 from llms.default_models import DefaultModels
 from embeddings.model import EmbeddingModel
 from config_service import ConfigService
+from knowledge.search_config import KnowledgeSearchConfig
+from llms.query_rewrite_config import QueryRewriteConfig
 from tests.utils import get_test_data_path
 
 
@@ -284,3 +286,54 @@ knowledge_pack_path: /non/existent/path
             assert cs.load_api_key_pseudonymization_salt() == "somesalt"
             assert cs.load_api_key_repository_file_path() == "somepath.json"
             os.unlink(tmp_file.name)
+
+    def test_load_knowledge_search_config(self):
+        config_service = ConfigService(self.config_path)
+        assert (
+            config_service.load_knowledge_search_config().search_mode
+            == KnowledgeSearchConfig.SEQUENTIAL
+        )
+
+        config_content = """
+        knowledge_search:
+          mode: ${MY_KNOWLEDGE_SEARCH_MODE}
+          memory_map: true
+        """
+        config_path = "test-env-config.yaml"
+        with open(config_path, "w") as f:
+            f.write(config_content)
+
+        os.environ["MY_KNOWLEDGE_SEARCH_MODE"] = "unified"
+
+        search_config = ConfigService(config_path).load_knowledge_search_config()
+        assert search_config.search_mode == KnowledgeSearchConfig.UNIFIED
+        assert search_config.memory_map is True
+
+        os.remove(config_path)
+
+    def test_unified_search_cannot_be_combined_with_lazy_loading(self):
+        with pytest.raises(ValueError):
+            KnowledgeSearchConfig.from_dict({"mode": "unified", "lazy_loading": "true"})
+
+    def test_load_query_rewrite_config(self):
+        config_service = ConfigService(self.config_path)
+        assert (
+            config_service.load_query_rewrite_config().strategy
+            == QueryRewriteConfig.LLM
+        )
+
+        config_content = """
+        query_rewrite:
+          strategy: heuristic
+          recent_turns: 3
+        """
+        config_path = "test-query-rewrite-config.yaml"
+        with open(config_path, "w") as f:
+            f.write(config_content)
+
+        query_rewrite_config = ConfigService(config_path).load_query_rewrite_config()
+        assert query_rewrite_config.strategy == QueryRewriteConfig.HEURISTIC
+        assert query_rewrite_config.recent_turns == 3
+        assert query_rewrite_config.max_keywords == 8
+
+        os.remove(config_path)
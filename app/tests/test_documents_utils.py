@@ -0,0 +1,71 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from unittest.mock import patch
+
+from embeddings.documents import DocumentsUtils, SourceIndex
+from langchain_core.documents import Document
+
+CHUNKS = [
+    Document(
+        page_content="first",
+        metadata={"source": "guide.pdf", "title": "Guide", "page": 1},
+    ),
+    Document(
+        page_content="second",
+        metadata={"source": "guide.pdf", "title": "Guide", "page": 1},
+    ),
+    Document(
+        page_content="third",
+        metadata={
+            "source": "https://example.com/article",
+            "title": "Article",
+            "authors": ["Ada", "Grace"],
+        },
+    ),
+    Document(page_content="fourth", metadata={"source": "guide.pdf", "page": 2}),
+]
+
+
+class TestDocumentsUtils:
+    def test_get_unique_sources_keeps_first_chunk_per_source_and_page(self):
+        unique_sources = DocumentsUtils.get_unique_sources(CHUNKS)
+
+        assert [doc.page_content for doc in unique_sources] == [
+            "first",
+            "third",
+            "fourth",
+        ]
+
+    def test_source_index_renders_same_items_as_documents_utils(self):
+        source_index = SourceIndex()
+        source_index.add_all(CHUNKS)
+
+        assert source_index.size() == 3
+        assert source_index.get_unique_search_result_items(CHUNKS) == [
+            DocumentsUtils.get_search_result_item(doc.metadata)
+            for doc in DocumentsUtils.get_unique_sources(CHUNKS)
+        ]
+        assert source_index.get_unique_search_result_items(CHUNKS)[0] == (
+            "[Guide](/kp-static/guide.pdf#page=1) (Page 1)"
+        )
+
+    def test_source_index_renders_each_source_only_once(self):
+        source_index = SourceIndex()
+        source_index.add_all(CHUNKS)
+
+        with patch.object(
+            DocumentsUtils, "get_search_result_item"
+        ) as get_search_result_item:
+            source_index.get_unique_search_result_items(CHUNKS)
+            source_index.get_search_result_item({"source": "new.pdf", "title": "New"})
+
+        get_search_result_item.assert_called_once_with(
+            {"source": "new.pdf", "title": "New"}
+        )
+
+    def test_source_index_can_be_cleared(self):
+        source_index = SourceIndex()
+        source_index.add_all(CHUNKS)
+
+        source_index.clear()
+
+        assert source_index.size() == 0
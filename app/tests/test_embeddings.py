@@ -2,6 +2,7 @@
 from unittest import mock
 
 import pytest
+from embeddings.cache import LRUCache
 from embeddings.client import EmbeddingsClient
 from embeddings.model import EmbeddingModel
 
@@ -269,3 +270,23 @@ class TestEmbeddings:
             embeddings=bedrock_embeddings_mock(),
             allow_dangerous_deserialization=True,
         )
+
+    @mock.patch("embeddings.client.OllamaEmbeddings")
+    def test_query_cache_sits_in_front_of_embeddings_provider(
+        self, ollama_embeddings_mock
+    ):
+        ollama_embeddings_mock.return_value.embed_query.return_value = [0.1, 0.2]
+        embedding_config = EmbeddingModel(
+            id="ollama-embeddings",
+            name="Ollama Embeddings",
+            provider="ollama",
+            config={"model": "ollama-embeddings"},
+        )
+
+        embeddings = EmbeddingsClient(embedding_config, LRUCache())
+        embeddings.embed_query("When was Ingenuity launched?")
+        embeddings.embed_query("When was Ingenuity launched?")
+
+        ollama_embeddings_mock.return_value.embed_query.assert_called_once()
+        assert embeddings.get_query_cache_stats()["hits"] == 1
+        assert embeddings.get_query_cache_stats()["misses"] == 1
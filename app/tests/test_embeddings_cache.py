@@ -0,0 +1,104 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from unittest.mock import MagicMock
+
+from embeddings.cache import CachedQueryEmbeddings, LRUCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache:
+    def test_get_counts_hits_and_misses(self):
+        cache = LRUCache(max_size=2)
+
+        assert cache.get("a") is None
+        cache.put("a", 1)
+        assert cache.get("a") == 1
+
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["size"] == 1
+        assert stats["hit_rate"] == 0.5
+
+    def test_evicts_least_recently_used_entry(self):
+        cache = LRUCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+
+        cache.put("c", 3)
+
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+
+    def test_entries_expire_after_ttl(self):
+        clock = FakeClock()
+        cache = LRUCache(max_size=2, ttl_seconds=10, clock=clock)
+        cache.put("a", 1)
+
+        clock.now = 5
+        assert cache.get("a") == 1
+
+        clock.now = 11
+        assert cache.get("a") is None
+        assert cache.stats()["size"] == 0
+
+    def test_size_zero_disables_caching(self):
+        cache = LRUCache(max_size=0)
+        cache.put("a", 1)
+
+        assert cache.get("a") is None
+
+
+class TestCachedQueryEmbeddings:
+    def test_repeated_queries_only_call_provider_once(self):
+        provider = MagicMock()
+        provider.embed_query.return_value = [0.1, 0.2]
+        cache = LRUCache()
+        embeddings = CachedQueryEmbeddings(provider, cache, "model-a")
+
+        assert embeddings.embed_query("When was Ingenuity launched?") == [0.1, 0.2]
+        assert embeddings.embed_query("  When was   Ingenuity launched? ") == [
+            0.1,
+            0.2,
+        ]
+
+        provider.embed_query.assert_called_once_with("When was Ingenuity launched?")
+        assert cache.stats()["hits"] == 1
+
+    def test_changing_a_returned_embedding_does_not_change_the_cache(self):
+        provider = MagicMock()
+        provider.embed_query.return_value = [0.1, 0.2]
+        embeddings = CachedQueryEmbeddings(provider, LRUCache(max_size=10), "model")
+
+        embeddings.embed_query("query").append(0.3)
+        embeddings.embed_query("query")[0] = 0.9
+
+        assert embeddings.embed_query("query") == [0.1, 0.2]
+
+    def test_cache_keys_include_model_id(self):
+        provider = MagicMock()
+        provider.embed_query.return_value = [0.1, 0.2]
+        cache = LRUCache()
+
+        CachedQueryEmbeddings(provider, cache, "model-a").embed_query("query")
+        CachedQueryEmbeddings(provider, cache, "model-b").embed_query("query")
+
+        assert provider.embed_query.call_count == 2
+
+    def test_document_embeddings_are_not_cached(self):
+        provider = MagicMock()
+        provider.embed_documents.return_value = [[0.1], [0.2]]
+        embeddings = CachedQueryEmbeddings(provider, LRUCache(), "model-a")
+
+        embeddings.embed_documents(["a", "b"])
+        embeddings.embed_documents(["a", "b"])
+
+        assert provider.embed_documents.call_count == 2
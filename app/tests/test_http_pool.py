@@ -0,0 +1,153 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+from unittest.mock import patch
+
+import httpx
+import litellm
+import pytest
+from litellm.llms.custom_httpx.http_handler import AsyncHTTPHandler, HTTPHandler
+from llms.clients import ChatClient, HaivenHumanMessage
+from llms.http_pool import OPENAI_SDK_POOL, HttpPools, ProviderHttpPool
+from llms.http_pool_config import HttpPoolConfig
+from llms.model_config import ModelConfig
+
+AWS_MODEL = ModelConfig(
+    "aws-claude", "aws", "Claude on AWS", config={"model_id": "anthropic.claude"}
+)
+AZURE_MODEL = ModelConfig(
+    "azure-gpt-4o", "azure", "GPT-4o on Azure", config={"azure_deployment": "gpt-4o"}
+)
+
+
+def create_pool(handler, max_consecutive_failures=3):
+    pool = ProviderHttpPool(
+        "aws", HttpPoolConfig(max_consecutive_failures=max_consecutive_failures)
+    )
+    client_kwargs = pool._client_kwargs()
+    client_kwargs["transport"] = httpx.MockTransport(handler)
+    pool._client_kwargs = lambda: client_kwargs
+    return pool
+
+
+class TestHttpPool:
+    def test_handler_providers_share_one_pooled_handler(self):
+        http_pools = HttpPools()
+
+        handler = http_pools.completion_kwargs(AWS_MODEL, is_async=False)["client"]
+        async_handler = http_pools.completion_kwargs(AWS_MODEL, is_async=True)["client"]
+
+        assert isinstance(handler, HTTPHandler)
+        assert handler.client is http_pools.pool("aws").client()
+        assert http_pools.completion_kwargs(AWS_MODEL, False)["client"] is handler
+        assert isinstance(async_handler, AsyncHTTPHandler)
+        assert async_handler.client is http_pools.pool("aws").async_client()
+
+    def test_openai_sdk_providers_use_the_litellm_session(self):
+        http_pools = HttpPools()
+        original_session = litellm.client_session
+        try:
+            assert http_pools.completion_kwargs(AZURE_MODEL, is_async=False) == {}
+            assert litellm.client_session is http_pools.pool(OPENAI_SDK_POOL).client()
+        finally:
+            litellm.client_session = original_session
+
+    def test_pool_counts_requests_and_connections(self):
+        pool = create_pool(lambda request: httpx.Response(200))
+
+        pool.client().get("https://bedrock.example.com/model")
+        stats = pool.get_stats()
+
+        assert stats["requests"] == 1
+        assert stats["failures"] == 0
+        assert stats["open_connections"] == 0
+
+    def test_unhealthy_pool_is_replaced_after_repeated_connection_errors(self):
+        def handler(request):
+            raise httpx.ConnectError("connection refused", request=request)
+
+        pool = create_pool(handler, max_consecutive_failures=2)
+        client = pool.client()
+
+        for _ in range(2):
+            with pytest.raises(httpx.ConnectError):
+                client.get("https://bedrock.example.com/model")
+
+        assert pool.get_stats()["recycles"] == 1
+        assert pool.get_stats()["failures"] == 2
+        assert pool.client() is not client
+
+    def test_async_handler_uses_the_pooled_client_without_creating_its_own(self):
+        pool = ProviderHttpPool("aws", HttpPoolConfig())
+
+        with patch.object(
+            httpx.AsyncClient,
+            "__init__",
+            autospec=True,
+            side_effect=httpx.AsyncClient.__init__,
+        ) as create_async_client:
+            handler = pool.async_handler()
+
+        assert handler.client is pool.async_client()
+        assert create_async_client.call_count == 1
+
+    def test_recycled_clients_are_closed(self):
+        pool = ProviderHttpPool("aws", HttpPoolConfig())
+        client = pool.client()
+
+        async def run():
+            async_client = pool.async_client()
+            pool.recycle()
+            await asyncio.sleep(0)
+            return async_client
+
+        async_client = asyncio.run(run())
+
+        assert client.is_closed
+        assert async_client.is_closed
+
+    def test_async_client_closed_outside_of_an_event_loop_is_closed_on_the_next_use(
+        self,
+    ):
+        pool = ProviderHttpPool("aws", HttpPoolConfig())
+
+        async def create():
+            return pool.async_client()
+
+        async def use():
+            pool.async_client()
+            await asyncio.sleep(0)
+
+        async_client = asyncio.run(create())
+        pool.close()
+        assert not async_client.is_closed
+
+        asyncio.run(use())
+
+        assert async_client.is_closed
+
+    @patch("llms.clients.llmCompletion")
+    def test_chat_client_calls_the_model_with_the_pooled_handler(self, mock_completion):
+        http_pools = HttpPools()
+        mock_completion.return_value = iter([])
+
+        list(
+            ChatClient(AWS_MODEL, http_pools=http_pools).stream(
+                [HaivenHumanMessage(content="Hello")]
+            )
+        )
+
+        assert (
+            mock_completion.call_args.kwargs["client"]
+            is http_pools.pool("aws").handler()
+        )
+
+    def test_config_from_dict_uses_defaults_for_unset_values(self):
+        config = HttpPoolConfig.from_dict(
+            {"max_connections": "10", "max_keepalive_connections": ""}
+        )
+
+        assert config.max_connections == 10
+        assert config.max_keepalive_connections == 10
+        assert config.keepalive_expiry_seconds == 30.0
+        with pytest.raises(ValueError):
+            HttpPoolConfig(max_connections=0)
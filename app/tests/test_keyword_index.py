@@ -0,0 +1,68 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from embeddings.keyword_index import KeywordIndex, reciprocal_rank_fusion
+from langchain_core.documents import Document
+
+
+class TestKeywordIndex:
+    def test_search_ranks_chunks_by_bm25_score(self):
+        keyword_index = KeywordIndex()
+        keyword_index.build(
+            [
+                "The payment service retries failed payments",
+                "Ticket PAY-1234: payment retries are not logged",
+                "Unrelated chunk about the rover",
+            ]
+        )
+
+        results = keyword_index.search("PAY-1234 payment", k=5)
+
+        assert [row for row, _ in results] == [1, 0]
+        assert results[0][1] > results[1][1]
+        assert keyword_index.search("helicopter") == []
+
+    def test_search_returns_at_most_k_rows(self):
+        keyword_index = KeywordIndex()
+        keyword_index.build([f"chunk number {number}" for number in range(10)])
+
+        assert len(keyword_index.search("chunk", k=3)) == 3
+
+    def test_tokenize_keeps_identifiers_and_their_parts(self):
+        assert KeywordIndex.tokenize("Call get_user_by_id for PAY-1234.") == [
+            "call",
+            "get_user_by_id",
+            "get",
+            "user",
+            "by",
+            "id",
+            "for",
+            "pay-1234",
+            "pay",
+            "1234",
+        ]
+
+    def test_is_keyword_query(self):
+        assert KeywordIndex.is_keyword_query("PAY-1234")
+        assert KeywordIndex.is_keyword_query("getUserById PaymentGateway")
+        assert KeywordIndex.is_keyword_query('"auth_token"')
+        assert not KeywordIndex.is_keyword_query("When was Ingenuity launched?")
+        assert not KeywordIndex.is_keyword_query("")
+
+    def test_reciprocal_rank_fusion_merges_same_chunk_from_both_lists(self):
+        first = Document(page_content="first", metadata={"page": 1})
+        second = Document(page_content="second")
+        third = Document(page_content="third")
+
+        results = reciprocal_rank_fusion(
+            [
+                [second, first],
+                [Document(page_content="first", metadata={"page": 1}), third],
+            ],
+            k=2,
+            rank_constant=60,
+        )
+
+        assert [document.page_content for document, _ in results] == [
+            "first",
+            "second",
+        ]
+        assert results[0][1] == 1 / 62 + 1 / 61
@@ -1,11 +1,16 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 import os
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_core.documents import Document
+from langchain_core.embeddings import FakeEmbeddings
 from embeddings.model import EmbeddingModel
+from embeddings.retriever_cache import RetrieverCache
 from knowledge.documents import KnowledgeBaseDocuments
+from knowledge.search_config import KnowledgeSearchConfig
 
 
 class TestsKnowledgeBaseDocuments:
@@ -115,3 +120,324 @@ class TestsKnowledgeBaseDocuments:
         assert similarity_results[2].page_content == "document content C"
         assert similarity_results[3].page_content == "document content D"
         assert similarity_results[4].page_content == "document content E"
+
+    def test_unified_search_embeds_query_once_and_filters_by_document_keys(
+        self,
+    ):
+        ingenuity_store = FAISS.from_embeddings(
+            text_embeddings=[
+                ("ingenuity chunk 1", [1.0, 0.0, 0.0]),
+                ("ingenuity chunk 2", [0.9, 0.1, 0.0]),
+            ],
+            embedding=FakeEmbeddings(size=3),
+        )
+        agile_store = FAISS.from_embeddings(
+            text_embeddings=[
+                ("agile chunk 1", [0.0, 1.0, 0.0]),
+                ("agile chunk 2", [0.0, 0.9, 0.1]),
+            ],
+            embedding=FakeEmbeddings(size=3),
+        )
+        embeddings_provider = self.service._embeddings_provider
+        embeddings_provider.generate_from_filesystem.side_effect = [
+            ingenuity_store,
+            agile_store,
+        ]
+        embeddings_provider.embed_query.return_value = [1.0, 0.0, 0.0]
+
+        service = KnowledgeBaseDocuments(
+            MagicMock(),
+            embeddings_provider,
+            KnowledgeSearchConfig(search_mode=KnowledgeSearchConfig.UNIFIED),
+        )
+        service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+
+        all_results = service.similarity_search_with_scores(
+            query="When Ingenuity was launched?", k=2
+        )
+        filtered_results = service.similarity_search_on_multiple_documents(
+            query="When Ingenuity was launched?",
+            document_keys=["tw-guide-agile-sd"],
+            k=2,
+        )
+
+        assert [doc.page_content for doc, _ in all_results] == [
+            "ingenuity chunk 1",
+            "ingenuity chunk 2",
+        ]
+        assert all_results[0][1] < all_results[1][1]
+        assert [doc.page_content for doc in filtered_results] == [
+            "agile chunk 2",
+            "agile chunk 1",
+        ]
+        assert embeddings_provider.embed_query.call_count == 2
+
+    def test_unified_search_falls_back_to_per_document_search_when_index_cannot_be_built(
+        self,
+    ):
+        retriever = self.service._embeddings_provider.generate_from_filesystem()
+        retriever.distance_strategy = DistanceStrategy.MAX_INNER_PRODUCT
+
+        service = KnowledgeBaseDocuments(
+            MagicMock(),
+            self.service._embeddings_provider,
+            KnowledgeSearchConfig(search_mode=KnowledgeSearchConfig.UNIFIED),
+        )
+        service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+
+        similarity_results = service.similarity_search_on_multiple_documents(
+            query="When Ingenuity was launched?",
+            document_keys=["ingenuity-wikipedia", "tw-guide-agile-sd"],
+        )
+
+        assert service._unified_index is None
+        assert len(similarity_results) == 10
+
+    def test_concurrent_search_merges_results_into_global_top_k(
+        self,
+    ):
+        ingenuity_retriever = MagicMock()
+        ingenuity_retriever.similarity_search_with_score_by_vector.return_value = [
+            (Document(page_content="ingenuity chunk 1"), 0.1),
+            (Document(page_content="ingenuity chunk 2"), 0.4),
+        ]
+        agile_retriever = MagicMock()
+        agile_retriever.similarity_search_with_score_by_vector.return_value = [
+            (Document(page_content="agile chunk 1"), 0.2),
+            (Document(page_content="agile chunk 2"), 0.3),
+        ]
+        embeddings_provider = self.service._embeddings_provider
+        embeddings_provider.generate_from_filesystem.side_effect = [
+            ingenuity_retriever,
+            agile_retriever,
+        ]
+        embeddings_provider.embed_query.return_value = [1.0, 0.0, 0.0]
+
+        service = KnowledgeBaseDocuments(
+            MagicMock(),
+            embeddings_provider,
+            KnowledgeSearchConfig(
+                search_mode=KnowledgeSearchConfig.CONCURRENT, max_search_workers=2
+            ),
+        )
+        service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+
+        similarity_results = service.similarity_search_on_multiple_documents(
+            query="When Ingenuity was launched?",
+            document_keys=["ingenuity-wikipedia", "tw-guide-agile-sd"],
+            k=3,
+        )
+
+        assert [doc.page_content for doc in similarity_results] == [
+            "ingenuity chunk 1",
+            "agile chunk 1",
+            "agile chunk 2",
+        ]
+        embeddings_provider.embed_query.assert_called_once_with(
+            "When Ingenuity was launched?"
+        )
+        ingenuity_retriever.similarity_search_with_score_by_vector.assert_called_once_with(
+            embedding=[1.0, 0.0, 0.0], k=3, score_threshold=None
+        )
+
+    def test_lazy_loading_only_reads_metadata_until_a_document_is_searched(
+        self,
+    ):
+        embeddings_provider = self.service._embeddings_provider
+        service = KnowledgeBaseDocuments(
+            MagicMock(),
+            embeddings_provider,
+            KnowledgeSearchConfig(lazy_loading=True),
+        )
+        service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+
+        assert len(service.get_documents()) == 2
+        embeddings_provider.generate_from_filesystem.assert_not_called()
+
+        with patch.object(RetrieverCache, "estimate_size_bytes", return_value=100):
+            similarity_results = service.similarity_search_on_multiple_documents(
+                query="When Ingenuity was launched?",
+                document_keys=["ingenuity-wikipedia"],
+            )
+
+        assert len(similarity_results) == 5
+        embeddings_provider.generate_from_filesystem.assert_called_once()
+        assert str(
+            embeddings_provider.generate_from_filesystem.call_args[0][0]
+        ).endswith("ingenuity_wikipedia.kb")
+
+    def test_retrieval_cache_returns_cached_results_until_pack_is_reloaded(
+        self,
+    ):
+        self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+        retriever = self.service._embeddings_provider.generate_from_filesystem()
+        retriever.similarity_search_with_score.reset_mock()
+
+        first_results = self.service.similarity_search_on_multiple_documents(
+            query="When Ingenuity was launched?",
+            document_keys=["ingenuity-wikipedia", "tw-guide-agile-sd"],
+        )
+        second_results = self.service.similarity_search_on_multiple_documents(
+            query="When Ingenuity was launched?",
+            document_keys=["tw-guide-agile-sd", "ingenuity-wikipedia"],
+        )
+
+        assert second_results == first_results
+        assert retriever.similarity_search_with_score.call_count == 2
+        assert self.service.get_retrieval_cache_stats()["hits"] == 1
+
+        self.service.similarity_search_on_multiple_documents(
+            query="When Ingenuity was launched?",
+            document_keys=["ingenuity-wikipedia", "tw-guide-agile-sd"],
+            k=3,
+        )
+        assert retriever.similarity_search_with_score.call_count == 4
+
+        self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+        self.service.similarity_search_on_multiple_documents(
+            query="When Ingenuity was launched?",
+            document_keys=["ingenuity-wikipedia", "tw-guide-agile-sd"],
+        )
+        assert retriever.similarity_search_with_score.call_count == 6
+        assert self.service.get_retrieval_cache_stats()["size"] == 1
+
+    @patch("knowledge.documents.HaivenLogger")
+    def test_query_embedding_cache_stats_are_logged_with_retrieval_cache_stats(
+        self, mock_logger
+    ):
+        self.service._embeddings_provider.get_query_cache_stats.return_value = {
+            "size": 1,
+            "max_size": 256,
+            "hits": 3,
+            "misses": 1,
+            "hit_rate": 0.75,
+        }
+        self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+        self.service.similarity_search_on_multiple_documents(
+            query="When Ingenuity was launched?",
+            document_keys=["ingenuity-wikipedia"],
+        )
+
+        self.service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+
+        logged = [
+            call.kwargs["extra"]
+            for call in mock_logger.get.return_value.info.call_args_list
+            if "extra" in call.kwargs
+        ]
+        assert {
+            "INFO": "QueryEmbeddingCacheStats",
+            "size": 1,
+            "max_size": 256,
+            "hits": 3,
+            "misses": 1,
+            "hit_rate": 0.75,
+        } in logged
+
+    def test_retrieval_cache_can_be_switched_off(
+        self,
+    ):
+        service = KnowledgeBaseDocuments(
+            MagicMock(),
+            self.service._embeddings_provider,
+            KnowledgeSearchConfig(retrieval_cache_size=0),
+        )
+        service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+        retriever = service._embeddings_provider.generate_from_filesystem()
+        retriever.similarity_search_with_score.reset_mock()
+
+        for _ in range(2):
+            service.similarity_search_on_multiple_documents(
+                query="When Ingenuity was launched?",
+                document_keys=["ingenuity-wikipedia"],
+            )
+
+        assert retriever.similarity_search_with_score.call_count == 2
+
+    def create_keyword_search_service(self, retrieval_mode: str):
+        ingenuity_store = FAISS.from_embeddings(
+            text_embeddings=[
+                ("Ingenuity was launched in July 2020", [1.0, 0.0, 0.0]),
+                ("Ticket MARS-4711 tracks the rotor blade issue", [0.0, 0.0, 1.0]),
+            ],
+            embedding=FakeEmbeddings(size=3),
+        )
+        agile_store = FAISS.from_embeddings(
+            text_embeddings=[
+                ("Agile teams deliver in small increments", [0.0, 1.0, 0.0]),
+                ("Continuous delivery keeps software releasable", [0.0, 0.9, 0.1]),
+            ],
+            embedding=FakeEmbeddings(size=3),
+        )
+        embeddings_provider = self.service._embeddings_provider
+        embeddings_provider.generate_from_filesystem.side_effect = [
+            ingenuity_store,
+            agile_store,
+        ]
+        embeddings_provider.embed_query.return_value = [0.0, 1.0, 0.0]
+
+        service = KnowledgeBaseDocuments(
+            MagicMock(),
+            embeddings_provider,
+            KnowledgeSearchConfig(
+                search_mode=KnowledgeSearchConfig.CONCURRENT,
+                retrieval_mode=retrieval_mode,
+            ),
+        )
+        service.load_documents_for_base(self.knowledge_pack_path + "/embeddings")
+        return service, embeddings_provider
+
+    def test_hybrid_search_answers_identifier_queries_without_embedding_call(
+        self,
+    ):
+        service, embeddings_provider = self.create_keyword_search_service(
+            KnowledgeSearchConfig.HYBRID
+        )
+
+        similarity_results = service.similarity_search_on_multiple_documents(
+            query="MARS-4711",
+            document_keys=["ingenuity-wikipedia", "tw-guide-agile-sd"],
+            k=2,
+        )
+
+        assert [doc.page_content for doc in similarity_results] == [
+            "Ticket MARS-4711 tracks the rotor blade issue"
+        ]
+        embeddings_provider.embed_query.assert_not_called()
+
+    def test_hybrid_search_fuses_keyword_and_vector_results(
+        self,
+    ):
+        service, embeddings_provider = self.create_keyword_search_service(
+            KnowledgeSearchConfig.HYBRID
+        )
+
+        similarity_results = service.similarity_search_with_scores(
+            query="When was Ingenuity launched?", k=2
+        )
+
+        # the keyword search ranks the Ingenuity chunk first, the vector search the closest agile chunk
+        assert sorted(doc.page_content for doc, _ in similarity_results) == [
+            "Agile teams deliver in small increments",
+            "Ingenuity was launched in July 2020",
+        ]
+        assert similarity_results[0][1] == similarity_results[1][1] == 1 / 61
+        embeddings_provider.embed_query.assert_called_once()
+
+    def test_keyword_search_never_embeds_the_query(
+        self,
+    ):
+        service, embeddings_provider = self.create_keyword_search_service(
+            KnowledgeSearchConfig.KEYWORD
+        )
+
+        similarity_results = service.similarity_search_on_multiple_documents(
+            query="How do agile teams deliver?",
+            document_keys=["tw-guide-agile-sd"],
+            k=5,
+        )
+
+        assert [doc.page_content for doc in similarity_results] == [
+            "Agile teams deliver in small increments"
+        ]
+        embeddings_provider.embed_query.assert_not_called()
@@ -0,0 +1,186 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from unittest.mock import MagicMock, patch
+
+import pytest
+from llms.chats import JSONChat
+from llms.clients import (
+    HaivenAIMessage,
+    HaivenHumanMessage,
+    HaivenSystemMessage,
+)
+from llms.memory_compaction import (
+    ConversationSummary,
+    MemoryCompactor,
+    ModelMemorySummarizer,
+    create_memory_compactor,
+)
+from llms.memory_compaction_config import MemoryCompactionConfig
+from llms.model_config import ModelConfig
+
+SYSTEM = HaivenSystemMessage(content="System")
+
+
+def turn(number, state_snapshot=False):
+    return [
+        HaivenHumanMessage(
+            content=f"Question {number} " + "x" * 36, state_snapshot=state_snapshot
+        ),
+        HaivenAIMessage(content=f"Answer {number} " + "y" * 36),
+    ]
+
+
+def count_words(text):
+    return len(text.split())
+
+
+class TestMemoryCompaction:
+    def test_memory_under_the_budget_is_unchanged(self):
+        memory = [SYSTEM] + turn(1) + turn(2)[:1]
+
+        assert MemoryCompactor(max_prompt_tokens=1000).compact(memory) == memory
+
+    def test_oldest_turns_are_dropped_to_fit_the_budget(self):
+        compactor = MemoryCompactor(max_prompt_tokens=30, token_counter=count_words)
+        memory = [SYSTEM] + turn(1) + turn(2) + turn(3)[:1]
+
+        # every message counts 3 words plus 4 tokens of overhead
+        compacted = compactor.compact(memory)
+
+        assert compacted == [SYSTEM] + turn(2) + turn(3)[:1]
+        assert compactor.count_tokens(compacted) <= 30
+
+    def test_newest_message_is_kept_even_if_it_exceeds_the_budget(self):
+        memory = [SYSTEM] + turn(1) + turn(2)[:1]
+
+        assert MemoryCompactor(max_prompt_tokens=1).compact(memory) == [
+            SYSTEM,
+            turn(2)[0],
+        ]
+
+    def test_oldest_turns_are_dropped_to_fit_the_byte_budget(self):
+        memory = [SYSTEM] + turn(1) + turn(2) + turn(3)[:1]
+        newest = turn(2) + turn(3)[:1]
+        budget = sum(message.footprint_bytes() for message in [SYSTEM] + newest)
+
+        compacted = MemoryCompactor(max_session_bytes=budget).compact(memory)
+
+        assert compacted == [SYSTEM] + newest
+
+    def test_dropped_turns_are_summarized(self):
+        summarizer = MagicMock()
+        summarizer.summarize.return_value = "The user asked twice"
+        compactor = MemoryCompactor(
+            max_prompt_tokens=20, summarizer=summarizer, token_counter=count_words
+        )
+
+        compacted = compactor.compact([SYSTEM] + turn(1) + turn(2) + turn(3)[:1])
+
+        summarizer.summarize.assert_called_once_with(None, turn(1) + turn(2))
+        assert compacted == [
+            SYSTEM,
+            ConversationSummary.of("The user asked twice"),
+            turn(3)[0],
+        ]
+        assert isinstance(compacted[1], ConversationSummary)
+
+        # the next compaction extends the existing summary
+        summarizer.summarize.return_value = "The user asked three times"
+        compacted = compactor.compact(compacted + turn(3)[1:] + turn(4)[:1])
+        summarizer.summarize.assert_called_with("The user asked twice", turn(3))
+        assert compacted[1].summary == "The user asked three times"
+
+    def test_turns_are_dropped_without_summary_if_summarizing_fails(self):
+        summarizer = MagicMock()
+        summarizer.summarize.side_effect = RuntimeError("model unavailable")
+        compactor = MemoryCompactor(
+            max_prompt_tokens=10, summarizer=summarizer, token_counter=count_words
+        )
+
+        assert compactor.compact([SYSTEM] + turn(1) + turn(2)[:1]) == [
+            SYSTEM,
+            turn(2)[0],
+        ]
+
+    def test_superseded_state_is_dropped(self):
+        memory = (
+            [SYSTEM]
+            + turn(1)
+            + turn(2, state_snapshot=True)
+            + turn(3)
+            + turn(4, state_snapshot=True)[:1]
+        )
+
+        assert MemoryCompactor().compact(memory) == [SYSTEM] + turn(1) + turn(3) + [
+            turn(4, state_snapshot=True)[0]
+        ]
+
+    def test_summarizer_asks_the_model_for_a_summary(self):
+        chat_client = MagicMock()
+        chat_client.stream.return_value = iter(
+            [{"content": "A "}, {"content": "summary"}, {"usage": {}}]
+        )
+
+        summary = ModelMemorySummarizer(chat_client).summarize(
+            "Earlier summary", turn(1)
+        )
+
+        assert summary == "A summary"
+        prompt = chat_client.stream.call_args.args[0][0].content
+        assert "Earlier summary" in prompt
+        assert "user: Question 1" in prompt
+        assert "assistant: Answer 1" in prompt
+
+    def test_model_config_overrides_the_default_budget(self):
+        config = MemoryCompactionConfig.from_dict(
+            {"max_prompt_tokens": "8000", "summarize": "", "drop_superseded_state": ""}
+        )
+        model_config = ModelConfig(
+            "azure-gpt35",
+            "azure",
+            "GPT-3.5",
+            config={"azure_deployment": "gpt35", "max_prompt_tokens": "4000"},
+        )
+
+        compactor = create_memory_compactor(config, model_config, MagicMock())
+
+        assert compactor.max_prompt_tokens == 4000
+        assert compactor.max_session_bytes == 0
+        assert compactor.summarizer is None
+        assert compactor.drop_superseded_state
+        assert (
+            create_memory_compactor(
+                MemoryCompactionConfig(drop_superseded_state=False),
+                ModelConfig("azure-gpt-4o", "azure", "GPT-4o"),
+                MagicMock(),
+            )
+            is None
+        )
+        with pytest.raises(ValueError):
+            MemoryCompactionConfig(max_prompt_tokens=-1)
+
+    @patch("knowledge_manager.KnowledgeManager")
+    def test_json_chat_sends_only_the_latest_state(self, mock_knowledge_manager):
+        mock_knowledge_manager.get_system_message.return_value = "System"
+        mock_knowledge_manager.knowledge_base_markdown.aggregate_all_contexts.return_value = ""
+        chat_client = MagicMock()
+        sent_messages = []
+
+        def stream(messages):
+            sent_messages.append([message.content for message in messages])
+            return iter([{"content": "[]"}])
+
+        chat_client.stream.side_effect = stream
+        chat = JSONChat(
+            chat_client, mock_knowledge_manager, memory_compactor=MemoryCompactor()
+        )
+
+        list(chat.run("Generate scenarios"))
+        list(chat.run("Iterate on [1]", state_snapshot=True))
+        list(chat.run("Iterate on [2]", state_snapshot=True))
+
+        assert sent_messages[-1] == [
+            "System",
+            "Generate scenarios",
+            "[]",
+            "Iterate on [2]",
+        ]
@@ -0,0 +1,206 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+from unittest.mock import MagicMock, patch
+
+import pytest
+from llms.clients import (
+    ChatClient,
+    ChatClientFactory,
+    HaivenHumanMessage,
+    MockChoice,
+    MockDelta,
+    MockResult,
+)
+from llms.latency_stats import LatencyHistogram, ProviderLatencyStats
+from llms.model_config import ModelConfig
+from llms.model_routing import RoutedChatClient
+from llms.model_routing_config import ModelRoute, ModelRoutingConfig
+from llms.rate_limit import RateLimitExceeded
+from llms.token_counter import ContextWindowExceeded
+
+MESSAGES = [HaivenHumanMessage(content="What is the capital of France?")]
+
+
+class FakeChatClient:
+    def __init__(self, name, chunks=None, error=None, delay_seconds=0):
+        self.model_config = MagicMock()
+        self.model_config.lite_id = name
+        self.chunks = chunks or [{"content": name}]
+        self.error = error
+        self.delay_seconds = delay_seconds
+        self.closed = False
+
+    def stream(self, messages, mock=False):
+        if self.error is not None:
+            raise self.error
+        yield from self.chunks
+
+    async def astream(self, messages):
+        try:
+            await asyncio.sleep(self.delay_seconds)
+            if self.error is not None:
+                raise self.error
+            for chunk in self.chunks:
+                yield chunk
+        finally:
+            self.closed = True
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+class TestRoutedChatClient:
+    def test_fails_over_to_the_next_model_before_the_first_chunk(self):
+        primary = FakeChatClient("primary", error=ConnectionError("down"))
+        fallback = FakeChatClient("fallback")
+        routed_client = RoutedChatClient([primary, fallback])
+
+        assert list(routed_client.stream(MESSAGES)) == [{"content": "fallback"}]
+        assert routed_client.answered_by is fallback.model_config
+        assert asyncio.run(collect(routed_client.astream(MESSAGES))) == [
+            {"content": "fallback"}
+        ]
+        assert routed_client.answered_by is fallback.model_config
+
+    def test_raises_the_error_of_the_last_model_when_all_fail(self):
+        routed_client = RoutedChatClient(
+            [
+                FakeChatClient("primary", error=ConnectionError("down")),
+                FakeChatClient("fallback", error=TimeoutError("slow")),
+            ]
+        )
+
+        with pytest.raises(TimeoutError):
+            list(routed_client.stream(MESSAGES))
+        with pytest.raises(TimeoutError):
+            asyncio.run(collect(routed_client.astream(MESSAGES)))
+
+    @pytest.mark.parametrize(
+        "error",
+        [
+            ContextWindowExceeded("primary", 200, 100),
+            RateLimitExceeded("primary", 30),
+        ],
+    )
+    def test_does_not_fail_over_when_our_own_guards_refuse_the_request(self, error):
+        fallback = FakeChatClient("fallback")
+        routed_client = RoutedChatClient(
+            [FakeChatClient("primary", error=error), fallback]
+        )
+
+        with pytest.raises(type(error)):
+            list(routed_client.stream(MESSAGES))
+        with pytest.raises(type(error)):
+            asyncio.run(collect(routed_client.astream(MESSAGES)))
+        assert not fallback.closed
+
+    def test_hedges_a_slow_model_and_cancels_the_loser(self):
+        primary = FakeChatClient("primary", delay_seconds=1)
+        fallback = FakeChatClient(
+            "fallback", chunks=[{"content": "a"}, {"content": "b"}]
+        )
+        routed_client = RoutedChatClient([primary, fallback], hedge_after_seconds=0.01)
+
+        chunks = asyncio.run(collect(routed_client.astream(MESSAGES)))
+
+        assert chunks == [{"content": "a"}, {"content": "b"}]
+        assert primary.closed
+
+    def test_keeps_the_primary_answer_when_it_is_fast_enough(self):
+        primary = FakeChatClient("primary")
+        fallback = FakeChatClient("fallback")
+        routed_client = RoutedChatClient([primary, fallback], hedge_after_seconds=1)
+
+        chunks = asyncio.run(collect(routed_client.astream(MESSAGES)))
+
+        assert chunks == [{"content": "primary"}]
+        assert not fallback.closed
+
+
+class TestLatencyStats:
+    def test_histogram_buckets_and_percentiles(self):
+        histogram = LatencyHistogram([100, 500, 1000])
+        for latency_ms in [50, 80, 300, 700, 5000]:
+            histogram.record(latency_ms)
+
+        stats = histogram.to_dict()
+
+        assert stats["buckets"] == {"100": 2, "500": 1, "1000": 1, "+Inf": 1}
+        assert stats["count"] == 5
+        assert histogram.percentile(0.4) == 100
+        assert histogram.percentile(0.5) == 500
+        assert histogram.percentile(1) == float("inf")
+
+    @patch("llms.clients.llmCompletion")
+    def test_chat_clients_record_first_chunks_and_failures(self, mock_completion):
+        latency_stats = ProviderLatencyStats()
+        model_config = ModelConfig(
+            "azure-gpt-4o", "Azure", "GPT-4o", config={"azure_deployment": "gpt-4o"}
+        )
+        chat_client = ChatClient(model_config, latency_stats=latency_stats)
+        mock_completion.return_value = iter(
+            [MockResult(choices=[MockChoice(delta=MockDelta(content="Paris"))])]
+        )
+        list(chat_client.stream(MESSAGES))
+        mock_completion.side_effect = ConnectionError("down")
+        with pytest.raises(ConnectionError):
+            list(chat_client.stream(MESSAGES))
+
+        stats = latency_stats.get_stats()
+
+        assert stats["azure"]["first_chunk"]["count"] == 1
+        assert stats["azure"]["failures"] == 1
+
+
+class TestModelRouting:
+    def test_config_from_env_values(self):
+        config = ModelRoutingConfig.from_dict(
+            {
+                "text-generation": {
+                    "fallback_models": "aws-claude, ollama-llama",
+                    "hedge_after_ms": "1500",
+                }
+            }
+        )
+
+        route = config.route("text-generation")
+        assert route.fallback_models == ["aws-claude", "ollama-llama"]
+        assert route.hedge_after_ms == 1500
+        assert config.route("image-to-text").fallback_models == []
+        with pytest.raises(ValueError):
+            ModelRoute(hedge_after_ms=-1)
+
+    def test_factory_routes_only_when_fallbacks_are_configured(self):
+        primary = ModelConfig("azure-gpt-4o", "azure", "GPT-4o", config={})
+        fallback = ModelConfig(
+            "aws-claude", "aws", "Claude", config={"model_id": "anthropic.claude"}
+        )
+        config_service = MagicMock()
+        config_service.load_model_routing_config.return_value = (
+            ModelRoutingConfig.from_dict(
+                {
+                    "text-generation": {
+                        "fallback_models": "azure-gpt-4o,aws-claude,unknown",
+                        "hedge_after_ms": "500",
+                    }
+                }
+            )
+        )
+
+        def get_model(model_id):
+            if model_id == "aws-claude":
+                return fallback
+            raise ValueError(f"Model with ID {model_id} not found")
+
+        config_service.get_model.side_effect = get_model
+        factory = ChatClientFactory(config_service)
+
+        routed_client = factory.new_chat_client(primary, "text-generation")
+        assert isinstance(routed_client, RoutedChatClient)
+        assert [client.model_config for client in routed_client.chat_clients] == [
+            primary,
+            fallback,
+        ]
+        assert routed_client.hedge_after_seconds == 0.5
+        assert isinstance(factory.new_chat_client(primary, "query-rewrite"), ChatClient)
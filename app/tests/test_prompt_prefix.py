@@ -0,0 +1,100 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from unittest.mock import MagicMock, patch
+
+from knowledge.markdown import KnowledgeBaseMarkdown, KnowledgeMarkdown
+from llms.chat_events import create_token_usage_event
+from llms.chats import StreamingChat
+from llms.clients import ChatClient, HaivenHumanMessage, HaivenSystemMessage
+from llms.model_config import ModelConfig
+from llms.prompt_prefix import CACHE_CONTROL, to_json_messages
+
+ANTHROPIC_MODEL = ModelConfig(
+    "claude", "anthropic", "Claude", config={"model_id": "claude-sonnet-4"}
+)
+BEDROCK_CLAUDE_MODEL = ModelConfig(
+    "aws-claude", "aws", "Claude on AWS", config={"model_id": "anthropic.claude"}
+)
+AZURE_MODEL = ModelConfig(
+    "azure-gpt-4o", "azure", "GPT-4o on Azure", config={"azure_deployment": "gpt-4o"}
+)
+MESSAGES = [
+    HaivenSystemMessage(
+        content="You are a test assistant\n\nContexts",
+        segments=["You are a test assistant", "\n\nContexts"],
+    ),
+    HaivenHumanMessage(content="Hello"),
+]
+
+
+class TestPromptPrefix:
+    def test_claude_models_get_cacheable_system_segments(self):
+        for model_config in [ANTHROPIC_MODEL, BEDROCK_CLAUDE_MODEL]:
+            json_messages = to_json_messages(MESSAGES, model_config)
+
+            assert json_messages[0] == {
+                "role": "system",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": "You are a test assistant",
+                        "cache_control": CACHE_CONTROL,
+                    },
+                    {
+                        "type": "text",
+                        "text": "\n\nContexts",
+                        "cache_control": CACHE_CONTROL,
+                    },
+                ],
+            }
+            assert json_messages[1] == {"content": "Hello", "role": "user"}
+
+    def test_other_models_get_the_plain_prefix(self):
+        assert to_json_messages(MESSAGES, AZURE_MODEL) == [
+            message.to_json() for message in MESSAGES
+        ]
+
+    def test_contexts_are_aggregated_in_a_stable_order(self):
+        knowledge_base = KnowledgeBaseMarkdown()
+        knowledge_base._knowledge = {
+            "architecture": KnowledgeMarkdown("Architecture", {}),
+            "business": KnowledgeMarkdown("Business", {}),
+        }
+
+        aggregated = knowledge_base.aggregate_all_contexts(
+            ["business", "architecture", "business"], "User context"
+        )
+
+        assert aggregated == "Architecture\n\nBusiness\n\nUser context"
+        assert aggregated == knowledge_base.aggregate_all_contexts(
+            ["architecture", "business"], "User context"
+        )
+
+    @patch("knowledge_manager.KnowledgeManager")
+    def test_chat_system_message_is_split_into_segments(self, mock_knowledge_manager):
+        mock_knowledge_manager.get_system_message.return_value = "System"
+        mock_knowledge_manager.knowledge_base_markdown.aggregate_all_contexts.return_value = "Contexts"
+
+        chat = StreamingChat(MagicMock(), mock_knowledge_manager, contexts=["a"])
+
+        system_message = chat.memory[0]
+        assert "".join(system_message.segments) == system_message.content
+        assert system_message.segments[0] == "System"
+        assert "segments" not in str(system_message)
+
+    def test_cached_prompt_tokens_are_reported(self):
+        usage = MagicMock(
+            prompt_tokens=1200,
+            completion_tokens=20,
+            total_tokens=1220,
+            cache_read_input_tokens=None,
+            cache_creation_input_tokens=None,
+        )
+        usage.prompt_tokens_details.cached_tokens = 1024
+        stream_state = MagicMock(citations=None, usage_data=usage)
+
+        chunks = list(ChatClient(AZURE_MODEL)._final_chunks(stream_state))
+
+        assert chunks[-1]["usage"]["cached_tokens"] == 1024
+        assert chunks[-1]["usage"]["cache_creation_tokens"] == 0
+        event = create_token_usage_event(1200, 20, 1220, "gpt-4o", cached_tokens=1024)
+        assert event.cached_tokens == 1024
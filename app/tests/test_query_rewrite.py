@@ -0,0 +1,128 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from unittest.mock import MagicMock
+
+import pytest
+from llms.clients import HaivenAIMessage, HaivenHumanMessage, HaivenSystemMessage
+from llms.query_rewrite import (
+    HeuristicQueryRewriter,
+    ModelQueryRewriter,
+    NoQueryRewriter,
+    QueryRewriteStats,
+    create_query_rewriter,
+)
+from llms.query_rewrite_config import QueryRewriteConfig
+
+MEMORY = [
+    HaivenSystemMessage(content="You are a helpful assistant"),
+    HaivenHumanMessage(content="How does the PaymentGateway handle ticket PAY-1234?"),
+    HaivenAIMessage(content="It retries the payment three times."),
+]
+
+
+class TestQueryRewrite:
+    def test_first_message_is_used_as_query_without_rewrite(self):
+        chat_client = MagicMock()
+        query_rewriter = ModelQueryRewriter()
+
+        query = query_rewriter.rewrite("What is Ingenuity?", MEMORY[:1], chat_client)
+
+        assert query == "What is Ingenuity?"
+        chat_client.stream.assert_not_called()
+        assert query_rewriter.stats.as_dict() == {}
+
+    def test_llm_rewrite_uses_chat_client(self):
+        chat_client = MagicMock()
+        chat_client.stream.return_value = iter(
+            [{"content": "PaymentGateway "}, {"content": "retries"}]
+        )
+
+        query = ModelQueryRewriter().rewrite("And retries?", MEMORY, chat_client)
+
+        assert query == "PaymentGateway retries"
+        chat_client.stream.assert_called_once()
+
+    def test_llm_rewrite_returns_none_when_no_search_needed(self):
+        chat_client = MagicMock()
+        chat_client.stream.return_value = iter([{"content": "NONE"}])
+
+        assert ModelQueryRewriter().rewrite("Thanks!", MEMORY, chat_client) is None
+
+    def test_small_model_rewrite_uses_its_own_chat_client(self):
+        chat_client = MagicMock()
+        small_model_chat_client = MagicMock()
+        small_model_chat_client.stream.return_value = iter(
+            [{"content": "PaymentGateway retries"}]
+        )
+        query_rewriter = ModelQueryRewriter(small_model_chat_client)
+
+        query = query_rewriter.rewrite("And retries?", MEMORY, chat_client)
+
+        assert query == "PaymentGateway retries"
+        assert query_rewriter.strategy == QueryRewriteConfig.SMALL_MODEL
+        chat_client.stream.assert_not_called()
+
+    def test_none_strategy_returns_message(self):
+        chat_client = MagicMock()
+
+        query = NoQueryRewriter().rewrite("And retries?", MEMORY, chat_client)
+
+        assert query == "And retries?"
+        chat_client.stream.assert_not_called()
+
+    def test_heuristic_adds_keywords_of_recent_user_messages(self):
+        chat_client = MagicMock()
+        query_rewriter = HeuristicQueryRewriter(recent_turns=1, max_keywords=3)
+
+        query = query_rewriter.rewrite("What about retries?", MEMORY, chat_client)
+
+        assert query == "What about retries? PaymentGateway handle ticket"
+        chat_client.stream.assert_not_called()
+
+    def test_heuristic_keeps_identifiers_as_keywords(self):
+        assert HeuristicQueryRewriter.keywords(
+            "Why does PAY-1234 fail in api/v2/orders?"
+        ) == ["PAY-1234", "fail", "api/v2/orders"]
+
+    def test_stats_report_latency_saved_against_llm_rewrites(self):
+        stats = QueryRewriteStats()
+        stats.record(QueryRewriteConfig.LLM, 800)
+        stats.record(QueryRewriteConfig.LLM, 1200)
+
+        assert stats.average_ms(QueryRewriteConfig.LLM) == 1000
+        assert stats.latency_saved_ms(QueryRewriteConfig.HEURISTIC, 2) == 998
+        assert stats.latency_saved_ms(QueryRewriteConfig.NONE, 0) == 1000
+        assert QueryRewriteStats().latency_saved_ms(QueryRewriteConfig.NONE, 0) is None
+
+    def test_rewrites_are_recorded_in_stats(self):
+        stats = QueryRewriteStats()
+        query_rewriter = HeuristicQueryRewriter(stats=stats)
+
+        query_rewriter.rewrite("What about retries?", MEMORY, MagicMock())
+
+        assert stats.as_dict()[QueryRewriteConfig.HEURISTIC]["count"] == 1
+
+    def test_create_query_rewriter_for_configured_strategy(self):
+        assert isinstance(
+            create_query_rewriter(QueryRewriteConfig(QueryRewriteConfig.NONE)),
+            NoQueryRewriter,
+        )
+        assert isinstance(
+            create_query_rewriter(QueryRewriteConfig(QueryRewriteConfig.HEURISTIC)),
+            HeuristicQueryRewriter,
+        )
+        assert (
+            create_query_rewriter(QueryRewriteConfig()).strategy
+            == QueryRewriteConfig.LLM
+        )
+        small_model_chat_client = MagicMock()
+        query_rewriter = create_query_rewriter(
+            QueryRewriteConfig(QueryRewriteConfig.SMALL_MODEL, model="small-model"),
+            small_model_chat_client,
+        )
+        assert query_rewriter.chat_client is small_model_chat_client
+
+    def test_config_rejects_unknown_strategy_and_small_model_without_model(self):
+        with pytest.raises(ValueError):
+            QueryRewriteConfig("unknown")
+        with pytest.raises(ValueError):
+            QueryRewriteConfig.from_dict({"strategy": "small_model", "model": ""})
@@ -0,0 +1,199 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from litellm import RateLimitError
+from llms.model_config import ModelConfig
+from llms.rate_limit import (
+    RateLimiter,
+    RateLimitExceeded,
+    TokenBucket,
+    retry_after_seconds,
+)
+from llms.rate_limit_config import RateLimitConfig
+
+MODEL = "azure/gpt-4o"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    async def async_sleep(self, seconds):
+        self.sleep(seconds)
+
+
+def rate_limit_error(retry_after=None):
+    headers = {"retry-after": str(retry_after)} if retry_after is not None else None
+    return RateLimitError("Too many requests", "azure", MODEL, headers=headers)
+
+
+def create_rate_limiter(clock, requests_per_minute=None, **config):
+    rate_limiter = RateLimiter(
+        RateLimitConfig(**config),
+        clock=clock,
+        sleep=clock.sleep,
+        async_sleep=clock.async_sleep,
+        jitter=lambda: 0.5,
+    )
+    rate_limiter.configure_model(
+        ModelConfig(
+            "gpt-4o",
+            "azure",
+            "GPT-4o",
+            config={
+                "azure_deployment": "gpt-4o",
+                "requests_per_minute": requests_per_minute,
+                "rate_limit_burst": "1",
+            },
+        )
+    )
+    return rate_limiter
+
+
+class TestRateLimit:
+    def test_token_bucket_queues_requests_beyond_its_capacity(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate_per_second=1, capacity=2, clock=clock)
+
+        assert bucket.reserve(max_wait=10) == (True, 0.0)
+        assert bucket.reserve(max_wait=10) == (True, 0.0)
+        assert bucket.reserve(max_wait=10) == (True, 1.0)
+        assert bucket.reserve(max_wait=10) == (True, 2.0)
+        assert bucket.reserve(max_wait=1) == (False, 3.0)
+
+        clock.now += 3
+        assert bucket.wait_time() == 0.0
+
+    def test_token_bucket_without_rate_only_waits_when_paused(self):
+        clock = FakeClock()
+        bucket = TokenBucket(clock=clock)
+
+        for _ in range(100):
+            assert bucket.reserve(max_wait=0) == (True, 0.0)
+        bucket.pause(5)
+        assert bucket.reserve(max_wait=1) == (False, 5.0)
+
+    def test_calls_wait_for_their_turn(self):
+        clock = FakeClock()
+        rate_limiter = create_rate_limiter(clock, requests_per_minute="30")
+
+        rate_limiter.call(lambda **kwargs: "response", model=MODEL)
+        response = rate_limiter.call(lambda **kwargs: "response", model=MODEL)
+
+        assert response == "response"
+        assert clock.sleeps == [0.0, 2.0]
+
+    def test_calls_are_rejected_when_the_wait_exceeds_the_deadline(self):
+        clock = FakeClock()
+        rate_limiter = create_rate_limiter(
+            clock, requests_per_minute="6", max_wait_seconds=5
+        )
+        rate_limiter.call(lambda **kwargs: "response", model=MODEL)
+
+        with pytest.raises(RateLimitExceeded) as error:
+            rate_limiter.call(lambda **kwargs: "response", model=MODEL)
+        assert error.value.retry_after == 10.0
+
+        with pytest.raises(RateLimitExceeded):
+            rate_limiter.check_admission(MODEL)
+
+    def test_rate_limit_errors_are_retried_after_retry_after(self):
+        clock = FakeClock()
+        rate_limiter = create_rate_limiter(clock)
+        results = [rate_limit_error(retry_after=3), "response"]
+
+        def completion(**kwargs):
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        assert rate_limiter.call(completion, model=MODEL) == "response"
+        # Retry-After plus half of the base delay as jitter
+        assert clock.sleeps == [0.0, 3.5, 0.0]
+
+    def test_rate_limit_errors_back_off_exponentially(self):
+        rate_limiter = RateLimiter(
+            RateLimitConfig(base_delay_seconds=1, max_delay_seconds=4),
+            jitter=lambda: 1.0,
+        )
+
+        assert [rate_limiter.backoff_delay(attempt) for attempt in range(1, 5)] == [
+            1,
+            2,
+            4,
+            4,
+        ]
+
+    def test_rate_limit_error_is_raised_after_max_retries(self):
+        clock = FakeClock()
+        rate_limiter = create_rate_limiter(clock, max_retries=1)
+
+        def completion(**kwargs):
+            raise rate_limit_error()
+
+        with pytest.raises(RateLimitError):
+            rate_limiter.call(completion, model=MODEL)
+
+    def test_retry_after_beyond_the_deadline_is_not_waited_for(self):
+        clock = FakeClock()
+        rate_limiter = create_rate_limiter(clock, max_wait_seconds=20)
+
+        def completion(**kwargs):
+            raise rate_limit_error(retry_after=60)
+
+        with pytest.raises(RateLimitExceeded):
+            rate_limiter.call(completion, model=MODEL)
+        assert clock.sleeps == [0.0]
+
+    def test_async_calls_wait_with_async_sleep(self):
+        clock = FakeClock()
+        rate_limiter = create_rate_limiter(clock, requests_per_minute="60")
+        results = [rate_limit_error(retry_after=1), "response"]
+
+        async def completion(**kwargs):
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        response = asyncio.run(rate_limiter.call_async(completion, model=MODEL))
+
+        assert response == "response"
+        assert clock.sleeps == [0.0, 1.5, 0.0]
+
+    def test_retry_after_seconds_from_headers(self):
+        retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+
+        assert retry_after_seconds(rate_limit_error(retry_after=7)) == 7.0
+        assert retry_after_seconds(rate_limit_error()) is None
+        error = RateLimitError(
+            "Too many requests", "azure", MODEL, headers={"Retry-After-Ms": "1500"}
+        )
+        assert retry_after_seconds(error) == 1.5
+        error = RateLimitError(
+            "Too many requests",
+            "azure",
+            MODEL,
+            headers={"Retry-After": format_datetime(retry_at, usegmt=True)},
+        )
+        assert 25 < retry_after_seconds(error) <= 30
+
+    def test_config_from_dict_uses_defaults_for_unset_values(self):
+        config = RateLimitConfig.from_dict({"max_retries": "", "max_wait_seconds": "5"})
+
+        assert config.max_retries == 3
+        assert config.max_wait_seconds == 5.0
+        with pytest.raises(ValueError):
+            RateLimitConfig(base_delay_seconds=10, max_delay_seconds=1)
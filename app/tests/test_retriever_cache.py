@@ -0,0 +1,103 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from unittest.mock import MagicMock
+
+from embeddings.chunk_store import ChunkStore, write_chunk_store
+from embeddings.documents import KnowledgeDocument
+from embeddings.retriever_cache import RetrieverCache
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import FakeEmbeddings
+
+
+def create_document(key: str) -> KnowledgeDocument:
+    return KnowledgeDocument(
+        key=key,
+        retriever=None,
+        title=key,
+        source="",
+        sample_question="",
+        description="",
+        provider="ollama",
+        kb_path=f"embeddings/{key}.kb",
+    )
+
+
+def create_store(text: str) -> FAISS:
+    # 4 float32 values (16 bytes) plus the text length
+    return FAISS.from_embeddings(
+        text_embeddings=[(text, [1.0, 0.0, 0.0, 0.0])],
+        embedding=FakeEmbeddings(size=4),
+    )
+
+
+class TestRetrieverCache:
+    def test_loads_retriever_only_on_first_use(self):
+        store = create_store("chunk")
+        load_retriever = MagicMock(return_value=store)
+        cache = RetrieverCache(load_retriever)
+        document = create_document("doc-a")
+
+        assert cache.loaded_keys() == []
+        assert cache.get(document) is store
+        assert cache.get(document) is store
+
+        load_retriever.assert_called_once_with("embeddings/doc-a.kb")
+        assert cache.loaded_keys() == ["doc-a"]
+
+    def test_evicts_least_recently_used_retrievers_over_memory_budget(self):
+        load_retriever = MagicMock(
+            side_effect=lambda kb_path: create_store("1234")  # 20 bytes each
+        )
+        cache = RetrieverCache(load_retriever, memory_budget_bytes=45)
+        doc_a = create_document("doc-a")
+        doc_b = create_document("doc-b")
+        doc_c = create_document("doc-c")
+
+        cache.get(doc_a)
+        cache.get(doc_b)
+        cache.get(doc_a)
+        cache.get(doc_c)
+
+        assert cache.loaded_keys() == ["doc-a", "doc-c"]
+        assert cache.loaded_bytes() == 40
+
+        cache.get(doc_b)
+        assert load_retriever.call_count == 4
+
+    def test_keeps_the_requested_retriever_even_if_it_exceeds_the_budget(self):
+        cache = RetrieverCache(
+            MagicMock(return_value=create_store("a long chunk")),
+            memory_budget_bytes=1,
+        )
+
+        cache.get(create_document("doc-a"))
+
+        assert cache.loaded_keys() == ["doc-a"]
+
+    def test_keeps_the_loading_lock_of_a_document_until_it_is_evicted(self):
+        # each store is estimated at 16 bytes of vectors plus 10 bytes of text
+        cache = RetrieverCache(
+            MagicMock(side_effect=lambda path: create_store("0123456789")),
+            memory_budget_bytes=30,
+        )
+
+        cache.get(create_document("doc-a"))
+        assert list(cache._loading_locks) == ["doc-a"]
+
+        cache.get(create_document("doc-b"))
+        assert cache.loaded_keys() == ["doc-b"]
+        assert list(cache._loading_locks) == ["doc-b"]
+
+    def test_estimates_the_size_of_chunk_store_documents(self, tmp_path):
+        chunks_file_path = tmp_path / "chunks.arrow"
+        write_chunk_store(
+            chunks_file_path, [Document(page_content="x" * 1000)], ["id-1"]
+        )
+        store = create_store("chunk")
+        chunk_store = ChunkStore(chunks_file_path)
+        store.docstore = chunk_store
+
+        size_bytes = RetrieverCache.estimate_size_bytes(store)
+
+        assert size_bytes == 16 + chunk_store.size_bytes()
+        assert chunk_store.size_bytes() > 1000
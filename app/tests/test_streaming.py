@@ -0,0 +1,266 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+import json
+from unittest.mock import MagicMock, patch
+
+from api.api_basics import (
+    SessionTurnStreamingResponse,
+    UnbatchedFrame,
+    batch_events,
+    cancel_on_disconnect,
+)
+from llms.chat_events import (
+    ChatEventFormatter,
+    ContentEvent,
+    create_content_event,
+    create_error_event,
+    create_metadata_event,
+)
+from llms.chats import StreamingChat
+from llms.clients import (
+    ChatClient,
+    HaivenAIMessage,
+    HaivenHumanMessage,
+    MockChoice,
+    MockDelta,
+    MockResult,
+)
+from llms.model_config import ModelConfig
+from llms.telemetry import MODEL_CALLS, OUTPUT_TOKENS, ChatTelemetry
+
+
+async def stream(events, delay_seconds=0.0):
+    for event in events:
+        if delay_seconds:
+            await asyncio.sleep(delay_seconds)
+        yield event
+
+
+def collect(events, **kwargs):
+    async def frames():
+        return [frame async for frame in batch_events(events, **kwargs)]
+
+    return asyncio.run(frames())
+
+
+class TestStreamBatching:
+    def test_events_within_the_window_are_joined(self):
+        assert collect(stream(["Hel", "lo", " world"]), window_seconds=1) == [
+            "Hello world"
+        ]
+
+    def test_batch_is_sent_when_the_window_has_passed(self):
+        frames = collect(
+            stream(["Hello", " world"], delay_seconds=0.05), window_seconds=0.01
+        )
+
+        assert frames == ["Hello", " world"]
+
+    def test_batch_is_sent_when_it_is_full(self):
+        frames = collect(stream(["aaa", "bbb", "c"]), window_seconds=1, max_chars=5)
+
+        assert frames == ["aaabbb", "c"]
+
+    def test_unbatched_frames_are_sent_on_their_own(self):
+        usage = UnbatchedFrame(json.dumps({"usage": {"total_tokens": 3}}))
+
+        frames = collect(stream(["Hello", usage, " world"]), window_seconds=1)
+
+        assert frames == ["Hello", usage, " world"]
+
+    def test_batching_can_be_switched_off(self):
+        assert collect(stream(["Hello", " world"]), window_seconds=0) == [
+            "Hello",
+            " world",
+        ]
+
+
+class TestChatEventFormatter:
+    def test_content_events_are_formatted_like_before(self):
+        event = create_content_event('Paris, "the capital"\n')
+
+        assert event == ContentEvent('Paris, "the capital"\n')
+        assert ChatEventFormatter.format_for_streaming(event) == event.content
+        assert (
+            ChatEventFormatter.format_for_json(event)
+            == json.dumps({"data": event.content}) + "\n\n"
+        )
+        assert (
+            ChatEventFormatter.format_for_json(create_content_event('{"data": "x"}'))
+            == '{"data": "x"}\n\n'
+        )
+
+    def test_other_events_are_formatted_like_before(self):
+        metadata_event = create_metadata_event(citations=["https://example.com"])
+
+        assert ChatEventFormatter.format_for_json(metadata_event) == (
+            json.dumps({"metadata": {"citations": ["https://example.com"]}}) + "\n\n"
+        )
+        assert (
+            ChatEventFormatter.format_for_streaming(create_error_event("boom"))
+            == "boom"
+        )
+
+
+def create_slow_chat(chunks, telemetry=None):
+    knowledge_manager = MagicMock()
+    knowledge_manager.get_system_message.return_value = "System"
+    knowledge_manager.knowledge_base_markdown.aggregate_all_contexts.return_value = None
+    chat_client = MagicMock()
+    chat_client.model_config.lite_id = "azure/gpt-4o"
+    chat_client.answered_by = chat_client.model_config
+
+    async def astream(messages):
+        for chunk in chunks:
+            yield chunk
+        # the model is still generating when the client goes away
+        await asyncio.sleep(10)
+
+    chat_client.astream.side_effect = astream
+    chat = StreamingChat(
+        chat_client, knowledge_manager, telemetry=telemetry, category="chat"
+    )
+    chat.on_turn_end = MagicMock()
+    return chat
+
+
+def disconnect_after(checks):
+    calls = []
+
+    async def is_disconnected():
+        calls.append(True)
+        return len(calls) > checks
+
+    return is_disconnected
+
+
+class TestClientDisconnect:
+    def test_stream_is_cancelled_when_the_client_disconnects(self):
+        closed = []
+
+        async def events():
+            try:
+                yield "Hello"
+                await asyncio.sleep(10)
+                yield " world"
+            finally:
+                closed.append(True)
+
+        async def run():
+            return [
+                event
+                async for event in cancel_on_disconnect(
+                    events(), disconnect_after(1), poll_seconds=0.01
+                )
+            ]
+
+        assert asyncio.run(run()) == ["Hello"]
+        assert closed == [True]
+
+    def test_aborted_turns_keep_the_answer_streamed_until_then(self):
+        telemetry = ChatTelemetry()
+        chat = create_slow_chat([{"content": "Paris is"}], telemetry)
+
+        async def run():
+            return [
+                event
+                async for event in cancel_on_disconnect(
+                    chat.run_async("What is the capital of France?"),
+                    disconnect_after(1),
+                    poll_seconds=0.01,
+                )
+            ]
+
+        asyncio.run(run())
+
+        assert chat.memory[1:] == [
+            HaivenHumanMessage(content="What is the capital of France?"),
+            HaivenAIMessage(content="Paris is"),
+        ]
+        chat.on_turn_end.assert_called_once_with(chat)
+        labels = {
+            "chat_type": "StreamingChat",
+            "model": "azure/gpt-4o",
+            "category": "chat",
+        }
+        assert (
+            telemetry.registry.counter(MODEL_CALLS, {**labels, "status": "aborted"})
+            == 1
+        )
+        assert telemetry.registry.counter(OUTPUT_TOKENS, labels) == 2
+
+    def test_questions_without_an_answer_are_dropped_when_aborted(self):
+        chat = create_slow_chat([])
+
+        async def run():
+            turn = chat.run_async("What is the capital of France?")
+            pending = asyncio.ensure_future(turn.__anext__())
+            await asyncio.sleep(0.01)
+            pending.cancel()
+            await asyncio.wait({pending})
+
+        asyncio.run(run())
+
+        assert len(chat.memory) == 1
+        chat.on_turn_end.assert_called_once_with(chat)
+
+    @patch("llms.clients.llmCompletionAsync")
+    def test_model_response_is_closed_when_its_stream_is(self, mock_completion):
+        response = FakeModelResponse(["Paris", " is"])
+
+        async def completion(**kwargs):
+            return response
+
+        mock_completion.side_effect = completion
+        chat_client = ChatClient(
+            ModelConfig("azure-gpt-4o", "azure", "GPT-4o", config={})
+        )
+
+        async def run():
+            stream = chat_client.astream(
+                [HaivenHumanMessage(content="What is the capital of France?")]
+            )
+            first_chunk = await stream.__anext__()
+            await stream.aclose()
+            return first_chunk
+
+        assert asyncio.run(run()) == {"content": "Paris"}
+        assert response.closed
+
+    def test_session_turn_is_released_when_the_stream_never_started(self):
+        session_turn = MagicMock()
+        started = []
+
+        async def events():
+            started.append(True)
+            yield "data"
+
+        async def disconnected_send(message):
+            raise OSError("client disconnected")
+
+        response = SessionTurnStreamingResponse(session_turn, events())
+        scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+
+        async def run():
+            try:
+                await response(scope, None, disconnected_send)
+            except Exception:
+                pass
+
+        asyncio.run(run())
+
+        assert started == []
+        session_turn.release.assert_called_once()
+
+
+class FakeModelResponse:
+    def __init__(self, contents):
+        self.contents = contents
+        self.closed = False
+
+    async def __aiter__(self):
+        for content in self.contents:
+            yield MockResult(choices=[MockChoice(delta=MockDelta(content=content))])
+
+    async def aclose(self):
+        self.closed = True
@@ -0,0 +1,192 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+from unittest.mock import MagicMock, patch
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from llms.chats import JSONChat, StreamingChat
+from llms.latency_stats import LatencyHistogram, ProviderLatencyStats
+from llms.prometheus import format_histogram, to_labels
+from llms.telemetry import (
+    CHAT_PHASE_DURATION,
+    HTTP_REQUEST_DURATION,
+    INTER_TOKEN_LATENCY,
+    MODEL_CALLS,
+    OUTPUT_TOKENS,
+    STREAM_DURATION,
+    TIME_TO_FIRST_TOKEN,
+    ChatTelemetry,
+    Span,
+)
+from server import Server
+
+CHUNKS = [
+    {"content": "Hello"},
+    {"content": " world"},
+    {"usage": {"prompt_tokens": 12, "completion_tokens": 2, "total_tokens": 14}},
+]
+LABELS = {"chat_type": "StreamingChat", "model": "azure/gpt-4o", "category": "chat"}
+
+
+def create_chat(chat_class, telemetry, chunks=CHUNKS):
+    knowledge_manager = MagicMock()
+    knowledge_manager.get_system_message.return_value = "System"
+    knowledge_manager.knowledge_base_markdown.aggregate_all_contexts.return_value = None
+    chat_client = MagicMock()
+    chat_client.model_config.lite_id = "azure/gpt-4o"
+    chat_client.answered_by = chat_client.model_config
+    chat_client.stream.side_effect = lambda messages: iter(chunks)
+
+    async def astream(messages):
+        for chunk in chunks:
+            yield chunk
+
+    chat_client.astream.side_effect = astream
+    return chat_class(
+        chat_client, knowledge_manager, telemetry=telemetry, category="chat"
+    )
+
+
+class TestChatTelemetry:
+    def test_streamed_responses_record_first_token_gaps_and_tokens(self):
+        telemetry = ChatTelemetry()
+        chat = create_chat(StreamingChat, telemetry)
+
+        list(chat.run("Hi"))
+
+        registry = telemetry.registry
+        assert registry.histogram(TIME_TO_FIRST_TOKEN, LABELS).count == 1
+        assert registry.histogram(INTER_TOKEN_LATENCY, LABELS).count == 1
+        assert registry.histogram(STREAM_DURATION, LABELS).count == 1
+        assert registry.counter(OUTPUT_TOKENS, LABELS) == 2
+        assert registry.counter(MODEL_CALLS, {**LABELS, "status": "ok"}) == 1
+
+    def test_async_json_chats_are_recorded_under_their_chat_type(self):
+        telemetry = ChatTelemetry()
+        chat = create_chat(JSONChat, telemetry)
+
+        async def run():
+            return [event async for event in chat.run_async("Hi")]
+
+        asyncio.run(run())
+
+        labels = {**LABELS, "chat_type": "JSONChat"}
+        assert telemetry.registry.histogram(TIME_TO_FIRST_TOKEN, labels).count == 1
+
+    def test_failed_model_calls_are_counted(self):
+        telemetry = ChatTelemetry()
+        chat = create_chat(StreamingChat, telemetry)
+
+        def failing_stream(messages):
+            raise ConnectionError("down")
+            yield
+
+        chat.chat_client.stream.side_effect = failing_stream
+
+        list(chat.run("Hi"))
+
+        registry = telemetry.registry
+        assert registry.counter(MODEL_CALLS, {**LABELS, "status": "error"}) == 1
+        assert registry.histogram(TIME_TO_FIRST_TOKEN, LABELS) is None
+
+    def test_model_calls_are_labelled_with_the_model_that_answered(self):
+        telemetry = ChatTelemetry()
+        chat = create_chat(StreamingChat, telemetry)
+        fallback_model = MagicMock()
+        fallback_model.lite_id = "bedrock/claude"
+
+        def fallback_stream(messages):
+            chat.chat_client.answered_by = fallback_model
+            yield from CHUNKS
+
+        chat.chat_client.stream.side_effect = fallback_stream
+
+        list(chat.run("Hi"))
+
+        labels = {**LABELS, "model": "bedrock/claude"}
+        assert telemetry.registry.histogram(TIME_TO_FIRST_TOKEN, labels).count == 1
+        assert telemetry.registry.histogram(TIME_TO_FIRST_TOKEN, LABELS) is None
+
+    def test_phases_are_timed_in_spans_of_the_turn(self):
+        telemetry = ChatTelemetry()
+        chat = create_chat(StreamingChat, telemetry)
+        chat.query_rewriter = MagicMock()
+        chat.query_rewriter.rewrite.return_value = "capital of France"
+        chat.knowledge_manager.knowledge_base_documents.similarity_search_on_multiple_documents.return_value = []
+        chat.knowledge_manager.knowledge_base_documents.get_search_result_items.return_value = []
+
+        with patch.object(Span, "end", autospec=True, return_value=1.0) as end_span:
+            list(chat.run_with_document(["document"], "What is the capital?"))
+
+        spans = {call.args[0].name: call.args[0] for call in end_span.call_args_list}
+        assert set(spans) == {
+            "chat.turn",
+            "chat.query_rewrite",
+            "chat.retrieval",
+            "chat.generation",
+        }
+        turn = spans["chat.turn"]
+        for name in ["chat.query_rewrite", "chat.retrieval", "chat.generation"]:
+            assert spans[name].trace_id == turn.trace_id
+            assert spans[name].parent_span_id == turn.span_id
+        phase_labels = {"chat_type": "StreamingChat", "category": "chat"}
+        assert (
+            telemetry.registry.histogram(
+                CHAT_PHASE_DURATION, {**phase_labels, "phase": "retrieval"}
+            ).count
+            == 1
+        )
+
+    def test_prometheus_text_has_cumulative_buckets_in_seconds(self):
+        histogram = LatencyHistogram([100, 1000])
+        histogram.record(50)
+        histogram.record(500)
+        histogram.record(5000)
+
+        lines = format_histogram(
+            "latency_seconds", "Latency", {to_labels({"model": 'a"b'}): histogram}
+        )
+
+        assert lines == [
+            "# HELP latency_seconds Latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{model="a\\"b",le="0.1"} 1',
+            'latency_seconds_bucket{model="a\\"b",le="1"} 2',
+            'latency_seconds_bucket{model="a\\"b",le="+Inf"} 3',
+            'latency_seconds_sum{model="a\\"b"} 5.55',
+            'latency_seconds_count{model="a\\"b"} 3',
+        ]
+
+    def test_metrics_include_provider_latencies(self):
+        telemetry = ChatTelemetry()
+        latency_stats = ProviderLatencyStats()
+        latency_stats.record_first_chunk("azure", 300)
+        latency_stats.record_failure("aws")
+
+        text = telemetry.to_prometheus(latency_stats)
+
+        assert (
+            'haiven_llm_provider_first_chunk_seconds_count{provider="azure"} 1' in text
+        )
+        assert 'haiven_llm_provider_failures_total{provider="aws"} 1' in text
+
+    def test_requests_are_recorded_by_route_template(self):
+        chat_manager = MagicMock()
+        chat_manager.telemetry = ChatTelemetry()
+        server = Server(chat_manager, MagicMock())
+        app = FastAPI()
+        server.record_request_metrics(app)
+
+        @app.get("/api/items/{item_id}")
+        def get_item(item_id: str):
+            return {"id": item_id}
+
+        client = TestClient(app)
+        client.get("/api/items/1")
+        client.get("/api/items/2")
+
+        histogram = chat_manager.telemetry.registry.histogram(
+            HTTP_REQUEST_DURATION,
+            {"method": "GET", "endpoint": "/api/items/{item_id}", "status": "200"},
+        )
+        assert histogram.count == 2
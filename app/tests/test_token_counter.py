@@ -0,0 +1,127 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from unittest.mock import MagicMock, patch
+
+import pytest
+from langchain_core.documents import Document
+from llms.chats import StreamingChat
+from llms.clients import ChatClient, HaivenHumanMessage, HaivenSystemMessage
+from llms.model_config import ModelConfig
+from llms.token_counter import ContextWindowExceeded, TokenCounter
+
+GPT_4O_MODEL = ModelConfig(
+    "azure-gpt-4o",
+    "azure",
+    "GPT-4o on Azure",
+    config={"azure_deployment": "chat-deployment", "max_input_tokens": "100"},
+)
+CLAUDE_MODEL = ModelConfig(
+    "aws-claude", "aws", "Claude on AWS", config={"model_id": "anthropic.claude"}
+)
+MESSAGES = [
+    HaivenSystemMessage(content="You are a test assistant"),
+    HaivenHumanMessage(content="What is the capital of France?"),
+]
+
+
+class TestTokenCounter:
+    def test_counts_with_the_encoding_of_the_model(self):
+        token_counter = TokenCounter()
+
+        assert token_counter.encoding_name(GPT_4O_MODEL) == "o200k_base"
+        assert token_counter.encoding_name(CLAUDE_MODEL) == "cl100k_base"
+        assert token_counter.count_text("hello world", GPT_4O_MODEL) == 2
+        # 3 tokens priming the reply, 4 per message on top of the content
+        assert token_counter.count_messages(MESSAGES, GPT_4O_MODEL) == (
+            3
+            + sum(
+                token_counter.count_text(message.content, GPT_4O_MODEL) + 4
+                for message in MESSAGES
+            )
+        )
+
+    def test_encoders_are_loaded_once_and_counts_are_cached(self):
+        token_counter = TokenCounter()
+
+        with patch("llms.token_counter.tiktoken.get_encoding") as mock_get_encoding:
+            mock_get_encoding.return_value.encode.return_value = [1, 2, 3]
+            token_counter.count_text("first", GPT_4O_MODEL)
+            token_counter.count_text("second", GPT_4O_MODEL)
+            token_counter.count_text("first", GPT_4O_MODEL)
+
+        mock_get_encoding.assert_called_once_with("o200k_base")
+        assert mock_get_encoding.return_value.encode.call_count == 2
+
+    def test_estimates_tokens_when_the_encoding_cannot_be_loaded(self):
+        token_counter = TokenCounter()
+
+        with patch(
+            "llms.token_counter.tiktoken.get_encoding", side_effect=OSError("offline")
+        ):
+            assert token_counter.count_text("x" * 40, CLAUDE_MODEL) == 10
+
+    def test_max_input_tokens_from_the_model_config_or_the_catalog(self):
+        token_counter = TokenCounter()
+        catalog_model = ModelConfig(
+            "openai-gpt-4o", "openai", "GPT-4o", config={"model_name": "gpt-4o"}
+        )
+        unknown_model = ModelConfig(
+            "ollama-custom", "ollama", "Custom", config={"model": "not-a-model"}
+        )
+
+        assert token_counter.max_input_tokens(GPT_4O_MODEL) == 100
+        assert token_counter.max_input_tokens(catalog_model) > 100000
+        assert token_counter.max_input_tokens(unknown_model) is None
+
+    @patch("llms.clients.llmCompletion")
+    def test_oversized_requests_fail_before_they_are_sent(self, mock_completion):
+        chat_client = ChatClient(GPT_4O_MODEL, token_counter=TokenCounter())
+
+        with pytest.raises(ContextWindowExceeded) as error:
+            list(chat_client.stream([HaivenHumanMessage(content="word " * 200)]))
+
+        assert error.value.max_input_tokens == 100
+        mock_completion.assert_not_called()
+
+    @patch("llms.clients.llmCompletion")
+    def test_pre_count_is_reported_next_to_the_usage(self, mock_completion):
+        token_counter = TokenCounter()
+        chat_client = ChatClient(GPT_4O_MODEL, token_counter=token_counter)
+        mock_completion.return_value = iter(
+            [
+                {
+                    "usage": {
+                        "prompt_tokens": 25,
+                        "completion_tokens": 5,
+                        "total_tokens": 30,
+                    }
+                }
+            ]
+        )
+
+        chunks = list(chat_client.stream(MESSAGES))
+
+        assert chunks[-1]["usage"]["estimated_prompt_tokens"] == (
+            token_counter.count_messages(MESSAGES, GPT_4O_MODEL)
+        )
+
+    @patch("knowledge_manager.KnowledgeManager")
+    def test_context_documents_are_trimmed_to_the_context_window(
+        self, mock_knowledge_manager
+    ):
+        mock_knowledge_manager.get_system_message.return_value = "System"
+        mock_knowledge_manager.knowledge_base_markdown.aggregate_all_contexts.return_value = None
+        chat_client = ChatClient(GPT_4O_MODEL, token_counter=TokenCounter())
+        streaming_chat = StreamingChat(
+            chat_client, mock_knowledge_manager, query_rewriter=MagicMock()
+        )
+        documents = [
+            Document(page_content="best " * 10),
+            Document(page_content="long " * 80),
+            Document(page_content="short"),
+        ]
+
+        fitted_documents = streaming_chat._fit_context_documents(
+            documents, "What is the capital of France?"
+        )
+
+        assert fitted_documents == [documents[0], documents[2]]
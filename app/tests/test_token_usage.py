@@ -1,9 +1,11 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
 import unittest
 from unittest.mock import MagicMock, patch
 from api.api_basics import HaivenBaseApi
 from llms.model_config import ModelConfig
 from llms.chats import ChatManager, StreamingChat
+from llms.rate_limit import RateLimitExceeded
 
 
 class TestTokenUsage(unittest.TestCase):
@@ -77,6 +79,47 @@ class TestTokenUsage(unittest.TestCase):
             # The stream should now include token usage events
             self.assertTrue(hasattr(result, "body_iterator"))
 
+    def test_stream_uses_async_run_of_chat_session(self):
+        """Test that chats with an async run are streamed from the event loop"""
+
+        class AsyncChat:
+            def run(self, prompt):
+                raise AssertionError("the sync run should not be used")
+
+            async def run_async(self, prompt):
+                yield "Hello"
+                yield " world"
+
+        self.mock_chat_manager.streaming_chat.return_value = (
+            "session-123",
+            AsyncChat(),
+        )
+
+        with patch.object(self.api, "log_run"):
+            result = self.api.stream_text_chat(
+                prompt="Test prompt",
+                chat_category="test",
+                chat_session_key_value="session-123",
+            )
+
+        async def collect():
+            return [chunk async for chunk in result.body_iterator]
+
+        # chunks arriving within the batch window are sent as one frame
+        self.assertEqual(asyncio.run(collect()), ["Hello world"])
+
+    def test_stream_is_rejected_when_rate_limit_wait_is_too_long(self):
+        """Test that a request the model can not take in time gets a 429 right away"""
+        self.mock_chat_manager.check_rate_limit.side_effect = RateLimitExceeded(
+            "azure/gpt-4o", 12.5
+        )
+
+        result = self.api.stream_text_chat(prompt="Test prompt", chat_category="test")
+
+        self.assertEqual(result.status_code, 429)
+        self.assertEqual(result.headers["Retry-After"], "13")
+        self.mock_chat_manager.streaming_chat.assert_not_called()
+
     def test_stream_options_include_usage(self):
         """Test that stream_options include usage is properly configured"""
         # This test verifies that the ChatClient is configured to include usage data
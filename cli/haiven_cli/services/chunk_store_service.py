@@ -0,0 +1,129 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import json
+import os
+import pickle
+import uuid
+
+import faiss
+import numpy as np
+import pyarrow as pa
+from langchain_core.documents import Document
+
+CHUNKS_FILE_NAME = "chunks.arrow"
+VECTORS_FILE_NAME = "vectors.npy"
+INDEX_FILE_NAME = "index.faiss"
+DOCSTORE_FILE_NAME = "index.pkl"
+
+CHUNKS_SCHEMA = pa.schema(
+    [
+        pa.field("id", pa.string()),
+        pa.field("page_content", pa.string()),
+        pa.field("metadata", pa.string()),
+    ]
+)
+
+
+class ChunkStoreService:
+    """
+    Writes a .kb folder as a float32 vectors matrix (vectors.npy), a flat FAISS index over the
+    same vectors (index.faiss) and an uncompressed Arrow IPC file with the text and metadata of
+    each chunk (chunks.arrow), all in the same row order. The app memory-maps the index and the
+    chunks, so loading a folder does not parse or unpickle anything.
+    Folders in the earlier format (index.faiss and a pickled index.pkl) are converted when
+    documents are added to them, so their chunks are kept.
+    """
+
+    def save(self, output_dir: str, documents: list[Document], vectors) -> int:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) != len(documents):
+            raise ValueError("expected one embedding vector per document")
+
+        table = self._chunks_table([str(uuid.uuid4()) for _ in documents], documents)
+
+        existing = self._read(output_dir)
+        if existing is not None:
+            existing_table, existing_vectors = existing
+            if existing_vectors.shape[1] != vectors.shape[1]:
+                raise ValueError(
+                    f"cannot add {vectors.shape[1]} dimensional embeddings to {output_dir}, it holds {existing_vectors.shape[1]} dimensional ones"
+                )
+            table = pa.concat_tables([existing_table, table])
+            vectors = np.vstack([existing_vectors, vectors])
+
+        os.makedirs(output_dir, exist_ok=True)
+        self._write_vectors(output_dir, vectors)
+        self._write_index(output_dir, vectors)
+        self._write_chunks(output_dir, table)
+
+        # the pickled docstore of a converted folder no longer matches its index
+        docstore_path = os.path.join(output_dir, DOCSTORE_FILE_NAME)
+        if os.path.exists(docstore_path):
+            os.remove(docstore_path)
+        return table.num_rows
+
+    def _read(self, output_dir: str):
+        chunks_path = os.path.join(output_dir, CHUNKS_FILE_NAME)
+        vectors_path = os.path.join(output_dir, VECTORS_FILE_NAME)
+        if os.path.exists(chunks_path) and os.path.exists(vectors_path):
+            with pa.OSFile(chunks_path, "rb") as source:
+                table = pa.ipc.open_file(source).read_all()
+            return table, np.load(vectors_path)
+
+        if os.path.exists(os.path.join(output_dir, DOCSTORE_FILE_NAME)):
+            return self._read_pickled(output_dir)
+        return None
+
+    def _read_pickled(self, output_dir: str):
+        index_path = os.path.join(output_dir, INDEX_FILE_NAME)
+        if not os.path.exists(index_path):
+            raise ValueError(
+                f"cannot add documents to {output_dir}, it has a {DOCSTORE_FILE_NAME} without an {INDEX_FILE_NAME}"
+            )
+
+        with open(os.path.join(output_dir, DOCSTORE_FILE_NAME), "rb") as file:
+            docstore, index_to_docstore_id = pickle.load(file)
+        index = faiss.read_index(index_path)
+        rows = sorted(index_to_docstore_id.keys())
+        if rows != list(range(index.ntotal)):
+            raise ValueError(
+                f"cannot convert {output_dir}, its docstore does not cover the {index.ntotal} vectors of its index"
+            )
+
+        ids = [index_to_docstore_id[row] for row in rows]
+        documents = [docstore.search(document_id) for document_id in ids]
+        table = self._chunks_table([str(document_id) for document_id in ids], documents)
+        return table, index.reconstruct_n(0, index.ntotal)
+
+    def _chunks_table(self, ids: list[str], documents: list[Document]) -> pa.Table:
+        return pa.table(
+            {
+                "id": ids,
+                "page_content": [document.page_content for document in documents],
+                "metadata": [
+                    json.dumps(document.metadata or {}, default=str)
+                    for document in documents
+                ],
+            },
+            schema=CHUNKS_SCHEMA,
+        )
+
+    def _write_vectors(self, output_dir: str, vectors: np.ndarray):
+        # np.save appends .npy to names without it, so write through a file object
+        temporary_path = os.path.join(output_dir, f"{VECTORS_FILE_NAME}.tmp")
+        with open(temporary_path, "wb") as file:
+            np.save(file, np.ascontiguousarray(vectors))
+        os.replace(temporary_path, os.path.join(output_dir, VECTORS_FILE_NAME))
+
+    def _write_index(self, output_dir: str, vectors: np.ndarray):
+        index = faiss.IndexFlatL2(vectors.shape[1])
+        index.add(np.ascontiguousarray(vectors))
+        temporary_path = os.path.join(output_dir, f"{INDEX_FILE_NAME}.tmp")
+        faiss.write_index(index, temporary_path)
+        os.replace(temporary_path, os.path.join(output_dir, INDEX_FILE_NAME))
+
+    def _write_chunks(self, output_dir: str, table: pa.Table):
+        temporary_path = os.path.join(output_dir, f"{CHUNKS_FILE_NAME}.tmp")
+        with pa.OSFile(temporary_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(temporary_path, os.path.join(output_dir, CHUNKS_FILE_NAME))
@@ -1,16 +1,20 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
-from langchain_community.vectorstores import FAISS
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from haiven_cli.services.chunk_store_service import ChunkStoreService
 from haiven_cli.services.embedding_service import EmbeddingService
 from haiven_cli.services.token_service import TokenService
 
 
 class KnowledgeService:
     def __init__(
-        self, token_service: TokenService, embedding_service: EmbeddingService
+        self,
+        token_service: TokenService,
+        embedding_service: EmbeddingService,
+        chunk_store_service: ChunkStoreService = None,
     ):
         self.token_service = token_service
         self.embedding_service = embedding_service
+        self.chunk_store_service = chunk_store_service or ChunkStoreService()
 
     def index(self, texts, metadatas, embedding_model, output_dir):
         if texts is None or len(texts) == 0:
@@ -31,14 +35,10 @@ class KnowledgeService:
         print("Loading embeddings model", embedding_model.name, "...")
         embeddings = self.embedding_service.load_embeddings(embedding_model)
 
-        print("Creating DB...")
-        db = FAISS.from_documents(documents, embeddings)
-        try:
-            local_db = FAISS.load_local(output_dir, embeddings)
-            local_db.merge_from(db)
-        except ValueError:
-            print("Indexing to new path")
-            local_db = db
-
-        print("Saving DB to", output_dir)
-        local_db.save_local(output_dir)
+        print("Embedding", len(documents), "documents...")
+        vectors = embeddings.embed_documents(
+            [document.page_content for document in documents]
+        )
+
+        print("Saving chunks and vectors to", output_dir)
+        self.chunk_store_service.save(output_dir, documents, vectors)
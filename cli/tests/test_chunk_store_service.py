@@ -0,0 +1,123 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import json
+import os
+
+import faiss
+import numpy as np
+import pyarrow as pa
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import FakeEmbeddings
+
+from haiven_cli.services.chunk_store_service import (
+    CHUNKS_FILE_NAME,
+    INDEX_FILE_NAME,
+    VECTORS_FILE_NAME,
+    ChunkStoreService,
+)
+
+
+def read_chunks(output_dir):
+    with pa.memory_map(os.path.join(output_dir, CHUNKS_FILE_NAME), "r") as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+class TestChunkStoreService:
+    def test_save_writes_chunks_and_vectors_in_the_same_order(self, tmp_path):
+        output_dir = str(tmp_path / "document.kb")
+        documents = [
+            Document(page_content="first", metadata={"page": 1}),
+            Document(page_content="second", metadata={"page": 2}),
+        ]
+
+        row_count = ChunkStoreService().save(
+            output_dir, documents, [[1.0, 0.0], [0.0, 1.0]]
+        )
+
+        assert row_count == 2
+        vectors = np.load(os.path.join(output_dir, VECTORS_FILE_NAME))
+        assert vectors.dtype == np.float32
+        assert vectors.tolist() == [[1.0, 0.0], [0.0, 1.0]]
+        chunks = read_chunks(output_dir)
+        assert chunks.column("page_content").to_pylist() == ["first", "second"]
+        assert [
+            json.loads(metadata) for metadata in chunks.column("metadata").to_pylist()
+        ] == [{"page": 1}, {"page": 2}]
+        assert sorted(os.listdir(output_dir)) == [
+            CHUNKS_FILE_NAME,
+            INDEX_FILE_NAME,
+            VECTORS_FILE_NAME,
+        ]
+
+    def test_save_writes_an_index_over_the_vectors(self, tmp_path):
+        output_dir = str(tmp_path / "document.kb")
+
+        ChunkStoreService().save(
+            output_dir,
+            [Document(page_content="first"), Document(page_content="second")],
+            [[1.0, 0.0], [0.0, 1.0]],
+        )
+
+        index = faiss.read_index(os.path.join(output_dir, INDEX_FILE_NAME))
+        assert index.ntotal == 2
+        _, rows = index.search(np.array([[0.1, 0.9]], dtype=np.float32), 1)
+        assert rows.tolist() == [[1]]
+
+    def test_save_appends_to_an_existing_folder(self, tmp_path):
+        output_dir = str(tmp_path / "document.kb")
+        chunk_store_service = ChunkStoreService()
+        chunk_store_service.save(
+            output_dir, [Document(page_content="first")], [[1.0, 0.0]]
+        )
+
+        row_count = chunk_store_service.save(
+            output_dir, [Document(page_content="second")], [[0.0, 1.0]]
+        )
+
+        assert row_count == 2
+        vectors = np.load(os.path.join(output_dir, VECTORS_FILE_NAME))
+        assert vectors.tolist() == [[1.0, 0.0], [0.0, 1.0]]
+        assert read_chunks(output_dir).column("page_content").to_pylist() == [
+            "first",
+            "second",
+        ]
+
+    def test_save_converts_a_folder_with_a_pickled_docstore(self, tmp_path):
+        output_dir = str(tmp_path / "document.kb")
+        FAISS.from_embeddings(
+            text_embeddings=[("first", [1.0, 0.0]), ("second", [0.0, 1.0])],
+            embedding=FakeEmbeddings(size=2),
+            metadatas=[{"page": 1}, {"page": 2}],
+        ).save_local(output_dir)
+
+        row_count = ChunkStoreService().save(
+            output_dir, [Document(page_content="third")], [[1.0, 1.0]]
+        )
+
+        assert row_count == 3
+        vectors = np.load(os.path.join(output_dir, VECTORS_FILE_NAME))
+        assert vectors.tolist() == [[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]]
+        chunks = read_chunks(output_dir)
+        assert chunks.column("page_content").to_pylist() == [
+            "first",
+            "second",
+            "third",
+        ]
+        assert [
+            json.loads(metadata) for metadata in chunks.column("metadata").to_pylist()
+        ] == [{"page": 1}, {"page": 2}, {}]
+        assert faiss.read_index(os.path.join(output_dir, INDEX_FILE_NAME)).ntotal == 3
+        assert not os.path.exists(os.path.join(output_dir, "index.pkl"))
+
+    def test_save_rejects_embeddings_of_another_dimension(self, tmp_path):
+        output_dir = str(tmp_path / "document.kb")
+        chunk_store_service = ChunkStoreService()
+        chunk_store_service.save(
+            output_dir, [Document(page_content="first")], [[1.0, 0.0]]
+        )
+
+        with pytest.raises(ValueError):
+            chunk_store_service.save(
+                output_dir, [Document(page_content="second")], [[0.0, 1.0, 0.0]]
+            )
@@ -1,5 +1,6 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 import pytest
+from langchain_core.documents import Document
 
 from haiven_cli.services.knowledge_service import KnowledgeService
 from unittest.mock import MagicMock, patch
@@ -47,9 +48,8 @@ class TestKnowledgeService:
             knowledge_service.index(text, metadatas, embedding_model, ouput_dir)
         assert str(e.value) == "embedding model has no value"
 
-    @patch("haiven_cli.services.knowledge_service.FAISS")
     @patch("haiven_cli.services.knowledge_service.RecursiveCharacterTextSplitter")
-    def test_save_knowledge_to_new_path(self, mock_text_splitter, mock_faiss):
+    def test_save_knowledge_to_path(self, mock_text_splitter):
         text = "something cool"
         texts = [text]
         metadatas = {}
@@ -58,60 +58,21 @@ class TestKnowledgeService:
 
         token_service = MagicMock()
 
-        documents = MagicMock()
+        documents = [Document(page_content="something"), Document(page_content="cool")]
         text_splitter = MagicMock()
         text_splitter.create_documents.return_value = documents
         mock_text_splitter.return_value = text_splitter
 
         embeddings = MagicMock()
+        vectors = [[0.1, 0.2], [0.3, 0.4]]
+        embeddings.embed_documents.return_value = vectors
         embedding_service = MagicMock()
         embedding_service.load_embeddings.return_value = embeddings
+        chunk_store_service = MagicMock()
 
-        local_db = MagicMock()
-        mock_faiss.from_documents.return_value = local_db
-        mock_faiss.load_local.side_effect = ValueError("Some Error")
-
-        knowledge_service = KnowledgeService(token_service, embedding_service)
-        knowledge_service.index(texts, metadatas, embedding_model, ouput_dir)
-
-        mock_text_splitter.assert_called_once_with(
-            chunk_size=300,
-            chunk_overlap=50,
-            length_function=token_service.get_tokens_length,
-            separators=["\n\n", "\n", " ", ""],
+        knowledge_service = KnowledgeService(
+            token_service, embedding_service, chunk_store_service
         )
-        text_splitter.create_documents.assert_called_once_with(texts, metadatas)
-        embedding_service.load_embeddings.assert_called_once_with(embedding_model)
-        mock_faiss.from_documents.assert_called_once_with(documents, embeddings)
-        mock_faiss.load_local.assert_called_once_with(ouput_dir, embeddings)
-        local_db.save_local.assert_called_once_with(ouput_dir)
-
-    @patch("haiven_cli.services.knowledge_service.FAISS")
-    @patch("haiven_cli.services.knowledge_service.RecursiveCharacterTextSplitter")
-    def test_save_knowledge_to_existing_path(self, mock_text_splitter, mock_faiss):
-        text = "something cool"
-        texts = [text]
-        metadatas = {}
-        embedding_model = MagicMock()
-        ouput_dir = "test knowledge base path"
-
-        token_service = MagicMock()
-
-        documents = MagicMock()
-        text_splitter = MagicMock()
-        text_splitter.create_documents.return_value = documents
-        mock_text_splitter.return_value = text_splitter
-
-        embeddings = MagicMock()
-        embedding_service = MagicMock()
-        embedding_service.load_embeddings.return_value = embeddings
-
-        local_db = MagicMock()
-        mock_faiss.from_documents.return_value = local_db
-        db = MagicMock()
-        mock_faiss.load_local.return_value = db
-
-        knowledge_service = KnowledgeService(token_service, embedding_service)
         knowledge_service.index(texts, metadatas, embedding_model, ouput_dir)
 
         mock_text_splitter.assert_called_once_with(
@@ -122,7 +83,5 @@ class TestKnowledgeService:
         )
         text_splitter.create_documents.assert_called_once_with(texts, metadatas)
         embedding_service.load_embeddings.assert_called_once_with(embedding_model)
-        mock_faiss.from_documents.assert_called_once_with(documents, embeddings)
-        mock_faiss.load_local.assert_called_once_with(ouput_dir, embeddings)
-        db.merge_from.assert_called_once_with(local_db)
-        db.save_local.assert_called_once_with(ouput_dir)
+        embeddings.embed_documents.assert_called_once_with(["something", "cool"])
+        chunk_store_service.save.assert_called_once_with(ouput_dir, documents, vectors)